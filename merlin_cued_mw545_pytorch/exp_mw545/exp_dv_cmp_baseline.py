@@ -14,14 +14,24 @@ from modules_torch import torch_initialisation
 from io_funcs.binary_io import BinaryIOCollection
 io_fun = BinaryIOCollection()
 
-from exp_mw545.exp_dv_cmp_pytorch import list_random_loader, dv_y_configuration, make_dv_y_exp_dir_name, make_dv_file_list, train_dv_y_model, class_test_dv_y_model
+from exp_mw545.exp_dv_cmp_pytorch import list_random_loader, dv_y_configuration, make_dv_y_exp_dir_name, make_dv_file_list, train_dv_y_model, class_test_dv_y_model, verification_test_dv_y_model, cut_conv_window_test_segment, gen_dv_y_model
 
 
-def make_feed_dict_y_cmp_train(dv_y_cfg, file_list_dict, file_dir_dict, batch_speaker_list, utter_tvt, return_dv=False, return_y=False, return_frame_index=False, return_file_name=False):
+def select_cmp_features(dv_y_cfg, features, start_frame_index=0, end_frame_index=None):
+    ''' feat_index columns of a loaded cmp file, frames start to end-1; delta and acc are added here if not in the file '''
+    if dv_y_cfg.delta_composer is None:
+        return features[start_frame_index:end_frame_index, dv_y_cfg.feat_index]
+    return dv_y_cfg.delta_composer.compose(features, start_frame_index, end_frame_index, dv_y_cfg.feat_index)
+
+def make_feed_dict_y_cmp_train(dv_y_cfg, file_list_dict, file_dir_dict, batch_speaker_list, utter_tvt, return_dv=False, return_y=False, return_frame_index=False, return_file_name=False, telemetry=None):
     feat_name = dv_y_cfg.y_feat_name # Hard-coded here for now
     # Make i/o shape arrays
     # This is numpy shape, not Tensor shape!
-    y  = numpy.zeros((dv_y_cfg.batch_num_spk, dv_y_cfg.spk_num_seq, dv_y_cfg.batch_seq_len, dv_y_cfg.feat_dim))
+    if dv_y_cfg.conv_window_exec:
+        # One segment per utterance; windows are cut by the first layer
+        y = numpy.zeros((dv_y_cfg.batch_num_spk, dv_y_cfg.spk_num_utter, dv_y_cfg.utter_seg_len, dv_y_cfg.feat_dim))
+    else:
+        y = numpy.zeros((dv_y_cfg.batch_num_spk, dv_y_cfg.spk_num_seq, dv_y_cfg.batch_seq_len, dv_y_cfg.feat_dim))
     dv = numpy.zeros((dv_y_cfg.batch_num_spk))
 
     # Do not use silence frames at the beginning or the end
@@ -40,24 +50,32 @@ def make_feed_dict_y_cmp_train(dv_y_cfg, file_list_dict, file_dir_dict, batch_sp
         # Draw multiple utterances per speaker: dv_y_cfg.spk_num_utter
         # Draw multiple windows per utterance:  dv_y_cfg.utter_num_seq
         # Stack them along B
-        speaker_file_name_list, speaker_utter_len_list, speaker_utter_list = get_utters_from_binary_dict(dv_y_cfg.spk_num_utter, file_list_dict[(speaker_id, utter_tvt)], file_dir_dict, feat_name_list=[feat_name], feat_dim_list=[dv_y_cfg.feat_dim], min_file_len=min_file_len, random_seed=None)
+        speaker_file_name_list, speaker_utter_len_list, speaker_utter_list = get_utters_from_binary_dict(dv_y_cfg.spk_num_utter, file_list_dict[(speaker_id, utter_tvt)], file_dir_dict, feat_name_list=[feat_name], feat_dim_list=[dv_y_cfg.nn_feature_dims], min_file_len=min_file_len, random_seed=None, telemetry=telemetry, feat_decoder_dict=dv_y_cfg.feat_decoder_dict)
         file_name_list.append(speaker_file_name_list)
 
         speaker_start_frame_index_list = []
         for utter_idx in range(dv_y_cfg.spk_num_utter):
-            y_stack = speaker_utter_list[feat_name][utter_idx][:,dv_y_cfg.feat_index]
             frame_number   = speaker_utter_len_list[utter_idx]
             extra_file_len = frame_number - (min_file_len)
             start_frame_index = numpy.random.choice(range(total_sil_one_side, total_sil_one_side+extra_file_len+1))
             speaker_start_frame_index_list.append(start_frame_index)
-            for seq_idx in range(dv_y_cfg.utter_num_seq):
-                y[speaker_idx, utter_idx*dv_y_cfg.utter_num_seq+seq_idx, :, :] = y_stack[start_frame_index:start_frame_index+dv_y_cfg.batch_seq_len, :]
-                start_frame_index = start_frame_index + dv_y_cfg.batch_seq_shift
+            # Only the frames of the sampled segment; all windows of the utterance are within it
+            y_stack = select_cmp_features(dv_y_cfg, speaker_utter_list[feat_name][utter_idx], start_frame_index, start_frame_index+dv_y_cfg.utter_seg_len)
+            if dv_y_cfg.conv_window_exec:
+                y[speaker_idx, utter_idx] = y_stack
+            else:
+                for seq_idx in range(dv_y_cfg.utter_num_seq):
+                    seq_start = seq_idx * dv_y_cfg.batch_seq_shift
+                    y[speaker_idx, utter_idx*dv_y_cfg.utter_num_seq+seq_idx, :, :] = y_stack[seq_start:seq_start+dv_y_cfg.batch_seq_len, :]
         start_frame_index_list.append(speaker_start_frame_index_list)
 
 
-    # S,B,T,D --> S,B,T*D
-    x_val = numpy.reshape(y, (dv_y_cfg.batch_num_spk, dv_y_cfg.spk_num_seq, dv_y_cfg.batch_seq_len*dv_y_cfg.feat_dim))
+    if dv_y_cfg.conv_window_exec:
+        # S,U,L,D segments
+        x_val = y
+    else:
+        # S,B,T,D --> S,B,T*D
+        x_val = numpy.reshape(y, (dv_y_cfg.batch_num_spk, dv_y_cfg.spk_num_seq, dv_y_cfg.batch_seq_len*dv_y_cfg.feat_dim))
     if dv_y_cfg.train_by_window:
         # S --> S*B
         y_val = numpy.repeat(dv, dv_y_cfg.spk_num_seq)
@@ -96,14 +114,26 @@ def make_feed_dict_y_cmp_test(dv_y_cfg, file_dir_dict, speaker_id, file_name, st
     except ValueError: true_speaker_index = 0 # At generation time, since dv is not used, a non-train speaker is given an arbituary speaker index
     dv[0] = true_speaker_index
 
+    if dv_y_cfg.conv_window_exec:
+        # Segment of frames, not windows; BTD_feat_remain holds the frames not used yet
+        if BTD_feat_remain is None:
+            _min_len, features = get_one_utter_by_name(file_name, file_dir_dict, feat_name_list=[feat_name], feat_dim_list=[dv_y_cfg.nn_feature_dims], feat_decoder_dict=dv_y_cfg.feat_decoder_dict)
+            y_features = select_cmp_features(dv_y_cfg, features[feat_name])
+            l_no_sil = y_features.shape[0] - total_sil_one_side * 2
+            BTD_feat_remain = y_features[total_sil_one_side:total_sil_one_side+l_no_sil]
+        x_val, gen_finish, batch_size, BTD_feat_remain = cut_conv_window_test_segment(dv_y_cfg, BTD_feat_remain)
+        y_val = numpy.repeat(dv, dv_y_cfg.spk_num_seq) if dv_y_cfg.train_by_window else dv
+        feed_dict = {'x':x_val, 'y':y_val}
+        return [feed_dict, gen_finish, batch_size, BTD_feat_remain]
+
     if BTD_feat_remain is None:
         # Get new file, make BTD
-        _min_len, features = get_one_utter_by_name(file_name, file_dir_dict, feat_name_list=[feat_name], feat_dim_list=[dv_y_cfg.feat_dim])
-        y_features = features[feat_name]
+        _min_len, features = get_one_utter_by_name(file_name, file_dir_dict, feat_name_list=[feat_name], feat_dim_list=[dv_y_cfg.nn_feature_dims], feat_decoder_dict=dv_y_cfg.feat_decoder_dict)
+        y_features = select_cmp_features(dv_y_cfg, features[feat_name])
         l = y_features.shape[0]
         l_no_sil = l - total_sil_one_side * 2
         features_no_sil = y_features[total_sil_one_side:total_sil_one_side+l_no_sil]
-        B_total  = int((l_no_sil - dv_y_cfg.batch_seq_len) / dv_y_cfg.batch_seq_shift) + 1
+        B_total  = max((l_no_sil - dv_y_cfg.batch_seq_len) // dv_y_cfg.batch_seq_shift + 1, 0) # 0 if too short for one window
         BTD_features = numpy.zeros((B_total, dv_y_cfg.batch_seq_len, dv_y_cfg.feat_dim))
         for b in range(B_total):
             start_i = dv_y_cfg.batch_seq_shift * b
@@ -191,3 +221,10 @@ def test_dv_y_cmp_model(cfg, dv_y_cfg=None):
         # numpy.random.seed(s)
     class_test_dv_y_model(cfg, dv_y_cfg)
 
+def verification_test_dv_y_cmp_model(cfg, dv_y_cfg=None):
+    if dv_y_cfg is None: dv_y_cfg = dv_y_cmp_configuration(cfg)
+    verification_test_dv_y_model(cfg, dv_y_cfg)
+
+def gen_dv_y_cmp_model(cfg, dv_y_cfg=None):
+    if dv_y_cfg is None: dv_y_cfg = dv_y_cmp_configuration(cfg)
+    gen_dv_y_model(cfg, dv_y_cfg)
@@ -2,13 +2,14 @@
 
 # This file uses dv_cmp experiments to slowly progress with pytorch
 
-import os, sys, pickle, time, shutil, logging, copy
+import os, sys, time, shutil, logging, copy
 import math, numpy, scipy
 numpy.random.seed(545)
-from modules import make_logger, read_file_list, prepare_file_path, prepare_file_path_list, make_held_out_file_number, copy_to_scratch
+from modules import make_logger, save_iv_values_to_file, read_file_list, prepare_file_path, prepare_file_path_list, make_held_out_file_number, copy_to_scratch
 from modules import keep_by_speaker, remove_by_speaker, keep_by_file_number, remove_by_file_number, keep_by_min_max_file_number, check_and_change_to_list
-from modules_2 import compute_feat_dim, log_class_attri, resil_nn_file_list, norm_nn_file_list, get_utters_from_binary_dict, get_one_utter_by_name, count_male_female_class_errors
-from modules_torch import torch_initialisation
+from modules_2 import compute_feat_dim, make_delta_composer, log_class_attri, resil_nn_file_list, norm_nn_file_list, get_utters_from_binary_dict, get_one_utter_by_name, count_male_female_class_errors, count_male_female_confusion, make_feat_decoder_dict, make_feat_dir_dict
+from modules_torch import torch_initialisation, Train_Telemetry, Train_Profiler, Metrics_Accumulator
+from modules_dv import Lambda_Store, make_lambda_store_key, make_speaker_index_from_dv_file, score_all_pair_trials, make_sampled_trial_list, score_trial_list, Score_Histogram
 
 from io_funcs.binary_io import BinaryIOCollection
 io_fun = BinaryIOCollection()
@@ -74,26 +75,69 @@ class dv_y_configuration(object):
         # From cfg: Features
         # self.dv_dim = cfg.dv_dim
         self.wav_sr = cfg.wav_sr
-        self.cmp_use_delta = False
+        self.cmp_use_delta = False # Static, delta and acc; computed in the loader when cmp files hold statics only (cfg.output_contain_delta False); from normalised statics, so delta and acc are not normalised to their own mean and std
+        self.mu_law_bits = None # 8 or 16: mu-law companding of y_feat_name (wav) in the loader, by table lookup
+        # 'MinMax' or 'MeanVar': y_feat_name is read un-normalised from cfg.nn_feat_resil_dirs (see pipeline_resil_feat_list)
+        # and normalised in the loader, with the statistics of cfg.nn_feat_resil_norm_files; None: read the normalised scratch copy
+        self.loader_norm_type = None
         self.frames_silence_to_keep = cfg.frames_silence_to_keep
         self.sil_pad = cfg.sil_pad
 
         self.speaker_id_list_dict = cfg.speaker_id_list_dict
         self.num_speaker_dict     = cfg.num_speaker_dict
 
-        self.log_except_list = ['data_split_file_number', 'speaker_id_list_dict', 'feat_index']
+        # Per-step time breakdown and throughput, written to telemetry.jsonl in exp_dir
+        self.telemetry_switch    = False
+        self.telemetry_log_steps = True # False: epoch summary lines only
+
+        # Profile a window of steps after warm-up; torch profiler trace and cProfile of data assembly, written to exp_dir
+        self.profiler_switch       = False
+        self.profiler_warmup_steps = 10
+        self.profiler_num_steps    = 5
+
+        # Speaker verification on unseen speakers; all utterance pairs are trials
+        self.verification_speaker_tvt_list = ['valid', 'test']
+        self.verification_P_target   = 0.01
+        self.verification_C_miss     = 1.
+        self.verification_C_fa       = 1.
+        self.verification_block_size = 2048
+        self.verification_num_threads = 4
+        self.verification_num_nontarget = None # None: all pairs; else all target pairs plus this many random non-target pairs
+        self.verification_num_bins = 20000 # Score histogram bins over [-1, 1]; EER and minDCF thresholds are bin edges, 1e-4 apart
+
+        # Generation of speaker d-vectors; files of gen_utter_tvt_name are used, for all speakers
+        self.gen_utter_tvt_name   = 'train'
+        self.gen_num_load_threads = 4
+        self.gen_num_load_ahead   = 8    # Files loaded ahead of the model, at most
+        self.gen_batch_num_windows = 4096 # Windows per generation batch; bounds batch memory (wav windows are large)
+        # Speaker index of the d-vectors in dv_file_name, for nearest-speaker search (see Speaker_Index)
+        self.dv_index_num_lists = 0 # IVF lists; 0: exact search only
+        self.dv_index_num_probe = 0 # Lists probed per query; 0: exact search
+
+        # Feed utterance segments instead of stacked windows; the first (ReLUDVMax) layer runs as a strided conv1d
+        # Same outputs as the windowed path, each frame is stored and multiplied once
+        self.conv_window_exec = False
+
+        self.exp_dir_suffix = '' # Appended to exp_dir; used by sweeps when a parameter is not part of the name
+
+        self.log_except_list = ['data_split_file_number', 'speaker_id_list_dict', 'feat_index', 'feat_decoder_dict', 'delta_composer', 'feat_dir_dict']
 
 
     def auto_complete(self, cfg):
         ''' Remember to call this after __init__ !!! '''
         self.utter_num_seq   = int((self.batch_seq_total_len - self.batch_seq_len) / self.batch_seq_shift) + 1  # Outputs of each sequence is then averaged
+        self.utter_seg_len = (self.utter_num_seq - 1) * self.batch_seq_shift + self.batch_seq_len # Frames used per utterance; segment length in conv_window_exec
         self.spk_num_seq     = self.spk_num_utter * self.utter_num_seq # B
 
         # Features
         self.nn_feature_dims = cfg.nn_feature_dims[self.y_feat_name]
         self.feat_dim, self.feat_index = compute_feat_dim(self, cfg, self.out_feat_list) # D
+        self.delta_composer = make_delta_composer(self, cfg, self.out_feat_list)
 
         self.num_nn_layers = len(self.nn_layer_config_list)
+        # Loads y_feat_name files as float32, decoding the codec of their directory (see nn_feat_codec_dict); optional mu-law
+        self.feat_decoder_dict = make_feat_decoder_dict([self.y_feat_name], mu_law_bits=self.mu_law_bits, cfg=cfg, norm_type=self.loader_norm_type)
+        self.feat_dir_dict = make_feat_dir_dict(self, cfg)
 
         # Directories
         self.work_dir = cfg.work_dir
@@ -103,6 +147,9 @@ class dv_y_configuration(object):
         self.nnets_file_name = os.path.join(self.exp_dir, nnets_file_name)
         dv_file_name = "DV.dat"
         self.dv_file_name = os.path.join(self.exp_dir, dv_file_name)
+        self.dv_index_file_name = os.path.join(self.exp_dir, 'DV.idx')
+        self.telemetry_file_name = os.path.join(self.exp_dir, 'telemetry.jsonl')
+        self.lambda_store_dir = os.path.join(self.exp_dir, 'lambda_store')
         prepare_file_path(file_dir=self.exp_dir, script_name=cfg.python_script_name)
         prepare_file_path(file_dir=self.exp_dir, script_name=self.python_script_name)
 
@@ -128,8 +175,6 @@ class dv_y_configuration(object):
         self.spk_num_utter = 1
         spk_num_utter_list = [1,2,5,10]
         self.spk_num_utter_list = check_and_change_to_list(spk_num_utter_list)
-        lambda_u_dict_file_name = 'lambda_u_class_test.dat'
-        self.lambda_u_dict_file_name = os.path.join(self.exp_dir, lambda_u_dict_file_name)
 
         if self.y_feat_name == 'cmp':
             self.batch_seq_shift = 1
@@ -137,6 +182,7 @@ class dv_y_configuration(object):
             self.batch_seq_shift = 100
 
         self.utter_num_seq = int((self.batch_seq_total_len - self.batch_seq_len) / self.batch_seq_shift) + 1  # Outputs of each sequence is then averaged
+        self.utter_seg_len = (self.utter_num_seq - 1) * self.batch_seq_shift + self.batch_seq_len # Frames used per utterance; segment length in conv_window_exec
         # self.spk_num_seq = self.spk_num_utter * self.utter_num_seq
         if 'debug' in self.work_dir: self.change_to_debug_mode(process="class_test")
 
@@ -145,6 +191,7 @@ class dv_y_configuration(object):
         self.spk_num_utter = 5
         self.batch_seq_shift = 1
         self.utter_num_seq = int((self.batch_seq_total_len - self.batch_seq_len) / self.batch_seq_shift) + 1  # Outputs of each sequence is then averaged
+        self.utter_seg_len = (self.utter_num_seq - 1) * self.batch_seq_shift + self.batch_seq_len # Frames used per utterance; segment length in conv_window_exec
         self.spk_num_seq = self.spk_num_utter * self.utter_num_seq
         if 'debug' in self.work_dir: self.change_to_debug_mode()
 
@@ -164,6 +211,9 @@ def make_dv_y_exp_dir_name(model_cfg, cfg):
             layer_str = layer_str + 'DR'
         exp_dir = exp_dir + layer_str + "_"
     exp_dir = exp_dir + "DV%iS%iB%iT%iD%i" %(model_cfg.dv_dim, model_cfg.batch_num_spk, model_cfg.spk_num_seq, model_cfg.batch_seq_len, model_cfg.feat_dim)
+    if model_cfg.loader_norm_type is not None:
+        exp_dir = exp_dir + "_" + model_cfg.loader_norm_type
+    exp_dir = exp_dir + model_cfg.exp_dir_suffix
     # exp_dir + "DV"+str(model_cfg.dv_dim)+"_S"+str(model_cfg.batch_num_spk)+"_B"+str(model_cfg.spk_num_seq)+"_T"+str(model_cfg.batch_seq_len)
     # if cfg.exp_type_switch == 'wav_sine_attention':
     #     exp_dir = exp_dir + "_SineSize_"+str(model_cfg.nn_layer_config_list[0]['Sine_filter_size'])
@@ -204,6 +254,19 @@ def train_dv_y_model(cfg, dv_y_cfg):
     dv_y_model.print_model_parameters(logger)
     # model.print_model_parameters(logger)
 
+    if dv_y_cfg.telemetry_switch:
+        logger.info('Writing telemetry to %s' % dv_y_cfg.telemetry_file_name)
+        telemetry = Train_Telemetry(dv_y_cfg.telemetry_file_name, dv_y_model.device_id, dv_y_cfg.telemetry_log_steps)
+        dv_y_model.telemetry = telemetry
+    else:
+        telemetry = None
+    num_windows = dv_y_cfg.batch_num_spk * dv_y_cfg.spk_num_seq
+    if dv_y_cfg.profiler_switch:
+        profiler = Train_Profiler(dv_y_cfg.exp_dir, 'train', dv_y_model.device_id, dv_y_cfg.profiler_warmup_steps, dv_y_cfg.profiler_num_steps)
+    else:
+        profiler = None
+    metrics = Metrics_Accumulator(len(speaker_id_list), dv_y_model.device_id)
+
     epoch      = 0
     early_stop = 0
     num_decay  = 0    
@@ -218,40 +281,49 @@ def train_dv_y_model(cfg, dv_y_cfg):
 
         logger.info('start training Epoch '+str(epoch))
         epoch_start_time = time.time()
+        if telemetry is not None: telemetry.start_epoch(epoch)
 
         for batch_idx in range(dv_y_cfg.epoch_num_batch['train']):
+            if telemetry is not None: telemetry.start_step()
+            if profiler is not None: profiler.start_step()
             # Draw random speakers
             batch_speaker_list = speaker_loader.draw_n_samples(dv_y_cfg.batch_num_spk)
             # Make feed_dict for training
-            feed_dict, batch_size = make_feed_dict_method_train(dv_y_cfg, file_list_dict, cfg.nn_feat_scratch_dirs, batch_speaker_list,  utter_tvt='train')
+            if profiler is not None: profiler.data_start()
+            feed_dict, batch_size = make_feed_dict_method_train(dv_y_cfg, file_list_dict, dv_y_cfg.feat_dir_dict, batch_speaker_list,  utter_tvt='train', telemetry=telemetry)
+            if profiler is not None: profiler.data_stop()
+            if telemetry is not None: telemetry.toc('assembly')
             dv_y_model.nn_model.train()
             dv_y_model.update_parameters(feed_dict=feed_dict)
+            if telemetry is not None: telemetry.end_step(num_windows, num_windows * dv_y_cfg.batch_seq_len)
+            if profiler is not None: profiler.end_step()
         epoch_train_time = time.time()
 
         logger.info('start evaluating Epoch '+str(epoch))
         output_string = {'loss':'epoch %i' % epoch, 'accuracy':'epoch %i' % epoch, 'time':'epoch %i' % epoch}
+        loss_dict = {}
+        accuracy_dict = {}
         for utter_tvt_name in ['train', 'valid', 'test']:
-            total_batch_size = 0.
-            total_loss       = 0.
-            total_accuracy   = 0.
+            # Loss, correct count and confusion stay on device; one synchronisation per split
+            metrics.reset()
+            dv_y_model.eval()
             for batch_idx in range(dv_y_cfg.epoch_num_batch['valid']):
                 # Draw random speakers
                 batch_speaker_list = speaker_loader.draw_n_samples(dv_y_cfg.batch_num_spk)
                 # Make feed_dict for evaluation
-                feed_dict, batch_size = make_feed_dict_method_train(dv_y_cfg, file_list_dict, cfg.nn_feat_scratch_dirs, batch_speaker_list, utter_tvt=utter_tvt_name)
-                dv_y_model.eval()
-                batch_mean_loss = dv_y_model.gen_loss_value(feed_dict=feed_dict)
-                total_batch_size += batch_size
-                total_loss       += batch_mean_loss
-                if dv_y_cfg.classify_in_training:
-                    _c, _t, accuracy = dv_y_model.cal_accuracy(feed_dict=feed_dict)
-                    total_accuracy   += accuracy
-            average_loss = total_loss/float(dv_y_cfg.epoch_num_batch['valid'])
+                feed_dict, batch_size = make_feed_dict_method_train(dv_y_cfg, file_list_dict, dv_y_cfg.feat_dir_dict, batch_speaker_list, utter_tvt=utter_tvt_name)
+                dv_y_model.accumulate_metrics(feed_dict, metrics)
+            metric_dict = metrics.result()
+            average_loss = metric_dict['loss']
             output_string['loss'] = output_string['loss'] + '; '+utter_tvt_name+' loss '+str(average_loss)
+            loss_dict[utter_tvt_name] = average_loss
 
             if dv_y_cfg.classify_in_training:
-                average_accu = total_accuracy/float(dv_y_cfg.epoch_num_batch['valid'])
+                average_accu = metric_dict['accuracy']
+                accuracy_dict[utter_tvt_name] = average_accu
                 output_string['accuracy'] = output_string['accuracy'] + '; %s accuracy %.4f' % (utter_tvt_name, average_accu)
+                wrong_list = count_male_female_confusion(metric_dict['confusion_matrix'], speaker_id_list, dv_y_cfg.speaker_id_list_dict['male'])
+                output_string['accuracy'] = output_string['accuracy'] + ' (errors mm %i, ff %i, mf %i, fm %i)' % (wrong_list['mm'], wrong_list['ff'], wrong_list['mf'], wrong_list['fm'])
 
             if utter_tvt_name == 'valid':
                 nnets_file_name = dv_y_cfg.nnets_file_name
@@ -270,6 +342,8 @@ def train_dv_y_model(cfg, dv_y_cfg):
                     num_decay = num_decay + 1
                     if num_decay > max_num_decay:
                         logger.info('stopping early, best model, %s, best valid error %.4f' % (nnets_file_name, best_valid_loss))
+                        if telemetry is not None: telemetry.end_epoch(epoch_train_time - epoch_start_time, time.time() - epoch_train_time, loss_dict, accuracy_dict)
+                        if profiler is not None: profiler.stop()
                         return best_valid_loss
                     else:
                         new_learning_rate = dv_y_model.learning_rate*0.5
@@ -287,9 +361,15 @@ def train_dv_y_model(cfg, dv_y_cfg):
         if dv_y_cfg.classify_in_training:
             logger.info(output_string['accuracy'])
         logger.info(output_string['time'])
+        if telemetry is not None:
+            epoch_dict = telemetry.end_epoch(epoch_train_time - epoch_start_time, epoch_valid_time - epoch_train_time, loss_dict, accuracy_dict)
+            logger.info('epoch %i; %.1f windows/s, %.1f samples/s; read %.2f, assembly %.2f, to_tensor %.2f, forward %.2f, backward %.2f, optimiser %.2f; peak GPU memory %.1f MB' \
+                %(epoch, epoch_dict['windows_per_s'], epoch_dict['samples_per_s'], epoch_dict['time']['read'], epoch_dict['time']['assembly'], epoch_dict['time']['to_tensor'], \
+                epoch_dict['time']['forward'], epoch_dict['time']['backward'], epoch_dict['time']['optimiser'], epoch_dict['peak_gpu_mem_mb']))
 
         dv_y_cfg.additional_action_epoch(logger, dv_y_model)
 
+    if profiler is not None: profiler.stop()
     return best_valid_loss
 
 def class_test_dv_y_model(cfg, dv_y_cfg):
@@ -303,95 +383,313 @@ def class_test_dv_y_model(cfg, dv_y_cfg):
     speaker_id_list = dv_y_cfg.speaker_id_list_dict['train'] # For classification, use train speakers only
     file_id_list    = read_file_list(cfg.file_id_list_file)
     file_list_dict  = make_dv_file_list(file_id_list, speaker_id_list, dv_y_cfg.data_split_file_number) # In the form of: file_list[(speaker_id, 'train')]
-    make_feed_dict_method_test = dv_y_cfg.make_feed_dict_method_test
-
     dv_y_model = torch_initialisation(dv_y_cfg)
     dv_y_model.load_nn_model(dv_y_cfg.nnets_file_name)
 
-    try: 
-        lambda_u_dict = pickle.load(open(dv_y_cfg.lambda_u_dict_file_name, 'rb'))
-        logger.info('Loaded lambda_u_dict from %s' % dv_y_cfg.lambda_u_dict_file_name)
-    # Generate for all utterances, all speakers
-    except:
-        logger.info('Cannot load from %s, generate instead' % dv_y_cfg.lambda_u_dict_file_name)
-        lambda_u_dict = {}   # lambda_u[file_name] = [lambda_speaker, total_batch_size]
-        for speaker_id in speaker_id_list:
-            logger.info('Generating %s' % speaker_id)
-            for file_name in file_list_dict[(speaker_id, 'test')]:
-                lambda_temp_list = []
-                batch_size_list  = []
-                gen_finish = False
-                start_frame_index = 0
-                BTD_feat_remain = None
-                while not (gen_finish):
-                    feed_dict, gen_finish, batch_size, BTD_feat_remain = make_feed_dict_method_test(dv_y_cfg, cfg.nn_feat_scratch_dirs, speaker_id, file_name, start_frame_index, BTD_feat_remain)
-                    dv_y_model.eval()
-                    lambda_temp = dv_y_model.gen_lambda_SBD_value(feed_dict=feed_dict)
-                    lambda_temp_list.append(lambda_temp)
-                    batch_size_list.append(batch_size)
-                B_u = numpy.sum(batch_size_list)
-                lambda_u = numpy.zeros(dv_y_cfg.dv_dim)
-                for lambda_temp, batch_size in zip(lambda_temp_list, batch_size_list):
-                    for b in range(batch_size):
-                        lambda_u += lambda_temp[0,b]
-                lambda_u /= float(B_u)
-                lambda_u_dict[file_name] = [lambda_u, B_u]
-        logger.info('Saving lambda_u_dict to %s' % dv_y_cfg.lambda_u_dict_file_name)
-        pickle.dump(lambda_u_dict, open(dv_y_cfg.lambda_u_dict_file_name, 'wb'))
+    # lambda_u_dict[file_name] = [lambda_u, B_u]; keyed by model and window settings, only new utterances are generated
+    lambda_u_dict = gen_lambda_store(cfg, dv_y_cfg, dv_y_model, [(speaker_id, file_list_dict[(speaker_id, 'test')]) for speaker_id in speaker_id_list], 'class_test')
 
+    # All test utterances of all speakers, as arrays; row offsets per speaker
+    num_trials  = dv_y_cfg.epoch_num_batch['test']
+    all_file_list = []
+    speaker_row_start = []
+    for speaker_id in speaker_id_list:
+        speaker_row_start.append(len(all_file_list))
+        all_file_list.extend(file_list_dict[(speaker_id, 'test')])
+    lambda_all, B_all = lambda_u_dict.get_lambda_B(all_file_list)
+    lambda_all = numpy.array(lambda_all, dtype=numpy.float64)
+    B_all      = numpy.array(B_all, dtype=numpy.float64)
+    true_speaker_index = numpy.array([dv_y_cfg.speaker_id_list_dict['train'].index(speaker_id) for speaker_id in speaker_id_list])
+
+    # Weighted average of lambda_u for every trial, every speaker, every spk_num_utter
+    batch_lambda_list = []
     for spk_num_utter in dv_y_cfg.spk_num_utter_list:
+        idx_list = []
+        for speaker_id, row_start in zip(speaker_id_list, speaker_row_start):
+            idx_list.append(draw_trial_index(len(file_list_dict[(speaker_id, 'test')]), num_trials, spk_num_utter) + row_start)
+        idx_S_T_K = numpy.stack(idx_list)         # S * T * K
+        w_S_T_K   = B_all[idx_S_T_K]
+        batch_lambda = numpy.einsum('stk,stkd->std', w_S_T_K, lambda_all[idx_S_T_K]) / numpy.sum(w_S_T_K, axis=2, keepdims=True)
+        batch_lambda_list.append(batch_lambda.reshape(-1, dv_y_cfg.dv_dim))
+
+    # Classify all trials in a few large batches
+    lambda_N_D = numpy.concatenate(batch_lambda_list, axis=0)
+    num_trials_per_batch = 10000
+    idx_list_N = []
+    for n_start in range(0, lambda_N_D.shape[0], num_trials_per_batch):
+        feed_dict = {'x': lambda_N_D[numpy.newaxis, n_start:n_start+num_trials_per_batch]}
+        idx_list_N.append(dv_y_model.lambda_to_indices(feed_dict=feed_dict)[0])
+    idx_list_U_S_T = numpy.concatenate(idx_list_N).reshape(len(dv_y_cfg.spk_num_utter_list), len(speaker_id_list), num_trials)
+    accuracy_U_S = numpy.mean(idx_list_U_S_T == true_speaker_index[numpy.newaxis, :, numpy.newaxis], axis=2)
+
+    for u, spk_num_utter in enumerate(dv_y_cfg.spk_num_utter_list):
         logger.info('Testing with %i utterances per speaker' % spk_num_utter)
-        accuracy_list = []
-        for speaker_id in speaker_id_list:
-            logger.info('testing speaker %s' % speaker_id)
-            speaker_lambda_list = []
-            speaker_file_loader = list_random_loader(file_list_dict[(speaker_id, 'test')])
-            for batch_idx in range(dv_y_cfg.epoch_num_batch['test']):
-                logger.info('batch %i' % batch_idx)
-                batch_file_list = speaker_file_loader.draw_n_samples(spk_num_utter)
-
-                # Weighted average of lambda_u
-                batch_lambda = numpy.zeros(dv_y_cfg.dv_dim)
-                B_total = 0
-                for file_name in batch_file_list:
-                    lambda_u, B_u = lambda_u_dict[file_name]
-                    batch_lambda += lambda_u * B_u
-                    B_total += B_u
-                batch_lambda /= B_total
-                speaker_lambda_list.append(batch_lambda)
-
-            true_speaker_index = dv_y_cfg.speaker_id_list_dict['train'].index(speaker_id)
-            lambda_list_remain = speaker_lambda_list
-            B_remain = len(speaker_lambda_list)
-            b_index = 0 # Track counter, instead of removing elements
-            correct_counter = 0.
-            while B_remain > 0:
-                lambda_val = numpy.zeros((dv_y_cfg.batch_num_spk, dv_y_cfg.spk_num_seq, dv_y_cfg.dv_dim))
-                if B_remain > dv_y_cfg.spk_num_seq:
-                    # Fill all dv_y_cfg.spk_num_seq, keep remain for later
-                    B_actual = dv_y_cfg.spk_num_seq
-                    B_remain -= dv_y_cfg.spk_num_seq
-                    b_index += dv_y_cfg.spk_num_seq
-                else:
-                    # No more remain
-                    B_actual = B_remain
-                    B_remain = 0
-
-                for b in range(B_actual):
-                    lambda_val[0, b] = lambda_list_remain[b_index + b]
-
-                feed_dict = {'x': lambda_val}
-                idx_list_S_B = dv_y_model.lambda_to_indices(feed_dict=feed_dict)
-                # print(idx_list_S_B)
-                for b in range(B_actual):
-                    if idx_list_S_B[0, b] == true_speaker_index: 
-                        correct_counter += 1.
-            speaker_accuracy = correct_counter/float(dv_y_cfg.epoch_num_batch['test'])
+        for speaker_id, speaker_accuracy in zip(speaker_id_list, accuracy_U_S[u]):
             logger.info('speaker %s accuracy is %f' % (speaker_id, speaker_accuracy))
-            accuracy_list.append(speaker_accuracy)
-        mean_accuracy = numpy.mean(accuracy_list)
+        mean_accuracy = numpy.mean(accuracy_U_S[u])
         logger.info('Accuracy with %i utterances per speaker is %f' % (spk_num_utter, mean_accuracy))
 
+def verification_test_dv_y_model(cfg, dv_y_cfg):
+    ''' EER, minDCF and DET points on valid and test speakers, from utterance lambdas '''
+
+    logger = make_logger("dv_y_config")
+    dv_y_cfg.change_to_class_test_mode()
+    log_class_attri(dv_y_cfg, logger, except_list=dv_y_cfg.log_except_list)
+
+    logger = make_logger("verif_dvy")
+    file_id_list = read_file_list(cfg.file_id_list_file)
+    dv_y_model = torch_initialisation(dv_y_cfg)
+    dv_y_model.load_nn_model(dv_y_cfg.nnets_file_name)
+
+    for speaker_tvt_name in dv_y_cfg.verification_speaker_tvt_list:
+        # Unseen speakers; all their utterances are used
+        speaker_id_list = dv_y_cfg.speaker_id_list_dict[speaker_tvt_name]
+        file_list_dict  = make_dv_file_list(file_id_list, speaker_id_list, dv_y_cfg.data_split_file_number)
+        lambda_u_dict = gen_lambda_store(cfg, dv_y_cfg, dv_y_model, [(speaker_id, file_list_dict[(speaker_id, 'all')]) for speaker_id in speaker_id_list], 'verification')
+
+        all_file_list = []
+        speaker_idx_list = []
+        for speaker_idx, speaker_id in enumerate(speaker_id_list):
+            all_file_list.extend(file_list_dict[(speaker_id, 'all')])
+            speaker_idx_list.extend([speaker_idx] * len(file_list_dict[(speaker_id, 'all')]))
+        lambda_N_D, _B_N = lambda_u_dict.get_lambda_B(all_file_list)
+
+        # Scores are reduced to histograms as they are computed, so memory does not grow with N^2
+        if dv_y_cfg.verification_num_nontarget is None:
+            score_histogram = score_all_pair_trials(numpy.array(lambda_N_D), speaker_idx_list, dv_y_cfg.verification_block_size, dv_y_cfg.verification_num_threads, dv_y_cfg.verification_num_bins)
+        else:
+            trial_index_M_2, is_target_M = make_sampled_trial_list(speaker_idx_list, dv_y_cfg.verification_num_nontarget)
+            scores_M = score_trial_list(numpy.array(lambda_N_D), trial_index_M_2, num_threads=dv_y_cfg.verification_num_threads)
+            score_histogram = Score_Histogram(dv_y_cfg.verification_num_bins)
+            score_histogram.add(scores_M[is_target_M], scores_M[~is_target_M])
+        metric_dict = score_histogram.compute_verification_metrics(dv_y_cfg.verification_P_target, dv_y_cfg.verification_C_miss, dv_y_cfg.verification_C_fa)
+        logger.info('%s speakers: %i target, %i non-target trials; EER %.4f; minDCF %.4f (P_target %.3f)' % (speaker_tvt_name, metric_dict['num_target'], metric_dict['num_nontarget'], metric_dict['eer'], metric_dict['min_dcf'], dv_y_cfg.verification_P_target))
+
+        det_file_name = os.path.join(dv_y_cfg.exp_dir, 'det_%s.txt' % speaker_tvt_name)
+        logger.info('Saving DET points to %s' % det_file_name)
+        numpy.savetxt(det_file_name, numpy.stack([metric_dict['det_threshold'], metric_dict['det_P_miss'], metric_dict['det_P_fa']], axis=1), header='threshold P_miss P_fa')
+
+def gen_dv_y_model(cfg, dv_y_cfg):
+    ''' Speaker d-vectors of train, valid and test speakers, saved to dv_file_name as dict[speaker_id] = dv '''
+    ''' Test feeds of files are loaded in parallel, at most gen_num_load_ahead files ahead of the model '''
+    ''' Batches hold gen_batch_num_windows windows; utterance lambdas go to the lambda store, so a stopped run resumes '''
+
+    logger = make_logger("dv_y_config")
+    dv_y_cfg.change_to_gen_mode()
+    log_class_attri(dv_y_cfg, logger, except_list=dv_y_cfg.log_except_list)
+
+    logger = make_logger("gen_dvy")
+    speaker_id_list = dv_y_cfg.speaker_id_list_dict['train'] + dv_y_cfg.speaker_id_list_dict['valid'] + dv_y_cfg.speaker_id_list_dict['test']
+    file_id_list   = read_file_list(cfg.file_id_list_file)
+    file_list_dict = make_dv_file_list(file_id_list, speaker_id_list, dv_y_cfg.data_split_file_number)
+
+    feed_cfg, model_cfg = make_gen_feed_model_cfg(dv_y_cfg, dv_y_cfg.gen_batch_num_windows)
+    dv_y_model = torch_initialisation(model_cfg)
+    dv_y_model.load_nn_model(dv_y_cfg.nnets_file_name)
+    dv_y_model.eval()
+
+    lambda_store_key = make_lambda_store_key(dv_y_cfg.nnets_file_name, dv_y_cfg, [dv_y_cfg.feat_dir_dict])
+    lambda_u_dict = Lambda_Store(dv_y_cfg.lambda_store_dir, lambda_store_key, dv_y_cfg.dv_dim)
+    speaker_file_list = [(speaker_id, file_name) for speaker_id in speaker_id_list for file_name in lambda_u_dict.find_missing(file_list_dict[(speaker_id, dv_y_cfg.gen_utter_tvt_name)])]
+    logger.info('%i files to generate, %i in %s' % (len(speaker_file_list), len(lambda_u_dict), lambda_u_dict.data_file_name))
+
+    gen_lambda_store_batched(feed_cfg, dv_y_model, speaker_file_list, lambda_u_dict, logger)
+
+    # Speaker d-vector: lambda_u weighted by number of windows B_u
+    dv_values = {}
+    for speaker_id in speaker_id_list:
+        lambda_N_D, B_N = lambda_u_dict.get_lambda_B(file_list_dict[(speaker_id, dv_y_cfg.gen_utter_tvt_name)])
+        if numpy.sum(B_N) == 0:
+            logger.info('No windows for speaker %s; no d-vector' % speaker_id)
+            continue
+        dv_values[speaker_id] = numpy.dot(B_N, lambda_N_D) / numpy.sum(B_N)
+    logger.info('Saving %i speaker d-vectors to %s' % (len(dv_values), dv_y_cfg.dv_file_name))
+    save_iv_values_to_file(dv_values, dv_y_cfg.dv_file_name, 'pickle')
+    speaker_index = make_speaker_index_from_dv_file(dv_y_cfg.dv_file_name, dv_y_cfg.dv_index_num_lists)
+    logger.info('Saving speaker index to %s' % dv_y_cfg.dv_index_file_name)
+    speaker_index.save(dv_y_cfg.dv_index_file_name)
+
+def gen_lambda_store_batched(feed_cfg, dv_y_model, speaker_file_list, lambda_u_dict, logger):
+    ''' Append lambda_u of each (speaker_id, file_name) to lambda_u_dict; dv_y_model and feed_cfg from make_gen_feed_model_cfg '''
+    ''' Windows of several files share a batch of spk_num_seq; a conv_window_exec model takes one segment per forward '''
+    capacity = feed_cfg.spk_num_seq
+    batch_dict = {} # Per-window inputs of one batch (x, and nlf/tau with pitch feeds), capacity rows each
+    owner_list = [] # File index of each window in batch_dict
+    file_name_list  = []
+    lambda_sum_list = []
+    num_remain_list = []
+    B_list = []
+
+    def add_lambda(file_idx, lambda_N_D):
+        lambda_sum_list[file_idx] += numpy.sum(lambda_N_D, axis=0)
+        num_remain_list[file_idx] -= lambda_N_D.shape[0]
+        if num_remain_list[file_idx] == 0:
+            B_u = B_list[file_idx]
+            lambda_u_dict.append(file_name_list[file_idx], lambda_sum_list[file_idx] / B_u, B_u)
+            lambda_sum_list[file_idx] = None
+
+    def run_batch(num_windows):
+        # S(1)*B*...
+        lambda_SBD = dv_y_model.gen_lambda_SBD_value(feed_dict={k: batch_dict[k][None] for k in batch_dict})
+        owner_N = numpy.array(owner_list)
+        lambda_N_D = lambda_SBD.reshape(capacity, -1)[:num_windows]
+        for file_idx in numpy.unique(owner_N):
+            add_lambda(file_idx, lambda_N_D[owner_N == file_idx])
+        del owner_list[:]
+
+    num_windows = 0
+    for file_name, feed_list in load_gen_feeds(feed_cfg, feed_cfg.feat_dir_dict, speaker_file_list, feed_cfg.gen_num_load_threads, feed_cfg.gen_num_load_ahead):
+        B_u = sum([batch_size for feed_dict, batch_size in feed_list])
+        if B_u == 0:
+            # Stored with B_u = 0, so it has no weight in the speaker d-vector and is not tried again
+            logger.info('%s is too short for one window; stored with B 0' % file_name)
+            lambda_u_dict.append(file_name, numpy.zeros(feed_cfg.dv_dim), 0)
+            continue
+        file_idx = len(file_name_list)
+        file_name_list.append(file_name)
+        lambda_sum_list.append(numpy.zeros(feed_cfg.dv_dim))
+        B_list.append(B_u)
+        num_remain_list.append(B_u)
+        for feed_dict, batch_size in feed_list:
+            if feed_cfg.conv_window_exec:
+                # Whole segment in one forward; the first layer cuts the windows
+                lambda_SBD = dv_y_model.gen_lambda_SBD_value(feed_dict=feed_dict)
+                add_lambda(file_idx, lambda_SBD.reshape(batch_size, -1))
+                continue
+            # Windows of several files share a batch; every input but y is S(1)*B*..., cut per window
+            if len(batch_dict) == 0:
+                batch_dict.update({k: numpy.zeros((capacity,)+feed_dict[k].shape[2:]) for k in feed_dict if k != 'y'})
+            n = 0
+            while n < batch_size:
+                n_fill = min(capacity - num_windows, batch_size - n)
+                for k in batch_dict:
+                    batch_dict[k][num_windows:num_windows+n_fill] = feed_dict[k][0, n:n+n_fill]
+                owner_list.extend([file_idx] * n_fill)
+                num_windows += n_fill
+                n += n_fill
+                if num_windows == capacity:
+                    run_batch(num_windows)
+                    num_windows = 0
+    if num_windows > 0:
+        for k in batch_dict:
+            batch_dict[k][num_windows:] = 0.
+        run_batch(num_windows)
+
+def make_gen_feed_model_cfg(dv_y_cfg, capacity):
+    ''' Generation configurations: feeds hold up to capacity windows; conv_window_exec segments if the model has a conv first layer '''
+    ''' The windowed model takes 1*capacity windows per batch; the conv model one segment per forward '''
+    feed_cfg = copy.copy(dv_y_cfg)
+    feed_cfg.batch_num_spk = 1
+    feed_cfg.spk_num_seq   = capacity
+    model_cfg = copy.copy(dv_y_cfg)
+    model_cfg.batch_num_spk = 1
+    model_cfg.spk_num_seq   = capacity
+    return feed_cfg, model_cfg
+
+def load_gen_feeds(feed_cfg, feat_dir_dict, speaker_file_list, num_threads, num_load_ahead):
+    ''' Yield (file_name, [(feed_dict, batch_size), ...]) in file order; whole test feeds, so pitch inputs are kept '''
+    ''' At most num_load_ahead files are loaded or waiting, so memory does not grow with the file list '''
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor
+
+    def load_feeds(speaker_file):
+        speaker_id, file_name = speaker_file
+        feed_list = []
+        gen_finish = False
+        BTD_feat_remain = None
+        while not (gen_finish):
+            feed_dict, gen_finish, batch_size, BTD_feat_remain = feed_cfg.make_feed_dict_method_test(feed_cfg, feat_dir_dict, speaker_id, file_name, 0, BTD_feat_remain)
+            if batch_size > 0:
+                feed_list.append((feed_dict, batch_size))
+        return file_name, feed_list
+
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        future_queue = deque()
+        speaker_file_iter = iter(speaker_file_list)
+        while True:
+            while len(future_queue) < num_load_ahead:
+                speaker_file = next(speaker_file_iter, None)
+                if speaker_file is None:
+                    break
+                future_queue.append(executor.submit(load_feeds, speaker_file))
+            if len(future_queue) == 0:
+                break
+            yield future_queue.popleft().result()
+
+def segment_to_windows(seg_L_D, window_len, window_shift):
+    ''' All windows of a segment, (num_windows, T*D), same order as the windowed feed; a strided view, not a copy '''
+    L, D = seg_L_D.shape
+    num_windows = (L - window_len) // window_shift + 1
+    seg_L_D = numpy.ascontiguousarray(seg_L_D)
+    return numpy.lib.stride_tricks.as_strided(seg_L_D, shape=(num_windows, window_len * D), strides=(seg_L_D.strides[0] * window_shift, seg_L_D.strides[1]), writeable=False)
+
+def gen_lambda_store(cfg, dv_y_cfg, dv_y_model, speaker_file_list, profile_name):
+    ''' Open the lambda store of this model; generate lambda_u of files not in it yet '''
+    ''' speaker_file_list: [(speaker_id, file_list), ...] '''
+    logger = make_logger("gen_lambda")
+    make_feed_dict_method_test = dv_y_cfg.make_feed_dict_method_test
+    lambda_store_key = make_lambda_store_key(dv_y_cfg.nnets_file_name, dv_y_cfg, [dv_y_cfg.feat_dir_dict])
+    lambda_u_dict = Lambda_Store(dv_y_cfg.lambda_store_dir, lambda_store_key, dv_y_cfg.dv_dim)
+    if dv_y_cfg.profiler_switch:
+        profiler = Train_Profiler(dv_y_cfg.exp_dir, profile_name, dv_y_model.device_id, dv_y_cfg.profiler_warmup_steps, dv_y_cfg.profiler_num_steps)
+    else:
+        profiler = None
+    dv_y_model.eval()
+    for speaker_id, file_list in speaker_file_list:
+        missing_file_list = lambda_u_dict.find_missing(file_list)
+        if len(missing_file_list) == 0:
+            continue
+        logger.info('Generating %s, %i utterances' % (speaker_id, len(missing_file_list)))
+        for file_name in missing_file_list:
+            lambda_temp_list = []
+            batch_size_list  = []
+            gen_finish = False
+            start_frame_index = 0
+            BTD_feat_remain = None
+            while not (gen_finish):
+                if profiler is not None: profiler.start_step()
+                if profiler is not None: profiler.data_start()
+                feed_dict, gen_finish, batch_size, BTD_feat_remain = make_feed_dict_method_test(dv_y_cfg, dv_y_cfg.feat_dir_dict, speaker_id, file_name, start_frame_index, BTD_feat_remain)
+                if profiler is not None: profiler.data_stop()
+                lambda_temp = dv_y_model.gen_lambda_SBD_value(feed_dict=feed_dict)
+                if profiler is not None: profiler.end_step()
+                lambda_temp_list.append(lambda_temp)
+                batch_size_list.append(batch_size)
+            B_u = numpy.sum(batch_size_list)
+            if B_u == 0:
+                logger.info('%s is too short for one window; stored with B 0' % file_name)
+                lambda_u_dict.append(file_name, numpy.zeros(dv_y_cfg.dv_dim), 0)
+                continue
+            lambda_u = numpy.sum([numpy.sum(lambda_temp[0,:batch_size], axis=0) for lambda_temp, batch_size in zip(lambda_temp_list, batch_size_list)], axis=0)
+            lambda_u /= float(B_u)
+            lambda_u_dict.append(file_name, lambda_u, B_u)
+    if profiler is not None: profiler.stop()
+    logger.info('%i utterances in %s' % (len(lambda_u_dict), lambda_u_dict.data_file_name))
+    return lambda_u_dict
+
+def cut_conv_window_test_segment(dv_y_cfg, features_no_sil):
+    ''' conv_window_exec test feed: one segment holding up to spk_num_seq windows, S(1)*U(1)*L*D '''
+    ''' Returns x_val, gen_finish, batch_size, and the frames from the next window on '''
+    l_no_sil = features_no_sil.shape[0]
+    B_total  = max((l_no_sil - dv_y_cfg.batch_seq_len) // dv_y_cfg.batch_seq_shift + 1, 0)
+    if B_total == 0:
+        # Too short for one window; zero-padded segment, batch_size 0
+        return numpy.zeros((1, 1, dv_y_cfg.batch_seq_len, dv_y_cfg.feat_dim)), True, 0, None
+    B_actual = min(B_total, dv_y_cfg.spk_num_seq)
+    seg_len  = (B_actual - 1) * dv_y_cfg.batch_seq_shift + dv_y_cfg.batch_seq_len
+    x_val = numpy.reshape(features_no_sil[:seg_len], (1, 1, seg_len, dv_y_cfg.feat_dim))
+    if B_total > B_actual:
+        return x_val, False, B_actual, features_no_sil[B_actual * dv_y_cfg.batch_seq_shift:]
+    else:
+        return x_val, True, B_actual, None
+
+def draw_trial_index(num_files, num_trials, num_draw):
+    ''' Indices of num_draw files for each of num_trials trials; T * K '''
+    ''' Same as list_random_loader: no repeats until all files are used '''
+    num_perm = int(math.ceil(num_trials * num_draw / float(num_files)))
+    perm_list = numpy.argsort(numpy.random.rand(num_perm, num_files), axis=1).reshape(-1)
+    return perm_list[:num_trials * num_draw].reshape(num_trials, num_draw)
+
 ################################
 # dv_y_cmp; Not used any more  #
 # Moved to exp_dv_cmp_baseline #
@@ -421,12 +719,12 @@ def make_feed_dict_y_cmp_train(dv_y_cfg, file_list_dict, file_dir_dict, batch_sp
         # Draw multiple utterances per speaker: dv_y_cfg.spk_num_utter
         # Draw multiple windows per utterance:  dv_y_cfg.utter_num_seq
         # Stack them along B
-        speaker_file_name_list, speaker_utter_len_list, speaker_utter_list = get_utters_from_binary_dict(dv_y_cfg.spk_num_utter, file_list_dict[(speaker_id, utter_tvt)], file_dir_dict, feat_name_list=[feat_name], feat_dim_list=[dv_y_cfg.feat_dim], min_file_len=min_file_len, random_seed=None)
+        speaker_file_name_list, speaker_utter_len_list, speaker_utter_list = get_utters_from_binary_dict(dv_y_cfg.spk_num_utter, file_list_dict[(speaker_id, utter_tvt)], file_dir_dict, feat_name_list=[feat_name], feat_dim_list=[dv_y_cfg.nn_feature_dims], min_file_len=min_file_len, random_seed=None, feat_decoder_dict=dv_y_cfg.feat_decoder_dict)
         file_name_list.append(speaker_file_name_list)
 
         speaker_start_frame_index_list = []
         for utter_idx in range(dv_y_cfg.spk_num_utter):
-            y_stack = speaker_utter_list[feat_name][utter_idx][:,dv_y_cfg.feat_index]
+            y_stack = select_cmp_features(dv_y_cfg, speaker_utter_list[feat_name][utter_idx])
             frame_number   = speaker_utter_len_list[utter_idx]
             extra_file_len = frame_number - (min_file_len)
             start_frame_index = numpy.random.choice(range(total_sil_one_side, total_sil_one_side+extra_file_len+1))
@@ -479,8 +777,8 @@ def make_feed_dict_y_cmp_test(dv_y_cfg, file_dir_dict, speaker_id, file_name, st
 
     if BTD_feat_remain is None:
         # Get new file, make BD
-        _min_len, features = get_one_utter_by_name(file_name, file_dir_dict, feat_name_list=[feat_name], feat_dim_list=[dv_y_cfg.feat_dim])
-        y_features = features[feat_name]
+        _min_len, features = get_one_utter_by_name(file_name, file_dir_dict, feat_name_list=[feat_name], feat_dim_list=[dv_y_cfg.nn_feature_dims], feat_decoder_dict=dv_y_cfg.feat_decoder_dict)
+        y_features = select_cmp_features(dv_y_cfg, features[feat_name])
         l = y_features.shape[0]
         l_no_sil = l - total_sil_one_side * 2
         features = y_features[total_sil_one_side:total_sil_one_side+l_no_sil]
@@ -0,0 +1,305 @@
+# exp_dv_server.py
+
+# Resident d-vector extraction server; the model is loaded once
+# Each request (feature file path, raw feature buffer, or RIFF wav path) is cut into windows by the test feed-dict method
+# Windows of concurrent requests, with all their per-window inputs, are packed into shared S*B batches; a batch waits at most max_wait_ms to fill
+# Served as HTTP on localhost, or HTTP over a Unix socket
+#   POST /lambda  {"file_path": "/dir/p001_001.cmp"}  or  {"buffer": base64 float32 features}
+#                 Only features of the model's y_feat_name are handled, stored as the data preparation writes them
+#                 (same extension, normalised); a RIFF .wav path is converted for a wav model: wav_2_wav_cmp, then the
+#                 MinMax normaliser of the data preparation (wav_norm_file); no label-based silence reduction, so the
+#                 feed drops frames_silence_to_keep + sil_pad frames at each end as for silence-reduced files
+#                 With use_pitch_feed, window pitch is read from the pitch store by file id: file_path requests of corpus files only
+#                 returns {"lambda": [...], "B": number of windows, "latency_ms": ...}
+#                 with "top_k": k, also the k nearest speakers of DV.dat: "speaker_id_list", "score_list"
+#   GET  /stats   latency percentiles and batch fill
+
+import os, time, copy, json, threading, queue, base64, tempfile
+import numpy
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+from modules import make_logger
+from modules_torch import torch_initialisation
+from modules_dv import load_speaker_index
+
+from io_funcs.binary_io import BinaryIOCollection
+io_fun = BinaryIOCollection()
+
+class dv_y_server_configuration(object):
+
+    def __init__(self, cfg):
+        self.host = '127.0.0.1'
+        self.port = 8545
+        self.unix_socket_file_name = None # If set, serve on this Unix socket instead of host:port
+
+        self.batch_num_spk = 10   # S of the shared batch; B is dv_y_cfg.spk_num_seq
+        self.max_wait_ms   = 20.  # A batch is run when full, or this long after its first request
+        self.num_latency_keep = 10000 # Latencies of the most recent requests, for percentiles
+        self.wav_norm_file = cfg.nn_feat_resil_norm_files['wav'] # MinMax normaliser of RIFF wav requests, as norm_nn_file_list
+
+class DV_Extraction_Batcher(object):
+    ''' Packs windows of queued requests into S*B batches; one thread runs the model '''
+    ''' A request holds every per-window input of its test feeds (x, and any other but y), each (num_windows, ...) '''
+    def __init__(self, dv_y_cfg, server_cfg):
+        self.logger = make_logger("dv_batcher")
+        # Feed-dict method needs batch_num_spk == 1; the model is built with the server batch size
+        # Windows of different requests are packed together, so the windowed path is used
+        self.feed_cfg = copy.copy(dv_y_cfg)
+        self.feed_cfg.conv_window_exec = False
+        model_cfg = copy.copy(self.feed_cfg)
+        model_cfg.batch_num_spk = server_cfg.batch_num_spk
+        self.dv_y_model = torch_initialisation(model_cfg)
+        self.dv_y_model.load_nn_model(dv_y_cfg.nnets_file_name)
+        self.dv_y_model.eval()
+
+        self.S = server_cfg.batch_num_spk
+        self.B = dv_y_cfg.spk_num_seq
+        self.max_wait = server_cfg.max_wait_ms / 1000.
+        self.wav_norm_file = server_cfg.wav_norm_file
+        # Sinenet with nlf and tau of each window: the test feed reads them from the pitch store by file id
+        self.use_pitch_feed = getattr(dv_y_cfg, 'use_pitch_feed', False)
+        self.temp_dir = tempfile.mkdtemp(prefix='dv_server_')
+
+        self.request_queue = queue.Queue()
+        self.stats_lock = threading.Lock()
+        self.latency_list = []
+        self.num_latency_keep = server_cfg.num_latency_keep
+        self.num_requests = 0
+        self.num_batches  = 0
+        self.num_windows  = 0
+        self.batch_worker = threading.Thread(target=self.run, daemon=True)
+        self.batch_worker.start()
+
+    def make_windows(self, file_path):
+        ''' All windows of one file, same as class test: dict of per-window inputs, (num_windows, ...) each '''
+        feat_name = self.feed_cfg.y_feat_name
+        if not file_path.endswith('.' + feat_name):
+            raise ValueError('Only .%s feature files are handled: %s' % (feat_name, file_path))
+        with open(file_path, 'rb') as f:
+            is_riff = (f.read(4) == b'RIFF')
+        if is_riff:
+            if self.use_pitch_feed:
+                raise ValueError('use_pitch_feed: a RIFF wav file has no pitch store; request the prepared .wav of a corpus file: %s' % file_path)
+            if feat_name != 'wav':
+                raise ValueError('RIFF wav file; a %s model needs %s features: %s' % (feat_name, feat_name, file_path))
+            return self.make_wav_windows(file_path)
+        file_dir_dict = {feat_name: os.path.dirname(file_path)}
+        file_name = os.path.basename(file_path).split('.')[0]
+        if self.use_pitch_feed:
+            pitch_store = self.feed_cfg.pitch_store
+            if not os.path.isfile(os.path.join(pitch_store.pitch_dir, file_name + pitch_store.pitch_ext)):
+                raise ValueError('use_pitch_feed: no pitch store of %s in %s' % (file_name, pitch_store.pitch_dir))
+        window_list_dict = {}
+        gen_finish = False
+        BTD_feat_remain = None
+        while not (gen_finish):
+            feed_dict, gen_finish, batch_size, BTD_feat_remain = self.feed_cfg.make_feed_dict_method_test(self.feed_cfg, file_dir_dict, '', file_name, 0, BTD_feat_remain)
+            for k in feed_dict:
+                if k != 'y':
+                    window_list_dict.setdefault(k, []).append(feed_dict[k][0, :batch_size])
+        return {k: numpy.concatenate(window_list_dict[k], axis=0) for k in window_list_dict}
+
+    def make_wav_windows(self, file_path):
+        ''' RIFF wav: samples as wav_2_wav_cmp writes them, normalised as norm_nn_file_list unless the loader does it, in a temporary file '''
+        from modules import wav_2_wav_cmp
+        fd, temp_file_path = tempfile.mkstemp(suffix='.wav', dir=self.temp_dir)
+        os.close(fd)
+        try:
+            sr = wav_2_wav_cmp(file_path, temp_file_path)
+            if sr != self.feed_cfg.wav_sr:
+                raise ValueError('Sample rate %i, model is %i: %s' % (sr, self.feed_cfg.wav_sr, file_path))
+            if getattr(self.feed_cfg, 'loader_norm_type', None) is None:
+                # make_wav_min_max_normaliser: same min and max for every sample of a frame; wav range is +-3.99
+                # With loader_norm_type, files stay un-normalised; the feat decoder normalises them
+                norm_info = numpy.fromfile(self.wav_norm_file, dtype=numpy.float32).reshape(2, -1).astype(numpy.float64)
+                fea_min, fea_max = norm_info[0, 0], norm_info[1, 0]
+                min_value, max_value = -3.99, 3.99
+                scale  = (max_value - min_value) / (fea_max - fea_min)
+                offset = min_value - fea_min * scale
+                samples = numpy.fromfile(temp_file_path, dtype=numpy.float32)
+                (samples * scale + offset).astype(numpy.float32).tofile(temp_file_path)
+            return self.make_windows(temp_file_path)
+        finally:
+            os.remove(temp_file_path)
+
+    def extract(self, file_path=None, buffer=None):
+        ''' Called by request threads; blocks until the batch thread has the result '''
+        t_start = time.time()
+        if (buffer is not None) and self.use_pitch_feed:
+            raise ValueError('use_pitch_feed: a buffer has no pitch store; request the file_path of a corpus file')
+        if buffer is not None:
+            # Raw features; written to a temporary file, so windowing is identical to file requests
+            fd, file_path = tempfile.mkstemp(suffix='.' + self.feed_cfg.y_feat_name, dir=self.temp_dir)
+            os.close(fd)
+            try:
+                io_fun.array_to_binary_file(numpy.frombuffer(buffer, dtype=numpy.float32), file_path)
+                window_dict = self.make_windows(file_path)
+            finally:
+                os.remove(file_path)
+        else:
+            window_dict = self.make_windows(file_path)
+        if window_dict['x'].shape[0] <= 0:
+            raise ValueError('Too short for one window: %s' % file_path)
+        request = {'window_dict': window_dict, 'B': window_dict['x'].shape[0], 'event': threading.Event()}
+        self.request_queue.put(request)
+        request['event'].wait()
+        latency = time.time() - t_start
+        with self.stats_lock:
+            self.num_requests += 1
+            self.latency_list.append(latency)
+            if len(self.latency_list) > self.num_latency_keep:
+                self.latency_list = self.latency_list[-self.num_latency_keep:]
+        return request['lambda'], request['B'], latency
+
+    def run(self):
+        capacity = self.S * self.B
+        while True:
+            request_list = [self.request_queue.get()]
+            num_windows = request_list[0]['B']
+            deadline = time.time() + self.max_wait
+            while num_windows < capacity:
+                wait_time = deadline - time.time()
+                if wait_time <= 0:
+                    break
+                try:
+                    request = self.request_queue.get(timeout=wait_time)
+                except queue.Empty:
+                    break
+                request_list.append(request)
+                num_windows += request['B']
+            try:
+                self.process(request_list)
+            except Exception as e:
+                self.logger.info('Batch failed: %s' % str(e))
+                for request in request_list:
+                    request['lambda'], request['B'] = None, 0
+                    request['event'].set()
+
+    def process(self, request_list):
+        capacity = self.S * self.B
+        window_dict = {k: numpy.concatenate([request['window_dict'][k] for request in request_list], axis=0) for k in request_list[0]['window_dict']}
+        N = window_dict['x'].shape[0]
+        lambda_list = []
+        for n_start in range(0, N, capacity):
+            n_valid = min(capacity, N - n_start)
+            feed_dict = {}
+            for k in window_dict:
+                # S*B*..., padded with zeros
+                v = numpy.zeros((capacity,) + window_dict[k].shape[1:])
+                v[:n_valid] = window_dict[k][n_start:n_start+n_valid]
+                feed_dict[k] = v.reshape((self.S, self.B) + v.shape[1:])
+            lambda_SBD = self.dv_y_model.gen_lambda_SBD_value(feed_dict=feed_dict)
+            lambda_list.append(lambda_SBD.reshape(capacity, -1)[:n_valid])
+            with self.stats_lock:
+                self.num_batches += 1
+                self.num_windows += n_valid
+        lambda_N_D = numpy.concatenate(lambda_list, axis=0)
+        n_start = 0
+        for request in request_list:
+            B_u = request['B']
+            request['lambda'] = numpy.mean(lambda_N_D[n_start:n_start+B_u], axis=0)
+            n_start += B_u
+            request['event'].set()
+
+    def get_stats(self):
+        with self.stats_lock:
+            latency_ms = numpy.array(self.latency_list) * 1000.
+            stats_dict = {'num_requests': self.num_requests, 'num_batches': self.num_batches, 'num_windows': self.num_windows}
+            stats_dict['batch_fill'] = self.num_windows / float(max(self.num_batches, 1) * self.S * self.B)
+            stats_dict['windows_per_batch'] = self.num_windows / float(max(self.num_batches, 1))
+        for p in [50, 90, 99]:
+            stats_dict['latency_ms_p%i' % p] = float(numpy.percentile(latency_ms, p)) if latency_ms.shape[0] > 0 else 0.
+        return stats_dict
+
+class DV_Request_Handler(BaseHTTPRequestHandler):
+    ''' self.server.batcher is the DV_Extraction_Batcher '''
+
+    def do_POST(self):
+        if self.path != '/lambda':
+            self.send_json({'error': 'unknown path %s' % self.path}, 404)
+            return
+        try:
+            request_dict = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            if 'buffer' in request_dict:
+                lambda_u, B_u, latency = self.server.batcher.extract(buffer=base64.b64decode(request_dict['buffer']))
+            else:
+                lambda_u, B_u, latency = self.server.batcher.extract(file_path=request_dict['file_path'])
+            if lambda_u is None:
+                raise ValueError('Batch failed, see server log')
+            result_dict = {'lambda': lambda_u.tolist(), 'B': int(B_u), 'latency_ms': latency * 1000.}
+            if 'top_k' in request_dict:
+                if self.server.speaker_index is None:
+                    raise ValueError('No speaker index; run gen_dv_y_model first')
+                speaker_id_Q_K, score_Q_K = self.server.speaker_index.search(lambda_u, int(request_dict['top_k']), self.server.num_probe)
+                result_dict['speaker_id_list'] = speaker_id_Q_K[0].tolist()
+                result_dict['score_list'] = score_Q_K[0].tolist()
+        except Exception as e:
+            self.send_json({'error': str(e)}, 400)
+            return
+        self.send_json(result_dict)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self.send_json(self.server.batcher.get_stats())
+        else:
+            self.send_json({'error': 'unknown path %s' % self.path}, 404)
+
+    def send_json(self, result_dict, code=200):
+        body = json.dumps(result_dict).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket clients have no host address
+        return str(self.client_address[0]) if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        pass
+
+class Threading_HTTP_Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class Threading_Unix_HTTP_Server(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+def make_dv_y_server(dv_y_cfg, server_cfg):
+    batcher = DV_Extraction_Batcher(dv_y_cfg, server_cfg)
+    if server_cfg.unix_socket_file_name is not None:
+        if os.path.exists(server_cfg.unix_socket_file_name):
+            os.remove(server_cfg.unix_socket_file_name)
+        server = Threading_Unix_HTTP_Server(server_cfg.unix_socket_file_name, DV_Request_Handler)
+    else:
+        server = Threading_HTTP_Server((server_cfg.host, server_cfg.port), DV_Request_Handler)
+    server.batcher = batcher
+    # Nearest-speaker search over the d-vectors of gen_dv_y_model, if generated
+    server.speaker_index = None
+    server.num_probe = dv_y_cfg.dv_index_num_probe
+    if os.path.isfile(dv_y_cfg.dv_file_name):
+        server.speaker_index = load_speaker_index(dv_y_cfg.dv_file_name, dv_y_cfg.dv_index_file_name, dv_y_cfg.dv_index_num_lists)
+    return server
+
+def serve_dv_y_model(cfg, dv_y_cfg, server_cfg=None):
+    logger = make_logger("dv_server")
+    if server_cfg is None: server_cfg = dv_y_server_configuration(cfg)
+    dv_y_cfg.change_to_class_test_mode()
+    server = make_dv_y_server(dv_y_cfg, server_cfg)
+    if server_cfg.unix_socket_file_name is not None:
+        logger.info('Serving %s on %s' % (dv_y_cfg.nnets_file_name, server_cfg.unix_socket_file_name))
+    else:
+        logger.info('Serving %s on http://%s:%i' % (dv_y_cfg.nnets_file_name, server_cfg.host, server_cfg.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info('Stopping; %s' % json.dumps(server.batcher.get_stats()))
+    server.server_close()
+
+def serve_dv_y_cmp_model(cfg, server_cfg=None):
+    from exp_mw545.exp_dv_cmp_baseline import dv_y_cmp_configuration
+    serve_dv_y_model(cfg, dv_y_cmp_configuration(cfg), server_cfg)
+
+def serve_dv_y_wav_model(cfg, server_cfg=None):
+    from exp_mw545.exp_dv_wav_baseline import dv_y_wav_cmp_configuration
+    serve_dv_y_model(cfg, dv_y_wav_cmp_configuration(cfg), server_cfg)
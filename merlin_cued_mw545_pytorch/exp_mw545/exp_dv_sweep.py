@@ -0,0 +1,265 @@
+# exp_dv_sweep.py
+
+# Hyper-parameter sweeps over dv_y configurations
+# Each trial is one train_dv_y_model run in its own process; trials run concurrently
+# Progress is read from each trial's telemetry.jsonl; clearly losing trials are killed early
+
+import os, sys, pickle, time, shutil, copy, json, itertools, importlib, subprocess
+import numpy
+numpy.random.seed(545)
+from modules import make_logger, prepare_file_path
+
+class dv_y_sweep_configuration(object):
+
+    def __init__(self, cfg):
+        # Base configuration; module and class name, so trial processes can rebuild it
+        self.config_module = 'exp_mw545.exp_dv_cmp_baseline'
+        self.config_class  = 'dv_y_cmp_configuration'
+        # Every combination of values is one trial
+        # Keys are dv_y_cfg attributes; dv_dim also resizes the last (bottleneck) layer
+        self.param_grid = {
+            'learning_rate': [0.0001, 0.00005],
+            'batch_seq_len': [20, 40],
+            'dv_dim': [32, 64],
+        }
+
+        self.sweep_name = 'dv_y_cmp'
+        self.sweep_dir  = os.path.join(cfg.work_dir, 'sweep_' + self.sweep_name)
+        self.results_file_name = os.path.join(self.sweep_dir, 'sweep_results.tsv')
+
+        # Scheduler
+        self.num_threads_per_trial  = 4    # OMP threads per trial; max concurrent trials = cpu_count / this
+        self.max_num_trials_running = None # None: derived from CPU cores
+        self.mem_per_trial_gb       = 8.   # A new trial is launched only if this much memory is available
+        self.gpu_id_list            = [0]  # Trials are spread over these; use ['cpu'] for CPU only
+        self.poll_interval          = 30   # Seconds between scheduler checks
+
+        # Early stopping of losing trials (median stopping rule)
+        # At each epoch, a trial whose best valid loss is worse than the median of the other trials
+        # at the same epoch by more than kill_margin is killed
+        self.kill_grace_epoch    = 5
+        self.kill_margin         = 0.05
+        self.kill_min_num_trials = 3
+
+        self.log_except_list = []
+
+def make_sweep_param_list(param_grid):
+    param_name_list = sorted(param_grid.keys())
+    param_list = []
+    for value_list in itertools.product(*[param_grid[k] for k in param_name_list]):
+        param_list.append(dict(zip(param_name_list, value_list)))
+    return param_list
+
+def make_dv_y_cfg_from_params(cfg, config_module, config_class, params, exp_dir_suffix=''):
+    ''' Build the base configuration, apply trial parameters, then derive exp_dir and dimensions '''
+    ''' auto_complete of the base constructor is skipped, so the exp_dir of the base configuration is never made '''
+    dv_y_cfg_class = getattr(importlib.import_module(config_module), config_class)
+    class base_dv_y_cfg_class(dv_y_cfg_class):
+        def auto_complete(self, cfg):
+            pass
+    dv_y_cfg = base_dv_y_cfg_class(cfg)
+    dv_y_cfg.__class__ = dv_y_cfg_class
+    for k in params:
+        setattr(dv_y_cfg, k, copy.deepcopy(params[k]))
+    if 'dv_dim' in params:
+        # The last layer is the bottleneck, its size is the lambda dimension
+        dv_y_cfg.nn_layer_config_list = copy.deepcopy(dv_y_cfg.nn_layer_config_list)
+        dv_y_cfg.nn_layer_config_list[-1]['size'] = params['dv_dim']
+    dv_y_cfg.exp_dir_suffix = exp_dir_suffix
+    dv_y_cfg.auto_complete(cfg)
+    return dv_y_cfg
+
+def make_sweep_trial_list(cfg, sweep_cfg, trial_list, logger):
+    ''' Appends one pending trial per parameter combination to trial_list, so a failure part way keeps the trials made so far '''
+    ''' Per-trial exp_dir is derived through make_dv_y_exp_dir_name; a suffix is added when two trials collide '''
+    exp_dir_list = []
+    for i, params in enumerate(make_sweep_param_list(sweep_cfg.param_grid)):
+        exp_dir_suffix = ''
+        dv_y_cfg = make_dv_y_cfg_from_params(cfg, sweep_cfg.config_module, sweep_cfg.config_class, params)
+        if dv_y_cfg.exp_dir in exp_dir_list:
+            exp_dir_suffix = '_sweep%03i' % i
+            dv_y_cfg = make_dv_y_cfg_from_params(cfg, sweep_cfg.config_module, sweep_cfg.config_class, params, exp_dir_suffix)
+        exp_dir_list.append(dv_y_cfg.exp_dir)
+        trial = {'index': i, 'params': params, 'exp_dir': dv_y_cfg.exp_dir, 'exp_dir_suffix': exp_dir_suffix, 'status': 'pending'}
+        trial['telemetry_file_name'] = dv_y_cfg.telemetry_file_name
+        # Only read telemetry written by this sweep
+        trial['telemetry_offset'] = os.path.getsize(trial['telemetry_file_name']) if os.path.exists(trial['telemetry_file_name']) else 0
+        trial['spec_file_name'] = os.path.join(sweep_cfg.sweep_dir, 'trial_%03i.spec' % i)
+        trial['log_file_name']  = os.path.join(sweep_cfg.sweep_dir, 'trial_%03i.log' % i)
+        trial['valid_loss_list'] = []
+        trial['best_valid_loss_list'] = []
+        trial['valid_accuracy'] = float('nan')
+        trial_list.append(trial)
+        logger.info('trial %i: %s; %s' % (i, json.dumps(params), dv_y_cfg.exp_dir))
+    return trial_list
+
+def read_trial_telemetry(trial):
+    ''' Read new epoch summary lines from the trial's telemetry file '''
+    if not os.path.exists(trial['telemetry_file_name']):
+        return
+    with open(trial['telemetry_file_name'], 'r') as f:
+        f.seek(trial['telemetry_offset'])
+        for l in f:
+            if not l.endswith('\n'):
+                break # Partially written line; read again next time
+            trial['telemetry_offset'] += len(l.encode())
+            epoch_dict = json.loads(l)
+            if epoch_dict['type'] != 'epoch' or 'valid' not in epoch_dict.get('loss', {}):
+                continue
+            valid_loss = epoch_dict['loss']['valid']
+            trial['valid_loss_list'].append(valid_loss)
+            trial['best_valid_loss_list'].append(min(valid_loss, trial['best_valid_loss_list'][-1]) if trial['best_valid_loss_list'] else valid_loss)
+            trial['valid_accuracy'] = epoch_dict.get('accuracy', {}).get('valid', float('nan'))
+
+def is_trial_losing(trial, trial_list, sweep_cfg):
+    ''' Median stopping rule, on best valid loss so far at the trial's current epoch '''
+    num_epoch = len(trial['best_valid_loss_list'])
+    if num_epoch < sweep_cfg.kill_grace_epoch:
+        return False
+    other_loss_list = [t['best_valid_loss_list'][num_epoch-1] for t in trial_list if (t is not trial) and len(t['best_valid_loss_list']) >= num_epoch]
+    if len(other_loss_list) < sweep_cfg.kill_min_num_trials:
+        return False
+    median_loss = numpy.median(other_loss_list)
+    return trial['best_valid_loss_list'][-1] > median_loss + abs(median_loss) * sweep_cfg.kill_margin
+
+def get_mem_available_gb():
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for l in f:
+                if l.startswith('MemAvailable:'):
+                    return float(l.split()[1]) / 1048576.
+    except IOError:
+        pass
+    return float('inf')
+
+def launch_sweep_trial(cfg, sweep_cfg, trial, gpu_id):
+    trial_spec = {'cfg_dict': vars(cfg), 'config_module': sweep_cfg.config_module, 'config_class': sweep_cfg.config_class, \
+                  'params': trial['params'], 'exp_dir_suffix': trial['exp_dir_suffix'], 'gpu_id': gpu_id, 'num_threads': sweep_cfg.num_threads_per_trial}
+    with open(trial['spec_file_name'], 'wb') as f:
+        pickle.dump(trial_spec, f)
+    env = dict(os.environ)
+    env['OMP_NUM_THREADS'] = str(sweep_cfg.num_threads_per_trial)
+    env['MKL_NUM_THREADS'] = str(sweep_cfg.num_threads_per_trial)
+    env['PYTHONPATH'] = os.path.dirname(cfg.python_script_name) + os.pathsep + env.get('PYTHONPATH', '')
+    log_fid = open(trial['log_file_name'], 'w')
+    trial['process'] = subprocess.Popen([sys.executable, os.path.realpath(__file__), trial['spec_file_name']], stdout=log_fid, stderr=subprocess.STDOUT, env=env)
+    trial['log_fid'] = log_fid
+    trial['gpu_id']  = gpu_id
+    trial['status']  = 'running'
+    trial['start_time'] = time.time()
+
+def write_sweep_results(sweep_cfg, trial_list):
+    param_name_list = sorted(sweep_cfg.param_grid.keys())
+    with open(sweep_cfg.results_file_name, 'w') as f:
+        f.write('\t'.join(['trial', 'status', 'num_epoch', 'best_valid_loss', 'final_valid_loss', 'final_valid_accuracy'] + param_name_list + ['exp_dir']) + '\n')
+        for trial in trial_list:
+            line = ['%i' % trial['index'], trial['status'], '%i' % len(trial['valid_loss_list'])]
+            if trial['valid_loss_list']:
+                line.extend(['%.6f' % trial['best_valid_loss_list'][-1], '%.6f' % trial['valid_loss_list'][-1], '%.4f' % trial['valid_accuracy']])
+            else:
+                line.extend(['nan', 'nan', 'nan'])
+            line.extend([json.dumps(trial['params'][k]) for k in param_name_list])
+            line.append(trial['exp_dir'])
+            f.write('\t'.join(line) + '\n')
+
+def remove_unlaunched_exp_dirs(trial_list, existing_exp_dir_set, logger):
+    ''' auto_complete makes exp_dir for every trial; remove those of trials never launched, unless there before the sweep '''
+    for trial in trial_list:
+        exp_dir = os.path.normpath(trial['exp_dir'])
+        if trial['status'] == 'pending' and exp_dir not in existing_exp_dir_set and os.path.isdir(exp_dir):
+            shutil.rmtree(exp_dir)
+            logger.info('trial %i not launched, removed %s' % (trial['index'], exp_dir))
+
+def stop_sweep_trial(trial):
+    trial['process'].terminate()
+    try: trial['process'].wait(timeout=60)
+    except subprocess.TimeoutExpired: trial['process'].kill()
+    trial['log_fid'].close()
+
+def run_dv_y_sweep(cfg, sweep_cfg):
+    logger = make_logger("dv_y_sweep")
+    prepare_file_path(sweep_cfg.sweep_dir)
+    existing_exp_dir_set = set([os.path.normpath(os.path.join(cfg.work_dir, d)) for d in os.listdir(cfg.work_dir)])
+
+    trial_list = []
+    running_list = []
+    try:
+        make_sweep_trial_list(cfg, sweep_cfg, trial_list, logger)
+
+        if sweep_cfg.max_num_trials_running is None:
+            max_num_trials_running = max(1, int(os.cpu_count() / sweep_cfg.num_threads_per_trial))
+        else:
+            max_num_trials_running = sweep_cfg.max_num_trials_running
+        logger.info('%i trials, at most %i running at once' % (len(trial_list), max_num_trials_running))
+
+        pending_list = list(trial_list)
+        while pending_list or running_list:
+            for trial in list(running_list):
+                read_trial_telemetry(trial)
+                return_code = trial['process'].poll()
+                if return_code is not None:
+                    trial['log_fid'].close()
+                    trial['status'] = 'finished' if return_code == 0 else 'failed'
+                    running_list.remove(trial)
+                    logger.info('trial %i %s after %i epochs, %.1f s' % (trial['index'], trial['status'], len(trial['valid_loss_list']), time.time()-trial['start_time']))
+                elif is_trial_losing(trial, trial_list, sweep_cfg):
+                    stop_sweep_trial(trial)
+                    trial['status'] = 'killed'
+                    running_list.remove(trial)
+                    logger.info('trial %i killed at epoch %i, best valid loss %.4f' % (trial['index'], len(trial['valid_loss_list']), trial['best_valid_loss_list'][-1]))
+
+            # Fill every free slot; memory of trials launched in this check is not in MemAvailable yet, so it is reserved here
+            mem_available_gb = get_mem_available_gb()
+            while pending_list and len(running_list) < max_num_trials_running:
+                if mem_available_gb < sweep_cfg.mem_per_trial_gb and len(running_list) > 0:
+                    break
+                trial = pending_list.pop(0)
+                gpu_count = [len([t for t in running_list if t['gpu_id'] == g]) for g in sweep_cfg.gpu_id_list]
+                gpu_id = sweep_cfg.gpu_id_list[int(numpy.argmin(gpu_count))]
+                launch_sweep_trial(cfg, sweep_cfg, trial, gpu_id)
+                running_list.append(trial)
+                logger.info('trial %i started on %s; %.1f GB memory available' % (trial['index'], str(gpu_id), mem_available_gb))
+                mem_available_gb -= sweep_cfg.mem_per_trial_gb
+
+            write_sweep_results(sweep_cfg, trial_list)
+            if pending_list or running_list:
+                time.sleep(sweep_cfg.poll_interval)
+    except BaseException:
+        logger.info('sweep failed; stopping %i running trials' % len(running_list))
+        for trial in running_list:
+            stop_sweep_trial(trial)
+            trial['status'] = 'failed'
+        remove_unlaunched_exp_dirs(trial_list, existing_exp_dir_set, logger)
+        if trial_list:
+            write_sweep_results(sweep_cfg, trial_list)
+        raise
+
+    write_sweep_results(sweep_cfg, trial_list)
+    logger.info('Results written to %s' % sweep_cfg.results_file_name)
+    return trial_list
+
+def run_sweep_trial(spec_file_name):
+    ''' Entry point of one trial process '''
+    with open(spec_file_name, 'rb') as f:
+        trial_spec = pickle.load(f)
+    from run_nn_iv_batch_T4_DV import configuration
+    cfg = configuration.__new__(configuration)
+    cfg.__dict__.update(trial_spec['cfg_dict'])
+
+    import torch
+    torch.set_num_threads(trial_spec['num_threads'])
+    dv_y_cfg = make_dv_y_cfg_from_params(cfg, trial_spec['config_module'], trial_spec['config_class'], trial_spec['params'], trial_spec['exp_dir_suffix'])
+    dv_y_cfg.gpu_id = trial_spec['gpu_id']
+    # The scheduler reads progress from the epoch summary lines
+    dv_y_cfg.telemetry_switch = True
+    dv_y_cfg.telemetry_log_steps = False
+
+    from exp_mw545.exp_dv_cmp_pytorch import train_dv_y_model
+    train_dv_y_model(cfg, dv_y_cfg)
+
+def sweep_dv_y_cmp_model(cfg, sweep_cfg=None):
+    if sweep_cfg is None: sweep_cfg = dv_y_sweep_configuration(cfg)
+    run_dv_y_sweep(cfg, sweep_cfg)
+
+if __name__ == '__main__':
+    run_sweep_trial(sys.argv[1])
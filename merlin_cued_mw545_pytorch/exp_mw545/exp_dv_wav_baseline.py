@@ -16,14 +16,19 @@ from modules_torch import torch_initialisation
 from io_funcs.binary_io import BinaryIOCollection
 io_fun = BinaryIOCollection()
 
-from exp_mw545.exp_dv_cmp_pytorch import list_random_loader, dv_y_configuration, make_dv_y_exp_dir_name, make_dv_file_list, train_dv_y_model, class_test_dv_y_model
+from exp_mw545.exp_dv_cmp_pytorch import list_random_loader, dv_y_configuration, make_dv_y_exp_dir_name, make_dv_file_list, train_dv_y_model, class_test_dv_y_model, verification_test_dv_y_model, cut_conv_window_test_segment
+import exp_mw545.exp_dv_cmp_pytorch
 
 
-def make_feed_dict_y_wav_cmp_train(dv_y_cfg, file_list_dict, file_dir_dict, batch_speaker_list, utter_tvt, return_dv=False, return_y=False, return_frame_index=False, return_file_name=False):
+def make_feed_dict_y_wav_cmp_train(dv_y_cfg, file_list_dict, file_dir_dict, batch_speaker_list, utter_tvt, return_dv=False, return_y=False, return_frame_index=False, return_file_name=False, telemetry=None):
     feat_name = dv_y_cfg.y_feat_name # Hard-coded here for now
     # Make i/o shape arrays
     # This is numpy shape, not Tensor shape!
-    y  = numpy.zeros((dv_y_cfg.batch_num_spk, dv_y_cfg.spk_num_seq, dv_y_cfg.batch_seq_len, dv_y_cfg.feat_dim))
+    if dv_y_cfg.conv_window_exec:
+        # One segment per utterance; windows are cut by the first layer
+        y = numpy.zeros((dv_y_cfg.batch_num_spk, dv_y_cfg.spk_num_utter, dv_y_cfg.utter_seg_len, dv_y_cfg.feat_dim))
+    else:
+        y = numpy.zeros((dv_y_cfg.batch_num_spk, dv_y_cfg.spk_num_seq, dv_y_cfg.batch_seq_len, dv_y_cfg.feat_dim))
     dv = numpy.zeros((dv_y_cfg.batch_num_spk))
 
     # Do not use silence frames at the beginning or the end
@@ -43,7 +48,7 @@ def make_feed_dict_y_wav_cmp_train(dv_y_cfg, file_list_dict, file_dir_dict, batc
         # Draw multiple utterances per speaker: dv_y_cfg.spk_num_utter
         # Draw multiple windows per utterance:  dv_y_cfg.utter_num_seq
         # Stack them along B
-        speaker_file_name_list, speaker_utter_len_list, speaker_utter_list = get_utters_from_binary_dict(dv_y_cfg.spk_num_utter, file_list_dict[(speaker_id, utter_tvt)], file_dir_dict, feat_name_list=[feat_name], feat_dim_list=[dv_y_cfg.feat_dim], min_file_len=min_file_len, random_seed=None)
+        speaker_file_name_list, speaker_utter_len_list, speaker_utter_list = get_utters_from_binary_dict(dv_y_cfg.spk_num_utter, file_list_dict[(speaker_id, utter_tvt)], file_dir_dict, feat_name_list=[feat_name], feat_dim_list=[dv_y_cfg.feat_dim], min_file_len=min_file_len, random_seed=None, telemetry=telemetry, feat_decoder_dict=dv_y_cfg.feat_decoder_dict)
         file_name_list.append(speaker_file_name_list)
 
         speaker_start_frame_index_list = []
@@ -53,14 +58,21 @@ def make_feed_dict_y_wav_cmp_train(dv_y_cfg, file_list_dict, file_dir_dict, batc
             extra_file_len = frame_number - (min_file_len)
             start_frame_index = numpy.random.choice(range(total_sil_one_side, total_sil_one_side+extra_file_len+1))
             speaker_start_frame_index_list.append(start_frame_index)
-            for seq_idx in range(dv_y_cfg.utter_num_seq):
-                y[speaker_idx, utter_idx*dv_y_cfg.utter_num_seq+seq_idx, :, :] = y_stack[start_frame_index:start_frame_index+dv_y_cfg.batch_seq_len, :]
-                start_frame_index = start_frame_index + dv_y_cfg.batch_seq_shift
+            if dv_y_cfg.conv_window_exec:
+                y[speaker_idx, utter_idx] = y_stack[start_frame_index:start_frame_index+dv_y_cfg.utter_seg_len, :]
+            else:
+                for seq_idx in range(dv_y_cfg.utter_num_seq):
+                    y[speaker_idx, utter_idx*dv_y_cfg.utter_num_seq+seq_idx, :, :] = y_stack[start_frame_index:start_frame_index+dv_y_cfg.batch_seq_len, :]
+                    start_frame_index = start_frame_index + dv_y_cfg.batch_seq_shift
         start_frame_index_list.append(speaker_start_frame_index_list)
 
 
-    # S,B,T,D --> S,B,T*D
-    x_val = numpy.reshape(y, (dv_y_cfg.batch_num_spk, dv_y_cfg.spk_num_seq, dv_y_cfg.batch_seq_len*dv_y_cfg.feat_dim))
+    if dv_y_cfg.conv_window_exec:
+        # S,U,L,D segments
+        x_val = y
+    else:
+        # S,B,T,D --> S,B,T*D
+        x_val = numpy.reshape(y, (dv_y_cfg.batch_num_spk, dv_y_cfg.spk_num_seq, dv_y_cfg.batch_seq_len*dv_y_cfg.feat_dim))
     if dv_y_cfg.train_by_window:
         # S --> S*B
         y_val = numpy.repeat(dv, dv_y_cfg.spk_num_seq)
@@ -100,14 +112,26 @@ def make_feed_dict_y_wav_cmp_test(dv_y_cfg, file_dir_dict, speaker_id, file_name
     except ValueError: true_speaker_index = 0 # At generation time, since dv is not used, a non-train speaker is given an arbituary speaker index
     dv[0] = true_speaker_index
 
+    if dv_y_cfg.conv_window_exec:
+        # Segment of frames, not windows; BTD_feat_remain holds the frames not used yet
+        if BTD_feat_remain is None:
+            _min_len, features = get_one_utter_by_name(file_name, file_dir_dict, feat_name_list=[feat_name], feat_dim_list=[dv_y_cfg.feat_dim], feat_decoder_dict=dv_y_cfg.feat_decoder_dict)
+            y_features = features[feat_name]
+            l_no_sil = y_features.shape[0] - total_sil_one_side * 2
+            BTD_feat_remain = y_features[total_sil_one_side:total_sil_one_side+l_no_sil]
+        x_val, gen_finish, batch_size, BTD_feat_remain = cut_conv_window_test_segment(dv_y_cfg, BTD_feat_remain)
+        y_val = numpy.repeat(dv, dv_y_cfg.spk_num_seq) if dv_y_cfg.train_by_window else dv
+        feed_dict = {'x':x_val, 'y':y_val}
+        return [feed_dict, gen_finish, batch_size, BTD_feat_remain]
+
     if BTD_feat_remain is None:
         # Get new file, make BTD
-        _min_len, features = get_one_utter_by_name(file_name, file_dir_dict, feat_name_list=[feat_name], feat_dim_list=[dv_y_cfg.feat_dim])
+        _min_len, features = get_one_utter_by_name(file_name, file_dir_dict, feat_name_list=[feat_name], feat_dim_list=[dv_y_cfg.feat_dim], feat_decoder_dict=dv_y_cfg.feat_decoder_dict)
         y_features = features[feat_name]
         l = y_features.shape[0]
         l_no_sil = l - total_sil_one_side * 2
         features_no_sil = y_features[total_sil_one_side:total_sil_one_side+l_no_sil]
-        B_total  = int((l_no_sil - dv_y_cfg.batch_seq_len) / dv_y_cfg.batch_seq_shift) + 1
+        B_total  = max((l_no_sil - dv_y_cfg.batch_seq_len) // dv_y_cfg.batch_seq_shift + 1, 0) # 0 if too short for one window
         BTD_features = numpy.zeros((B_total, dv_y_cfg.batch_seq_len, dv_y_cfg.feat_dim))
         for b in range(B_total):
             start_i = dv_y_cfg.batch_seq_shift * b
@@ -149,6 +173,63 @@ def make_feed_dict_y_wav_cmp_test(dv_y_cfg, file_dir_dict, speaker_id, file_name
     return_list = [feed_dict, gen_finish, batch_size, BTD_feat_remain]
     return return_list
 
+def make_pitch_feed(dv_y_cfg, file_id_list, start_index_SB):
+    ''' nlf and tau (S*B*1*1) of wav windows from dv_y_cfg.pitch_store; one file per row, start_index_SB in samples '''
+    ''' Pitch times start at the first non-silence frame, total_sil_one_side samples into the silence-reduced wav '''
+    total_sil_one_side = (dv_y_cfg.frames_silence_to_keep + dv_y_cfg.sil_pad) * 80
+    start_index_SB = numpy.asarray(start_index_SB) - total_sil_one_side
+    tau_SB, lf0_SB = dv_y_cfg.pitch_store.query_windows(file_id_list, start_index_SB, dv_y_cfg.batch_seq_len, dv_y_cfg.wav_sr)
+    nlf_SB = (lf0_SB - dv_y_cfg.lf0_mean) / dv_y_cfg.lf0_std
+    S, B = tau_SB.shape
+    return nlf_SB.reshape(S, B, 1, 1), tau_SB.reshape(S, B, 1, 1)
+
+def make_feed_dict_y_wav_sinenet_train(dv_y_cfg, file_list_dict, file_dir_dict, batch_speaker_list, utter_tvt, return_dv=False, return_y=False, return_frame_index=False, return_file_name=False, telemetry=None):
+    ''' make_feed_dict_y_wav_cmp_train, plus nlf and tau of each window for a Sinenet first layer '''
+    return_list = make_feed_dict_y_wav_cmp_train(dv_y_cfg, file_list_dict, file_dir_dict, batch_speaker_list, utter_tvt, return_dv, return_y, return_frame_index=True, return_file_name=True, telemetry=telemetry)
+    file_name_list = return_list.pop()
+    start_frame_index_list = return_list.pop()
+
+    # One row per utterance, utter_num_seq windows each; window b of speaker s is utterance b // utter_num_seq
+    utter_file_list = [file_name for speaker_file_name_list in file_name_list for file_name in speaker_file_name_list]
+    start_index_SU_N = numpy.array(start_frame_index_list).reshape(-1, 1) + dv_y_cfg.batch_seq_shift * numpy.arange(dv_y_cfg.utter_num_seq)
+    nlf, tau = make_pitch_feed(dv_y_cfg, utter_file_list, start_index_SU_N)
+    feed_dict = return_list[0]
+    feed_dict['nlf'] = nlf.reshape(dv_y_cfg.batch_num_spk, dv_y_cfg.spk_num_seq, 1, 1)
+    feed_dict['tau'] = tau.reshape(dv_y_cfg.batch_num_spk, dv_y_cfg.spk_num_seq, 1, 1)
+
+    if return_frame_index:
+        return_list.append(start_frame_index_list)
+    if return_file_name:
+        return_list.append(file_name_list)
+    return return_list
+
+def make_feed_dict_y_wav_sinenet_test(dv_y_cfg, file_dir_dict, speaker_id, file_name, start_frame_index, BTD_feat_remain):
+    ''' make_feed_dict_y_wav_cmp_test, plus nlf and tau of each window; BTD_feat_remain also carries those of the remaining windows '''
+    if BTD_feat_remain is None:
+        pitch_remain = None
+    else:
+        BTD_feat_remain, pitch_remain = BTD_feat_remain
+    feed_dict, gen_finish, batch_size, BTD_feat_remain = make_feed_dict_y_wav_cmp_test(dv_y_cfg, file_dir_dict, speaker_id, file_name, start_frame_index, BTD_feat_remain)
+
+    if pitch_remain is None:
+        # New file: pitch of all its windows, same starts as make_feed_dict_y_wav_cmp_test
+        total_sil_one_side = (dv_y_cfg.frames_silence_to_keep + dv_y_cfg.sil_pad) * 80
+        B_total = batch_size if BTD_feat_remain is None else batch_size + BTD_feat_remain.shape[0]
+        start_index_1_B = total_sil_one_side + dv_y_cfg.batch_seq_shift * numpy.arange(B_total).reshape(1, -1)
+        nlf, tau = make_pitch_feed(dv_y_cfg, [file_name], start_index_1_B)
+        pitch_remain = (nlf[0], tau[0])
+
+    nlf_B = numpy.zeros((dv_y_cfg.spk_num_seq, 1, 1))
+    tau_B = numpy.zeros((dv_y_cfg.spk_num_seq, 1, 1))
+    nlf_B[:batch_size] = pitch_remain[0][:batch_size]
+    tau_B[:batch_size] = pitch_remain[1][:batch_size]
+    feed_dict['nlf'] = nlf_B.reshape(dv_y_cfg.batch_num_spk, dv_y_cfg.spk_num_seq, 1, 1)
+    feed_dict['tau'] = tau_B.reshape(dv_y_cfg.batch_num_spk, dv_y_cfg.spk_num_seq, 1, 1)
+
+    if BTD_feat_remain is not None:
+        BTD_feat_remain = (BTD_feat_remain, (pitch_remain[0][batch_size:], pitch_remain[1][batch_size:]))
+    return [feed_dict, gen_finish, batch_size, BTD_feat_remain]
+
 class dv_y_wav_cmp_configuration(dv_y_configuration):
     
     def __init__(self, cfg):
@@ -195,3 +276,11 @@ def test_dv_y_wav_model(cfg, dv_y_cfg=None):
     if dv_y_cfg is None: dv_y_cfg = dv_y_wav_cmp_configuration(cfg)
     class_test_dv_y_model(cfg, dv_y_cfg)
 
+def verification_test_dv_y_wav_model(cfg, dv_y_cfg=None):
+    if dv_y_cfg is None: dv_y_cfg = dv_y_wav_cmp_configuration(cfg)
+    verification_test_dv_y_model(cfg, dv_y_cfg)
+
+def gen_dv_y_model(cfg, dv_y_cfg=None):
+    if dv_y_cfg is None: dv_y_cfg = dv_y_wav_cmp_configuration(cfg)
+    # Same name as the process in exp_dv_cmp_pytorch
+    exp_mw545.exp_dv_cmp_pytorch.gen_dv_y_model(cfg, dv_y_cfg)
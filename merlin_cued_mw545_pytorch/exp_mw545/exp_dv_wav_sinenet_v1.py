@@ -59,6 +59,20 @@ class dv_y_wav_cmp_configuration(dv_y_configuration):
         from exp_mw545.exp_dv_wav_baseline import make_feed_dict_y_wav_cmp_train, make_feed_dict_y_wav_cmp_test
         self.make_feed_dict_method_train = make_feed_dict_y_wav_cmp_train
         self.make_feed_dict_method_test  = make_feed_dict_y_wav_cmp_test
+
+        # True: first layer is Sinenet, with nlf and tau of each window from the binary pitch stores (ResilPitch)
+        # False: SinenetV1 predicts them from the window
+        self.use_pitch_feed = False
+        self.lf0_mean = 5.02654  # Same as SinenetLayer log_f_mean
+        self.lf0_std  = 0.373288 # Same as SinenetLayer log_f_std
+        if self.use_pitch_feed:
+            from modules_2 import Pitch_Store
+            from exp_mw545.exp_dv_wav_baseline import make_feed_dict_y_wav_sinenet_train, make_feed_dict_y_wav_sinenet_test
+            self.nn_layer_config_list[0]['type'] = 'Sinenet'
+            self.pitch_store = Pitch_Store(cfg.nn_feat_scratch_dirs['pitch'])
+            self.log_except_list = self.log_except_list + ['pitch_store']
+            self.make_feed_dict_method_train = make_feed_dict_y_wav_sinenet_train
+            self.make_feed_dict_method_test  = make_feed_dict_y_wav_sinenet_test
         self.auto_complete(cfg)
 
         self.a_val = None
@@ -66,7 +80,8 @@ class dv_y_wav_cmp_configuration(dv_y_configuration):
 
     def additional_action_epoch(self, logger, dv_y_model):
         # Print values of a and phi to see if they are updated
-        sinenet_layer = dv_y_model.nn_model.layer_list[0].layer_fn.sinenet_layer
+        layer_fn = dv_y_model.nn_model.layer_list[0].layer_fn
+        sinenet_layer = layer_fn if self.use_pitch_feed else layer_fn.sinenet_layer
 
         a_val = sinenet_layer.return_a_value()
         phi_val = sinenet_layer.return_phi_value()
@@ -24,19 +24,105 @@ def make_logger(logger_name):
         logger.addHandler(ch)
     return logger
 
-def find_index_list_for_parallel(num_threads, in_file_list):
-    num_files = len(in_file_list)
-    num_files_per_thread = int(num_files/num_threads)
-    index_list = []
-    start_index = 0
-    for i in range(num_threads-1):
-        end_index = start_index + num_files_per_thread
-        index_list.append([start_index, end_index])
-        start_index = start_index + num_files_per_thread
-    end_index = num_files
-    index_list.append([start_index, end_index])
-    assert len(index_list) == num_threads
-    return index_list
+##########################
+# Parallel file executor #
+##########################
+
+# Per-worker state, built once by init_fn in each worker process, e.g. a normaliser or SilenceReducer
+parallel_worker_state = {}
+
+def init_parallel_worker(init_fn, init_args):
+    parallel_worker_state.clear()
+    if init_fn is not None:
+        parallel_worker_state.update(init_fn(*init_args))
+
+def run_parallel_chunk(args):
+    ''' Run process_fn(parallel_worker_state, *task) on every task of a chunk; a failed task is retried num_retries times '''
+    process_fn, chunk, num_retries = args
+    result_list = []
+    for task_idx, task in chunk:
+        for attempt in range(num_retries+1):
+            try:
+                result_list.append((task_idx, True, process_fn(parallel_worker_state, *task)))
+                break
+            except Exception as e:
+                if attempt == num_retries:
+                    result_list.append((task_idx, False, '%s: %s' % (type(e).__name__, str(e))))
+    return result_list
+
+def make_size_aware_chunks(size_list, num_workers, chunks_per_worker=4):
+    ''' Largest tasks first; chunks of about total_size/(num_workers*chunks_per_worker), so long files do not gather in one worker '''
+    ''' Returns a list of index lists, in decreasing total size '''
+    order = sorted(range(len(size_list)), key=lambda i: -size_list[i])
+    target_size = sum(size_list) / float(max(num_workers * chunks_per_worker, 1))
+    chunk_list = []
+    chunk, chunk_size = [], 0.
+    for i in order:
+        chunk.append(i)
+        chunk_size += size_list[i]
+        if chunk_size >= target_size:
+            chunk_list.append(chunk)
+            chunk, chunk_size = [], 0.
+    if len(chunk) > 0:
+        chunk_list.append(chunk)
+    return chunk_list
+
+def get_task_size(task):
+    ''' Size of the first existing file in task; 1 if none '''
+    for x in task:
+        if isinstance(x, str) and os.path.isfile(x):
+            return os.path.getsize(x)
+    return 1
+
+def run_parallel_file_tasks(process_fn, task_list, init_fn=None, init_args=(), num_workers=1, size_list=None, num_retries=1, result_fn=None, task_name='files', log_interval=30.):
+    ''' Run process_fn(worker_state, *task) for every task (a tuple, e.g. (in_file, out_file)) in a process pool '''
+    ''' init_fn(*init_args) returns the worker_state dict, once per worker; process_fn and init_fn must be module-level functions '''
+    ''' result_fn(task, result) is called in this process as tasks finish; raises after all tasks if any failed '''
+    logger = make_logger("parallel_tasks")
+    task_list = [tuple(task) for task in task_list]
+    if size_list is None:
+        size_list = [get_task_size(task) for task in task_list]
+    num_tasks = len(task_list)
+    total_size = float(sum(size_list))
+    chunk_list = make_size_aware_chunks(size_list, num_workers)
+    args_list = [(process_fn, [(i, task_list[i]) for i in chunk], num_retries) for chunk in chunk_list]
+    logger.info('%s: %i %s, %.1f MB, %i chunks, %i workers' % (process_fn.__name__, num_tasks, task_name, total_size / 1048576., len(chunk_list), num_workers))
+
+    num_done, size_done = 0, 0.
+    failed_list = []
+    start_time = time.time()
+    last_log_time = start_time
+
+    def collect(result_list):
+        nonlocal num_done, size_done, last_log_time
+        for task_idx, success, result in result_list:
+            num_done  += 1
+            size_done += size_list[task_idx]
+            if success:
+                if result_fn is not None:
+                    result_fn(task_list[task_idx], result)
+            else:
+                logger.info('Failed %s: %s' % (str(task_list[task_idx]), result))
+                failed_list.append(task_list[task_idx])
+        t = time.time()
+        if (t - last_log_time > log_interval) or (num_done == num_tasks):
+            last_log_time = t
+            elapsed = max(t - start_time, 1e-12)
+            logger.info('%i/%i %s; %.1f %s/s, %.2f MB/s' % (num_done, num_tasks, task_name, num_done / elapsed, task_name, size_done / 1048576. / elapsed))
+
+    if num_workers <= 1:
+        init_parallel_worker(init_fn, init_args)
+        for args in args_list:
+            collect(run_parallel_chunk(args))
+    else:
+        import multiprocessing
+        with multiprocessing.Pool(num_workers, initializer=init_parallel_worker, initargs=(init_fn, init_args)) as p:
+            # Chunks are handed out as workers free up, largest first
+            for result_list in p.imap_unordered(run_parallel_chunk, args_list):
+                collect(result_list)
+
+    if len(failed_list) > 0:
+        raise RuntimeError('%s: %i of %i %s failed after %i retries' % (process_fn.__name__, len(failed_list), num_tasks, task_name, num_retries))
 
 def make_held_out_file_number(last_index, start_index=1):
     held_out_file_number = []
@@ -168,99 +254,289 @@ def clean_directory(target_dir):
 
 def copy_to_scratch(cfg, file_id_list):
     for feat_name in cfg.nn_features:
-        if feat_name == 'wav':
-            # nn_resil_norm_file_list         = prepare_file_path_list(file_id_list, cfg.nn_feat_resil_norm_dirs[feat_name], '.mu.'+feat_name)
-            # nn_resil_norm_file_list_scratch = prepare_file_path_list(file_id_list, cfg.nn_feat_scratch_dirs[feat_name], '.mu.'+feat_name)
-            nn_resil_norm_file_list         = prepare_file_path_list(file_id_list, cfg.nn_feat_resil_norm_dirs[feat_name], '.'+feat_name)
-            nn_resil_norm_file_list_scratch = prepare_file_path_list(file_id_list, cfg.nn_feat_scratch_dirs[feat_name], '.'+feat_name)
-        else:
-            nn_resil_norm_file_list         = prepare_file_path_list(file_id_list, cfg.nn_feat_resil_norm_dirs[feat_name], '.'+feat_name)
-            nn_resil_norm_file_list_scratch = prepare_file_path_list(file_id_list, cfg.nn_feat_scratch_dirs[feat_name], '.'+feat_name)
+        # Mu-law wav is a loader transform (dv_y_cfg.mu_law_bits), there are no .mu. files to copy
+        nn_resil_norm_file_list         = prepare_file_path_list(file_id_list, cfg.nn_feat_resil_norm_dirs[feat_name], '.'+feat_name)
+        nn_resil_norm_file_list_scratch = prepare_file_path_list(file_id_list, cfg.nn_feat_scratch_dirs[feat_name], '.'+feat_name)
+
+        run_parallel_file_tasks(copy_file_worker, zip(nn_resil_norm_file_list, nn_resil_norm_file_list_scratch), num_workers=cfg.num_workers, task_name=feat_name+' files')
 
-        for x, y in zip(nn_resil_norm_file_list, nn_resil_norm_file_list_scratch):
-            shutil.copyfile(x, y)
+def copy_file_worker(worker_state, in_file_name, out_file_name):
+    shutil.copyfile(in_file_name, out_file_name)
 
 def check_within_range(in_data, value_max, value_min):
-    temp_max = max(in_data)
-    temp_min = min(in_data)
+    temp_max = numpy.max(in_data)
+    temp_min = numpy.min(in_data)
     assert temp_max <= value_max
     assert temp_min >= value_min
 
-def reduce_silence_reaper_output(cfg, reaper_output_file='/home/dawna/tts/mw545/Data/Data_Voicebank_48kHz_Pitch/p7_345.used.pm', label_align_file='/data/vectra2/tts/mw545/Data/data_voicebank/label_state_align/p7_345.lab', out_file='/home/dawna/tts/mw545/Data/Data_Voicebank_48kHz_Pitch_Resil/p7_345.pm', silence_pattern=['*-#+*']):
-    logger = make_logger("reduce_silence_reaper")
-    from frontend.silence_reducer_keep_sil import SilenceReducer
-    remover = SilenceReducer(n_cmp = 1, silence_pattern = silence_pattern)
-    nonsilence_indices = remover.load_alignment(label_align_file)
-    start_time = float(nonsilence_indices[0]) / float(cfg.frame_sr)
-    end_time   = float(nonsilence_indices[-1]+1.) / float(cfg.frame_sr)
+##########################
+# Silence boundary index #
+##########################
+
+class Silence_Index(object):
+    ''' First and last+1 non-silence frame (at frame_sr) of each file, by file id; label files are parsed once per corpus '''
+    ''' file_stat keeps size and mtime_ns of the label file each entry was parsed from; see is_current '''
+    def __init__(self, file_id_list=[], boundary_list=[], silence_pattern=['*-#+*'], file_stat_list=None):
+        self.silence_pattern = list(silence_pattern)
+        self.file_id_list = list(file_id_list)
+        self.file_index_dict = {file_id: i for i, file_id in enumerate(self.file_id_list)}
+        self.boundary = numpy.array(boundary_list, dtype=numpy.int32).reshape(-1, 2)
+        if file_stat_list is None:
+            # Unknown; entries are stale until re-parsed
+            file_stat_list = numpy.zeros((len(self.file_id_list), 2))
+        self.file_stat = numpy.array(file_stat_list, dtype=numpy.int64).reshape(-1, 2)
+
+    def __contains__(self, file_id):
+        return file_id in self.file_index_dict
+
+    def get_boundary(self, file_id):
+        ''' (start, end): non-silence frames are start to end-1 '''
+        start, end = self.boundary[self.file_index_dict[file_id]]
+        return int(start), int(end)
+
+    def is_current(self, label_align_file):
+        ''' True if the entry of this label file exists and was parsed from its current size and mtime '''
+        file_id = get_file_id_from_label_align_file(label_align_file)
+        if file_id not in self.file_index_dict:
+            return False
+        return list(self.file_stat[self.file_index_dict[file_id]]) == list(get_label_file_stat(label_align_file))
+
+    def merge(self, other):
+        ''' Entries of other replace those of the same file id '''
+        entry_dict = {file_id: (self.boundary[i], self.file_stat[i]) for i, file_id in enumerate(self.file_id_list)}
+        entry_dict.update({file_id: (other.boundary[i], other.file_stat[i]) for i, file_id in enumerate(other.file_id_list)})
+        file_id_list = list(entry_dict.keys())
+        self.__init__(file_id_list, [entry_dict[x][0] for x in file_id_list], self.silence_pattern, [entry_dict[x][1] for x in file_id_list])
+
+    def save(self, index_file):
+        with open(index_file, 'wb') as f:
+            numpy.savez(f, file_id=numpy.array(self.file_id_list, dtype=str), boundary=self.boundary, silence_pattern=numpy.array(self.silence_pattern, dtype=str), file_stat=self.file_stat)
+
+def load_silence_index(index_file):
+    index_data = numpy.load(index_file)
+    # Index files without file_stat: every entry is re-parsed once
+    file_stat_list = index_data['file_stat'] if 'file_stat' in index_data.files else None
+    return Silence_Index(index_data['file_id'].tolist(), index_data['boundary'], index_data['silence_pattern'].tolist(), file_stat_list)
+
+def get_file_id_from_label_align_file(label_align_file):
+    return os.path.basename(label_align_file).split('.')[0]
+
+def get_label_file_stat(label_align_file):
+    st = os.stat(label_align_file)
+    return (st.st_size, st.st_mtime_ns)
+
+def silence_boundary_worker(worker_state, label_align_file):
+    nonsilence_indices = worker_state['remover'].load_alignment(label_align_file)
+    return (int(nonsilence_indices[0]), int(nonsilence_indices[-1]) + 1)
+
+def build_silence_index(cfg, label_align_file_list, silence_pattern=['*-#+*']):
+    ''' Parses label_align_file_list in parallel; file ids are the label file names '''
+    # Stat before parsing: a file changed while parsing is stale next time
+    file_stat_list = [get_label_file_stat(x) for x in label_align_file_list]
+    boundary_dict = {}
+    def add_boundary(task, boundary):
+        boundary_dict[task[0]] = boundary
+    run_parallel_file_tasks(silence_boundary_worker, [(x,) for x in label_align_file_list], init_silence_reducer_worker, (cfg, 1, silence_pattern), num_workers=cfg.num_workers, result_fn=add_boundary, task_name='label files')
+    return Silence_Index([get_file_id_from_label_align_file(x) for x in label_align_file_list], [boundary_dict[x] for x in label_align_file_list], silence_pattern, file_stat_list)
+
+def make_silence_index(cfg, label_align_file_list, silence_pattern=['*-#+*']):
+    ''' Updates cfg.silence_index_file with files not yet in it or changed since parsed, or rebuilds it for a new silence_pattern; returns the file name '''
+    logger = make_logger("make_silence_index")
+    silence_index = None
+    if os.path.exists(cfg.silence_index_file):
+        silence_index = load_silence_index(cfg.silence_index_file)
+        if silence_index.silence_pattern != list(silence_pattern):
+            silence_index = None
+    if silence_index is None:
+        new_file_list = list(label_align_file_list)
+    else:
+        new_file_list = [x for x in label_align_file_list if not silence_index.is_current(x)]
+    if len(new_file_list) > 0:
+        logger.info('Parsing %i label files' % len(new_file_list))
+        new_silence_index = build_silence_index(cfg, new_file_list, silence_pattern)
+        if silence_index is None:
+            silence_index = new_silence_index
+        else:
+            silence_index.merge(new_silence_index)
+        silence_index.save(cfg.silence_index_file)
+    return cfg.silence_index_file
+
+def load_nonsilence_boundary(worker_state, label_align_file):
+    ''' From the silence index of the worker if it has the file, else parsed from the label file '''
+    silence_index = worker_state.get('silence_index', None)
+    file_id = get_file_id_from_label_align_file(label_align_file)
+    if (silence_index is not None) and (file_id in silence_index):
+        return silence_index.get_boundary(file_id)
+    return silence_boundary_worker(worker_state, label_align_file)
+
+def read_reaper_output(reaper_output_file):
+    ''' REAPER pitch-mark text to [N, 3] float64: time stamp, vuv, F0 value; header lines are skipped '''
     with open(reaper_output_file, 'r') as f:
         file_lines = f.readlines()
-    with open(out_file, 'w') as f:
-        for l in file_lines:
-            x = l.strip().split(' ')
-            # Content lines should have 3 values
-            # Time stamp, vuv, F0 value
-            if len(x) == 3:
-                t = float(x[0])
-                if (t >= start_time) and (t <= end_time):
-                    t_new = t - start_time
-                    f.write(str(t_new)+' '+x[1]+' '+x[2]+'\n')
-
-def reduce_silence_reaper_output_list(cfg, file_id_list, reaper_output_dir, label_align_dir, out_dir, reaper_output_ext='.used.pm', label_align_ext='.lab', out_ext='.pm', silence_pattern=['*-#+*']):
+    # Content lines should have 3 values
+    content_lines = [l for l in file_lines if len(l.strip().split(' ')) == 3]
+    if len(content_lines) == 0:
+        return numpy.zeros((0, 3))
+    return numpy.array(' '.join(content_lines).split(), dtype=numpy.float64).reshape(-1, 3)
+
+def save_pitch_data(pitch_file, pitch_data):
+    ''' Binary pitch store: [N, 3] float64, time stamp (sorted), vuv, F0 value '''
+    numpy.array(pitch_data, dtype=numpy.float64).tofile(pitch_file)
+
+def load_pitch_data(pitch_file):
+    return numpy.fromfile(pitch_file, dtype=numpy.float64).reshape(-1, 3)
+
+def reduce_silence_reaper_output(cfg, reaper_output_file='/home/dawna/tts/mw545/Data/Data_Voicebank_48kHz_Pitch/p7_345.used.pm', label_align_file='/data/vectra2/tts/mw545/Data/data_voicebank/label_state_align/p7_345.lab', out_file='/home/dawna/tts/mw545/Data/Data_Voicebank_48kHz_Pitch_Resil/p7_345.pitch', silence_pattern=['*-#+*'], worker_state=None):
+    ''' Keeps pitch marks within the non-silence part, times relative to its start; written as a binary pitch store '''
+    if worker_state is None:
+        worker_state = init_silence_reducer_worker(cfg, 1, silence_pattern)
+    nonsilence_start, nonsilence_end = load_nonsilence_boundary(worker_state, label_align_file)
+    start_time = float(nonsilence_start) / float(cfg.frame_sr)
+    end_time   = float(nonsilence_end) / float(cfg.frame_sr)
+    pitch_data = read_reaper_output(reaper_output_file)
+    pitch_data = pitch_data[(pitch_data[:, 0] >= start_time) & (pitch_data[:, 0] <= end_time)]
+    pitch_data[:, 0] -= start_time
+    save_pitch_data(out_file, pitch_data[numpy.argsort(pitch_data[:, 0], kind='stable')])
+
+def reduce_silence_reaper_output_list(cfg, file_id_list, reaper_output_dir, label_align_dir, out_dir, reaper_output_ext='.used.pm', label_align_ext='.lab', out_ext='.pitch', silence_pattern=['*-#+*']):
+    task_list = []
     for file_id in file_id_list:
         reaper_output_file = os.path.join(reaper_output_dir, file_id + reaper_output_ext)
         label_align_file   = os.path.join(label_align_dir, file_id + label_align_ext)
         out_file           = os.path.join(out_dir, file_id + out_ext)
-        reduce_silence_reaper_output(cfg, reaper_output_file, label_align_file, out_file, silence_pattern)
+        task_list.append((reaper_output_file, label_align_file, out_file))
+    silence_index_file = make_silence_index(cfg, [x[1] for x in task_list], silence_pattern)
+    run_parallel_file_tasks(reduce_silence_reaper_output_worker, task_list, init_silence_reducer_worker, (cfg, 1, silence_pattern, silence_index_file), num_workers=cfg.num_workers)
 
-def reduce_silence_list(cfg, feature_dim, in_file_list, label_align_file_list, out_file_list, silence_pattern=['*-#+*']):
-    logger = make_logger("reduce_silence_list")
+def init_silence_reducer_worker(cfg, feature_dim, silence_pattern, silence_index_file=None):
     from frontend.silence_reducer_keep_sil import SilenceReducer
-    remover = SilenceReducer(n_cmp = feature_dim, silence_pattern = silence_pattern)
-    remover.reduce_silence(in_file_list, label_align_file_list, out_file_list, frames_silence_to_keep=cfg.frames_silence_to_keep,sil_pad=cfg.sil_pad)
+    worker_state = {'cfg': cfg, 'feature_dim': feature_dim, 'total_sil_one_side': cfg.frames_silence_to_keep + cfg.sil_pad}
+    worker_state['remover'] = SilenceReducer(n_cmp = feature_dim, silence_pattern = silence_pattern)
+    if silence_index_file is not None:
+        worker_state['silence_index'] = load_silence_index(silence_index_file)
+    return worker_state
 
-def compute_min_max_normaliser(feature_dim, in_file_list, norm_file, min_value=0.01, max_value=0.99):
+def reduce_silence_worker(worker_state, in_file, label_align_file, out_file):
+    from io_funcs.binary_io import BinaryIOCollection
+    BIC = BinaryIOCollection()
+    BIC.array_to_binary_file(load_resil_data(worker_state, in_file, label_align_file), out_file)
+
+def reduce_silence_reaper_output_worker(worker_state, reaper_output_file, label_align_file, out_file):
+    reduce_silence_reaper_output(worker_state['cfg'], reaper_output_file, label_align_file, out_file, worker_state=worker_state)
+
+def reduce_silence_list(cfg, feature_dim, in_file_list, label_align_file_list, out_file_list, silence_pattern=['*-#+*'], num_workers=None):
+    ''' Same silence reduction as the fused resil_norm_list, with boundaries from the silence index '''
+    if num_workers is None: num_workers = cfg.num_workers
+    label_align_file_list = list(label_align_file_list)
+    silence_index_file = make_silence_index(cfg, label_align_file_list, silence_pattern)
+    run_parallel_file_tasks(reduce_silence_worker, zip(in_file_list, label_align_file_list, out_file_list), init_silence_reducer_worker, (cfg, feature_dim, silence_pattern, silence_index_file), num_workers=num_workers)
+
+#######################
+# Feature statistics  #
+#######################
+
+class Feat_Stats(object):
+    ''' Frame count, mean, sum of squared deviations (M2), min and max per dimension; is_binary if all values are 0 or 1 '''
+    ''' Built in one pass; two Feat_Stats merge exactly (Chan et al.), so shards and new speakers add up '''
+    def __init__(self, feature_dim):
+        self.feature_dim = feature_dim
+        self.n    = 0
+        self.mean = numpy.zeros(feature_dim)
+        self.m2   = numpy.zeros(feature_dim)
+        self.min  = numpy.full(feature_dim, numpy.inf)
+        self.max  = numpy.full(feature_dim, -numpy.inf)
+        self.is_binary = numpy.ones(feature_dim, dtype=bool)
+
+    def add_data(self, data_T_D):
+        data_T_D = numpy.asarray(data_T_D, dtype=numpy.float64)
+        if data_T_D.shape[0] == 0:
+            return
+        other = Feat_Stats(self.feature_dim)
+        other.n    = data_T_D.shape[0]
+        other.mean = numpy.mean(data_T_D, axis=0)
+        other.m2   = numpy.sum((data_T_D - other.mean) ** 2, axis=0)
+        other.min  = numpy.min(data_T_D, axis=0)
+        other.max  = numpy.max(data_T_D, axis=0)
+        other.is_binary = numpy.all((data_T_D == 0.) | (data_T_D == 1.), axis=0)
+        self.merge(other)
+
+    def add_file(self, file_name):
+        from io_funcs.binary_io import BinaryIOCollection
+        BIC = BinaryIOCollection()
+        features, frame_number = BIC.load_binary_file_frame(file_name, self.feature_dim)
+        self.add_data(features)
+
+    def merge(self, other):
+        if other.n == 0:
+            return
+        n = self.n + other.n
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * (other.n / float(n))
+        self.m2   = self.m2 + other.m2 + delta ** 2 * (self.n * other.n / float(n))
+        self.n    = n
+        self.min  = numpy.minimum(self.min, other.min)
+        self.max  = numpy.maximum(self.max, other.max)
+        self.is_binary = self.is_binary & other.is_binary
+
+    def std(self):
+        ''' Divided by n, same as MeanVarianceNorm.compute_std '''
+        return numpy.sqrt(self.m2 / max(self.n, 1))
+
+    def save(self, stats_file):
+        with open(stats_file, 'wb') as f:
+            pickle.dump({'feature_dim': self.feature_dim, 'n': self.n, 'mean': self.mean, 'm2': self.m2, 'min': self.min, 'max': self.max, 'is_binary': self.is_binary}, f)
+
+    def load(self, stats_file):
+        with open(stats_file, 'rb') as f:
+            stats_dict = pickle.load(f)
+        assert stats_dict['feature_dim'] == self.feature_dim
+        for k in ['n', 'mean', 'm2', 'min', 'max']:
+            setattr(self, k, stats_dict[k])
+        # Older sidecars have no is_binary; no dimension is then taken as binary
+        self.is_binary = stats_dict.get('is_binary', numpy.zeros(self.feature_dim, dtype=bool))
+
+def make_feat_stats_file_name(norm_file):
+    ''' Sidecar of a *_info.dat file; keeps frame count and M2, so new files can be added later '''
+    return norm_file + '.stats'
+
+def init_feat_stats_worker(feature_dim):
+    return {'feature_dim': feature_dim}
+
+def feat_stats_worker(worker_state, in_file_name):
+    feat_stats = Feat_Stats(worker_state['feature_dim'])
+    feat_stats.add_file(in_file_name)
+    return feat_stats
+
+def compute_feat_stats_list(feature_dim, in_file_list, num_workers=1, feat_stats=None):
+    ''' One pass over in_file_list, sharded over num_workers processes; merged into feat_stats if given '''
+    if feat_stats is None:
+        feat_stats = Feat_Stats(feature_dim)
+    run_parallel_file_tasks(feat_stats_worker, [(x,) for x in in_file_list], init_feat_stats_worker, (feature_dim,), num_workers=num_workers, result_fn=lambda task, file_stats: feat_stats.merge(file_stats))
+    return feat_stats
+
+def save_min_max_normaliser(feat_stats, norm_file):
     logger = make_logger("compute_min_max_normaliser")
-    from frontend.min_max_norm import MinMaxNormalisation
-    min_max_normaliser = MinMaxNormalisation(feature_dimension=feature_dim, min_value=min_value, max_value=max_value)
-    min_max_normaliser.find_min_max_values(in_file_list)
-    min_vector = min_max_normaliser.min_vector
-    max_vector = min_max_normaliser.max_vector
-
+    min_vector = feat_stats.min.reshape(1, -1)
+    max_vector = feat_stats.max.reshape(1, -1)
     norm_info = numpy.concatenate((min_vector, max_vector), axis=0)
     norm_info = numpy.array(norm_info, 'float32')
     fid = open(norm_file, 'wb')
     norm_info.tofile(fid)
     fid.close()
+    feat_stats.save(make_feat_stats_file_name(norm_file))
     logger.info('saved %s vectors to %s' %(min_vector.size, norm_file))
 
-def perform_min_max_normlisation_list(feature_dim, norm_file, in_file_list, out_file_list, min_value=0.01, max_value=0.99):
-    logger = make_logger("perform_min_max_normlisation_list")
-    from frontend.min_max_norm import MinMaxNormalisation
-    min_max_normaliser = MinMaxNormalisation(feature_dimension=feature_dim, min_value=min_value, max_value=max_value)
-    if norm_file is None:
-        compute_min_max_normaliser(feature_dim, in_file_list, norm_file, min_value, max_value)
-    min_max_normaliser.load_min_max_values(norm_file)
-    min_max_normaliser.normalise_data(in_file_list, out_file_list)
-
-def perform_min_max_denormlisation_list(feature_dim, norm_file, in_file_list, out_file_list, min_value=0.01, max_value=0.99):
-    from frontend.min_max_norm import MinMaxNormalisation
-    min_max_normaliser = MinMaxNormalisation(feature_dimension=feature_dim, min_value=min_value, max_value=max_value)
-    min_max_normaliser.load_min_max_values(norm_file)
-    min_max_normaliser.denormalise_data(in_file_list, out_file_list)
-
-def compute_mean_var_normaliser(feature_dim, in_file_list, norm_file, var_file_dict=None, acoustic_out_dimension_dict=None):
+def save_mean_var_normaliser(feat_stats, norm_file, var_file_dict=None, acoustic_out_dimension_dict=None):
     logger = make_logger("compute_mean_var_normaliser")
-    from frontend.mean_variance_norm import MeanVarianceNorm
-    mean_var_normaliser = MeanVarianceNorm(feature_dimension=feature_dim)
-    mean_vector = mean_var_normaliser.compute_mean(in_file_list, 0, feature_dim)
-    std_vector  = mean_var_normaliser.compute_std(in_file_list, mean_vector, 0, feature_dim)
+    mean_vector = feat_stats.mean.reshape(1, -1)
+    std_vector  = feat_stats.std().reshape(1, -1)
 
     norm_info = numpy.concatenate((mean_vector, std_vector), axis=0)
     norm_info = numpy.array(norm_info, 'float32')
     fid = open(norm_file, 'wb')
     norm_info.tofile(fid)
     fid.close()
+    feat_stats.save(make_feat_stats_file_name(norm_file))
     logger.info('saved %s vectors to %s' %('MVN', norm_file))
 
     # Store variance for each feature separately
@@ -276,13 +552,66 @@ def compute_mean_var_normaliser(feature_dim, in_file_list, norm_file, var_file_d
             logger.info('saved %s variance vector to %s' %(feature_name, var_file_dict[feature_name]))
             feature_index += acoustic_out_dimension_dict[feature_name]
 
-def perform_mean_var_normlisation_list(feature_dim, norm_file, in_file_list, out_file_list):
-    from frontend.mean_variance_norm import MeanVarianceNorm
-    mean_var_normaliser = MeanVarianceNorm(feature_dimension=feature_dim)
+def compute_min_max_normaliser(feature_dim, in_file_list, norm_file, min_value=0.01, max_value=0.99, num_workers=1):
+    ''' Saves data min and max; min_value and max_value are the normalised range, used by perform_min_max_normlisation_list '''
+    feat_stats = compute_feat_stats_list(feature_dim, in_file_list, num_workers)
+    save_min_max_normaliser(feat_stats, norm_file)
+
+def perform_min_max_normlisation_list(feature_dim, norm_file, in_file_list, out_file_list, min_value=0.01, max_value=0.99, num_workers=1):
+    logger = make_logger("perform_min_max_normlisation_list")
+    if norm_file is None:
+        compute_min_max_normaliser(feature_dim, in_file_list, norm_file, min_value, max_value)
+    run_parallel_file_tasks(min_max_normlisation_worker, zip(in_file_list, out_file_list), init_min_max_normaliser_worker, (feature_dim, norm_file, min_value, max_value), num_workers=num_workers)
+
+def init_min_max_normaliser_worker(feature_dim, norm_file, min_value, max_value):
+    from frontend.min_max_norm import MinMaxNormalisation
+    min_max_normaliser = MinMaxNormalisation(feature_dimension=feature_dim, min_value=min_value, max_value=max_value)
+    min_max_normaliser.load_min_max_values(norm_file)
+    return {'normaliser': min_max_normaliser}
+
+def min_max_normlisation_worker(worker_state, in_file, out_file):
+    worker_state['normaliser'].normalise_data([in_file], [out_file])
+
+def perform_min_max_denormlisation_list(feature_dim, norm_file, in_file_list, out_file_list, min_value=0.01, max_value=0.99):
+    from frontend.min_max_norm import MinMaxNormalisation
+    min_max_normaliser = MinMaxNormalisation(feature_dimension=feature_dim, min_value=min_value, max_value=max_value)
+    min_max_normaliser.load_min_max_values(norm_file)
+    min_max_normaliser.denormalise_data(in_file_list, out_file_list)
+
+def compute_mean_var_normaliser(feature_dim, in_file_list, norm_file, var_file_dict=None, acoustic_out_dimension_dict=None, num_workers=1):
+    feat_stats = compute_feat_stats_list(feature_dim, in_file_list, num_workers)
+    save_mean_var_normaliser(feat_stats, norm_file, var_file_dict, acoustic_out_dimension_dict)
+
+def update_normaliser(feature_dim, new_file_list, norm_file, norm_type='MeanVar', var_file_dict=None, acoustic_out_dimension_dict=None, num_workers=1):
+    ''' Add statistics of new files (e.g. new speakers) to an existing norm_file; only the new files are read '''
+    ''' Needs the .stats sidecar written with norm_file '''
+    logger = make_logger("update_normaliser")
+    stats_file = make_feat_stats_file_name(norm_file)
+    if not os.path.exists(stats_file):
+        raise IOError('No statistics file %s; compute the normaliser on the full list once first' % stats_file)
+    feat_stats = Feat_Stats(feature_dim)
+    feat_stats.load(stats_file)
+    n_old = feat_stats.n
+    compute_feat_stats_list(feature_dim, new_file_list, num_workers, feat_stats)
+    logger.info('%i new files, %i frames added to %i frames' % (len(new_file_list), feat_stats.n - n_old, n_old))
+    if norm_type == 'MinMax':
+        save_min_max_normaliser(feat_stats, norm_file)
+    elif norm_type == 'MeanVar':
+        save_mean_var_normaliser(feat_stats, norm_file, var_file_dict, acoustic_out_dimension_dict)
+
+def perform_mean_var_normlisation_list(feature_dim, norm_file, in_file_list, out_file_list, num_workers=1):
     if norm_file is None:
         compute_mean_var_normaliser(feature_dim, in_file_list, norm_file, var_file_dict=None, acoustic_out_dimension_dict=None)
+    run_parallel_file_tasks(mean_var_normlisation_worker, zip(in_file_list, out_file_list), init_mean_var_normaliser_worker, (feature_dim, norm_file), num_workers=num_workers)
+
+def init_mean_var_normaliser_worker(feature_dim, norm_file):
+    from frontend.mean_variance_norm import MeanVarianceNorm
+    mean_var_normaliser = MeanVarianceNorm(feature_dimension=feature_dim)
     mean_var_normaliser.load_mean_var_values(norm_file)
-    mean_var_normaliser.feature_normalisation(in_file_list, out_file_list)
+    return {'normaliser': mean_var_normaliser}
+
+def mean_var_normlisation_worker(worker_state, in_file, out_file):
+    worker_state['normaliser'].feature_normalisation([in_file], [out_file])
 
 def perform_mean_var_denormlisation_list(feature_dim, norm_file, in_file_list, out_file_list):
     from frontend.mean_variance_norm import MeanVarianceNorm
@@ -290,6 +619,275 @@ def perform_mean_var_denormlisation_list(feature_dim, norm_file, in_file_list, o
     mean_var_normaliser.load_mean_var_values(norm_file)
     mean_var_normaliser.feature_denormalisation(in_file_list, out_file_list, mean_var_normaliser.mean_vector, mean_var_normaliser.std_vector)
 
+#######################
+# Feature file codecs #
+#######################
+
+# Storage type of each codec; codec_info.json in the feature directory gives codec name and per-dimension scale and offset
+# Stored code c decodes to c * scale + offset (mulaw8: mu-law expanded code, then * scale + offset)
+# float32, float16: normalised features; int16, mulaw8: PCM wav samples, the normaliser is the scale and offset
+# bitpack: binary (0/1) dimensions, binary_mask in codec_info, as packed bits per frame, then the other dimensions as float32
+feat_codec_dtype_dict = {'float32': numpy.float32, 'float16': numpy.float16, 'int16': numpy.int16, 'mulaw8': numpy.uint8, 'bitpack': numpy.uint8}
+
+def make_codec_info_file_name(feat_dir):
+    return os.path.join(feat_dir, 'codec_info.json')
+
+def save_codec_info(feat_dir, codec_name, scale, offset, binary_mask=None):
+    import json
+    codec_info = {'codec_name': codec_name, 'scale': numpy.asarray(scale, dtype=numpy.float64).tolist(), 'offset': numpy.asarray(offset, dtype=numpy.float64).tolist()}
+    if binary_mask is not None:
+        codec_info['binary_mask'] = numpy.asarray(binary_mask, dtype=bool).tolist()
+    with open(make_codec_info_file_name(feat_dir), 'w') as f:
+        json.dump(codec_info, f)
+
+def load_codec_info(feat_dir):
+    ''' None if there is no codec_info.json, i.e. plain float32 files '''
+    import json
+    codec_info_file = make_codec_info_file_name(feat_dir)
+    if not os.path.exists(codec_info_file):
+        return None
+    with open(codec_info_file, 'r') as f:
+        codec_info = json.load(f)
+    codec_info['scale']  = numpy.array(codec_info['scale'])
+    codec_info['offset'] = numpy.array(codec_info['offset'])
+    if 'binary_mask' in codec_info:
+        codec_info['binary_mask'] = numpy.array(codec_info['binary_mask'], dtype=bool)
+    return codec_info
+
+mu_law_table_cache = {}
+
+def make_mu_law_encode_table(num_bits=8, mu_value=255.):
+    ''' Mu-law code of each 16-bit linear PCM value, indexed by PCM + 32768; num_bits 8 (uint8 codes) or 16 (uint16 codes) '''
+    key = ('encode', num_bits, mu_value)
+    if key not in mu_law_table_cache:
+        x_unit = (numpy.arange(65536) - 32768.) / 32768.
+        y = numpy.sign(x_unit) * numpy.log1p(mu_value * numpy.abs(x_unit)) / numpy.log1p(mu_value)
+        half_levels = (2 ** num_bits - 1) / 2.
+        code_dtype = numpy.uint8 if num_bits <= 8 else numpy.uint16
+        mu_law_table_cache[key] = numpy.array(numpy.rint((y + 1.) * half_levels), dtype=code_dtype)
+    return mu_law_table_cache[key]
+
+def make_mu_law_decode_table(num_bits=8, mu_value=255.):
+    ''' Linear value in [-1, 1] of each mu-law code '''
+    key = ('decode', num_bits, mu_value)
+    if key not in mu_law_table_cache:
+        y = numpy.arange(2 ** num_bits) / ((2 ** num_bits - 1) / 2.) - 1.
+        mu_law_table_cache[key] = numpy.sign(y) * (numpy.power(1. + mu_value, numpy.abs(y)) - 1.) / mu_value
+    return mu_law_table_cache[key]
+
+def make_pcm_index(x_unit):
+    ''' [-1, 1] to 16-bit PCM table index, 0 to 65535 '''
+    return numpy.clip(numpy.rint(numpy.asarray(x_unit) * 32768.), -32768, 32767).astype(numpy.int64) + 32768
+
+def mu_law_encode(x_unit, num_bits=8, mu_value=255.):
+    ''' [-1, 1] to mu-law codes, via the 16-bit PCM table '''
+    return make_mu_law_encode_table(num_bits, mu_value)[make_pcm_index(x_unit)]
+
+def mu_law_decode(code, num_bits=8, mu_value=255.):
+    ''' Mu-law codes to linear values in [-1, 1] '''
+    return make_mu_law_decode_table(num_bits, mu_value)[code]
+
+def make_mu_law_transform_table(num_bits=8, mu_value=255.):
+    ''' Companded value in [-1, 1] of each 16-bit PCM index; the in-loader mu-law transform '''
+    key = ('transform', num_bits, mu_value)
+    if key not in mu_law_table_cache:
+        half_levels = (2 ** num_bits - 1) / 2.
+        mu_law_table_cache[key] = numpy.array(make_mu_law_encode_table(num_bits, mu_value) / half_levels - 1., dtype=numpy.float32)
+    return mu_law_table_cache[key]
+
+def check_feat_codec(feat_name, codec_name):
+    ''' int16 and mulaw8 quantise PCM samples; on other features they lose precision silently '''
+    if codec_name in ['int16', 'mulaw8'] and feat_name != 'wav':
+        raise ValueError('Codec %s is for wav only, not %s; use float32, float16 or bitpack' % (codec_name, feat_name))
+
+def make_codec_scale_offset(codec_name, norm_scale, norm_offset, binary_mask=None):
+    ''' Codec scale and offset, from the normaliser: normalised = raw * norm_scale + norm_offset '''
+    ''' Feature and codec are checked by check_feat_codec, where the codec is chosen '''
+    if codec_name in ['float32', 'float16']:
+        return numpy.ones_like(norm_scale), numpy.zeros_like(norm_offset)
+    elif codec_name == 'bitpack':
+        # Bits are raw values of binary dimensions; other dimensions are stored normalised
+        return numpy.where(binary_mask, norm_scale, 1.), numpy.where(binary_mask, norm_offset, 0.)
+    elif codec_name == 'int16':
+        return norm_scale, norm_offset
+    elif codec_name == 'mulaw8':
+        return norm_scale * 32768., norm_offset
+    raise ValueError('Unknown codec %s' % codec_name)
+
+def encode_features(norm_features, codec_name, scale, offset, binary_mask=None):
+    ''' Normalised features to stored codes; inverse of the decode affine '''
+    if codec_name in ['float32', 'float16']:
+        return numpy.array(norm_features, dtype=feat_codec_dtype_dict[codec_name])
+    elif codec_name == 'bitpack':
+        return encode_bitpack_features(norm_features, scale, offset, binary_mask)
+    x_unit = (numpy.asarray(norm_features, dtype=numpy.float64) - offset) / scale
+    if codec_name == 'int16':
+        return numpy.array(numpy.clip(numpy.rint(x_unit), -32768, 32767), dtype=numpy.int16)
+    elif codec_name == 'mulaw8':
+        return mu_law_encode(x_unit, num_bits=8)
+
+def encode_bitpack_features(norm_features, scale, offset, binary_mask):
+    ''' [T, D] normalised features to uint8 [T, ceil(num_binary/8) + 4*num_other] '''
+    norm_features = numpy.asarray(norm_features, dtype=numpy.float64)
+    bits = (norm_features[:, binary_mask] - offset[binary_mask]) / scale[binary_mask]
+    bits_int = numpy.rint(bits)
+    if not numpy.all(((bits_int == 0.) | (bits_int == 1.)) & (numpy.abs(bits - bits_int) < 1e-3)):
+        raise ValueError('bitpack: a binary dimension has a value other than 0 or 1; rebuild codec_info.json with this file in in_file_list')
+    packed  = numpy.packbits(bits_int.astype(numpy.uint8), axis=1)
+    numeric = numpy.ascontiguousarray(norm_features[:, ~binary_mask], dtype=numpy.float32).view(numpy.uint8)
+    return numpy.concatenate([packed, numeric.reshape(norm_features.shape[0], -1)], axis=1)
+
+def binary_dim_worker(worker_state, in_file, feature_dim):
+    ''' Dimensions whose values in in_file are all 0 or 1 '''
+    from io_funcs.binary_io import BinaryIOCollection
+    BIC = BinaryIOCollection()
+    features, frame_number = BIC.load_binary_file_frame(in_file, feature_dim)
+    return numpy.all((features == 0.) | (features == 1.), axis=0)
+
+def make_bitpack_binary_mask(feature_dim, norm_file, in_file_list=[], num_workers=1):
+    ''' Binary dimensions from the .stats sidecar of norm_file: all training values are 0 or 1 '''
+    ''' Dimensions with other values in any of in_file_list, e.g. held-out files, are stored as float32 instead '''
+    logger = make_logger("make_bitpack_binary_mask")
+    stats_file = make_feat_stats_file_name(norm_file)
+    if not os.path.exists(stats_file):
+        raise IOError('bitpack needs %s; recompute the normaliser' % stats_file)
+    feat_stats = Feat_Stats(feature_dim)
+    feat_stats.load(stats_file)
+    binary_mask = numpy.array(feat_stats.is_binary, dtype=bool)
+    if len(in_file_list) > 0:
+        file_binary_mask = numpy.ones(feature_dim, dtype=bool)
+        def merge_binary_dim(task, file_is_binary):
+            file_binary_mask[:] = file_binary_mask & file_is_binary
+        run_parallel_file_tasks(binary_dim_worker, [(x, feature_dim) for x in in_file_list], num_workers=num_workers, result_fn=merge_binary_dim, task_name='bitpack files')
+        num_float = int(numpy.sum(binary_mask & ~file_binary_mask))
+        if num_float > 0:
+            logger.info('%i dimensions are binary in training files only; stored as float32' % num_float)
+        binary_mask = binary_mask & file_binary_mask
+    return binary_mask
+
+def make_codec_params(codec_name, feature_dim, norm_file, norm_type, min_value, max_value, binary_mask=None):
+    ''' Normaliser scale and offset, and the codec scale, offset and binary mask (None unless bitpack) '''
+    ''' bitpack: binary_mask is normally that of codec_info.json; if None, from the .stats sidecar only '''
+    scale, offset = load_normaliser_values(feature_dim, norm_file, norm_type, min_value, max_value)
+    if (codec_name == 'bitpack') and (binary_mask is None):
+        binary_mask = make_bitpack_binary_mask(feature_dim, norm_file)
+    elif codec_name != 'bitpack':
+        binary_mask = None
+    codec_scale, codec_offset = make_codec_scale_offset(codec_name, scale, offset, binary_mask)
+    return {'scale': scale, 'offset': offset, 'codec_scale': codec_scale, 'codec_offset': codec_offset, 'binary_mask': binary_mask}
+
+#########################################
+# Fused silence reduction and normalise #
+#########################################
+
+def reduce_silence_data(features, nonsilence_boundary, total_sil_one_side):
+    ''' In-memory silence reduction: keep total_sil_one_side frames before the first and after the last non-silence frame '''
+    ''' nonsilence_boundary is (start, end), see Silence_Index; if the file has less silence, edge frames are repeated '''
+    start_index = nonsilence_boundary[0] - total_sil_one_side
+    end_index   = nonsilence_boundary[1] + total_sil_one_side
+    num_frames  = features.shape[0]
+    features = features[max(start_index, 0):min(end_index, num_frames)]
+    if (start_index < 0) or (end_index > num_frames):
+        features = numpy.pad(features, ((max(-start_index, 0), max(end_index - num_frames, 0)), (0, 0)), mode='edge')
+    return features
+
+def load_normaliser_values(feature_dim, norm_file, norm_type, min_value=0.01, max_value=0.99):
+    ''' Returns scale and offset: normalised = features * scale + offset; same maths as MinMaxNormalisation and MeanVarianceNorm '''
+    norm_info = numpy.fromfile(norm_file, dtype=numpy.float32).reshape(2, feature_dim).astype(numpy.float64)
+    return make_normaliser_scale_offset(norm_info, norm_type, min_value, max_value)
+
+def load_stats_normaliser_values(feature_dim, norm_file, norm_type, min_value=0.01, max_value=0.99, saved_norm_type=None):
+    ''' As load_normaliser_values, but from the .stats sidecar of norm_file if there is one; then norm_type can differ from the saved one '''
+    ''' saved_norm_type: type norm_file was written with; without a sidecar, norm_file is only read as that type '''
+    stats_file = make_feat_stats_file_name(norm_file)
+    if not os.path.exists(stats_file):
+        if norm_type != saved_norm_type:
+            raise ValueError('%s has no .stats sidecar and was saved as %s, not %s; regenerate the sidecar by re-running its normaliser (compute_resil_normaliser)' % (norm_file, saved_norm_type or 'an unknown type', norm_type))
+        return load_normaliser_values(feature_dim, norm_file, norm_type, min_value, max_value)
+    feat_stats = Feat_Stats(feature_dim)
+    feat_stats.load(stats_file)
+    if norm_type == 'MinMax':
+        norm_info = numpy.stack([feat_stats.min, feat_stats.max])
+    elif norm_type == 'MeanVar':
+        norm_info = numpy.stack([feat_stats.mean, feat_stats.std()])
+    # Rounded to float32 as in *_info.dat, so the values equal those of the normalised files
+    return make_normaliser_scale_offset(norm_info.astype(numpy.float32).astype(numpy.float64), norm_type, min_value, max_value)
+
+def make_normaliser_scale_offset(norm_info, norm_type, min_value=0.01, max_value=0.99):
+    ''' norm_info: [2, D], min and max (MinMax) or mean and std (MeanVar) '''
+    feature_dim = norm_info.shape[1]
+    if norm_type == 'MinMax':
+        fea_min, fea_max = norm_info[0], norm_info[1]
+        fea_max_min_diff = fea_max - fea_min
+        target_max_min_diff = numpy.full(feature_dim, max_value - min_value)
+        target_max_min_diff[fea_max_min_diff <= 0.0] = 1.0
+        fea_max_min_diff[fea_max_min_diff <= 0.0] = 1.0
+        scale  = target_max_min_diff / fea_max_min_diff
+        offset = min_value - fea_min * scale
+    elif norm_type == 'MeanVar':
+        mean_vector, std_vector = norm_info[0], norm_info[1]
+        scale  = 1. / std_vector
+        offset = - mean_vector * scale
+    return scale, offset
+
+def init_resil_norm_worker(cfg, feature_dim, norm_file, norm_type, min_value, max_value, silence_pattern, codec_name='float32', silence_index_file=None, codec_info_dir=None):
+    ''' bitpack: the binary mask is read from codec_info.json of codec_info_dir, so files match the decoder '''
+    worker_state = init_silence_reducer_worker(cfg, feature_dim, silence_pattern, silence_index_file)
+    if norm_file is not None:
+        binary_mask = load_codec_info(codec_info_dir)['binary_mask'] if (codec_name == 'bitpack') and (codec_info_dir is not None) else None
+        worker_state.update(make_codec_params(codec_name, feature_dim, norm_file, norm_type, min_value, max_value, binary_mask))
+        worker_state['codec_name'] = codec_name
+    return worker_state
+
+def load_resil_data(worker_state, in_file, label_align_file):
+    from io_funcs.binary_io import BinaryIOCollection
+    BIC = BinaryIOCollection()
+    features, frame_number = BIC.load_binary_file_frame(in_file, worker_state['feature_dim'])
+    return reduce_silence_data(features, load_nonsilence_boundary(worker_state, label_align_file), worker_state['total_sil_one_side'])
+
+def resil_feat_stats_worker(worker_state, in_file, label_align_file):
+    feat_stats = Feat_Stats(worker_state['feature_dim'])
+    feat_stats.add_data(load_resil_data(worker_state, in_file, label_align_file))
+    return feat_stats
+
+def resil_worker(worker_state, in_file, label_align_file, out_file):
+    ''' Silence-reduced features, not normalised; for loaders that normalise on the fly '''
+    numpy.asarray(load_resil_data(worker_state, in_file, label_align_file), dtype=numpy.float32).tofile(out_file)
+
+def resil_norm_worker(worker_state, in_file, label_align_file, out_file):
+    features = load_resil_data(worker_state, in_file, label_align_file)
+    norm_features = features * worker_state['scale'] + worker_state['offset']
+    encode_features(norm_features, worker_state['codec_name'], worker_state['codec_scale'], worker_state['codec_offset'], worker_state['binary_mask']).tofile(out_file)
+
+def save_resil_norm_codec_info(out_dir, codec_name, feature_dim, norm_file, norm_type, min_value, max_value, in_file_list=[], num_workers=1):
+    ''' codec_info.json of normalised features; float32 directories have none '''
+    ''' bitpack: in_file_list are all raw files to be stored, so that no file fails in the stage after '''
+    if codec_name == 'float32':
+        if os.path.exists(make_codec_info_file_name(out_dir)):
+            os.remove(make_codec_info_file_name(out_dir))
+    else:
+        binary_mask = make_bitpack_binary_mask(feature_dim, norm_file, in_file_list, num_workers) if codec_name == 'bitpack' else None
+        codec_params = make_codec_params(codec_name, feature_dim, norm_file, norm_type, min_value, max_value, binary_mask)
+        save_codec_info(out_dir, codec_name, codec_params['codec_scale'], codec_params['codec_offset'], codec_params['binary_mask'])
+
+def resil_norm_list(cfg, feature_dim, in_file_list, label_align_file_list, out_file_list, norm_file, norm_type='MeanVar', min_value=0.01, max_value=0.99, silence_pattern=['*-#+*'], codec_name='float32'):
+    ''' Raw features to silence-reduced, normalised features in one read and one write per file; no _resil files '''
+    ''' Files are stored with codec_name; except for float32, codec_info.json is written to the output directory '''
+    in_file_list, out_file_list = list(in_file_list), list(out_file_list)
+    for out_dir in set([os.path.dirname(x) for x in out_file_list]):
+        save_resil_norm_codec_info(out_dir, codec_name, feature_dim, norm_file, norm_type, min_value, max_value, in_file_list, cfg.num_workers)
+    silence_index_file = make_silence_index(cfg, label_align_file_list, silence_pattern)
+    # Every output directory has the same codec_info.json
+    codec_info_dir = os.path.dirname(out_file_list[0]) if len(out_file_list) > 0 else None
+    run_parallel_file_tasks(resil_norm_worker, zip(in_file_list, label_align_file_list, out_file_list), init_resil_norm_worker, (cfg, feature_dim, norm_file, norm_type, min_value, max_value, silence_pattern, codec_name, silence_index_file, codec_info_dir), num_workers=cfg.num_workers)
+
+def compute_resil_feat_stats_list(cfg, feature_dim, in_file_list, label_align_file_list, silence_pattern=['*-#+*']):
+    ''' Normaliser statistics of silence-reduced features, reduced in memory; nothing is written '''
+    feat_stats = Feat_Stats(feature_dim)
+    silence_index_file = make_silence_index(cfg, label_align_file_list, silence_pattern)
+    run_parallel_file_tasks(resil_feat_stats_worker, zip(in_file_list, label_align_file_list), init_resil_norm_worker, (cfg, feature_dim, None, None, None, None, silence_pattern, 'float32', silence_index_file), num_workers=cfg.num_workers, result_fn=lambda task, file_stats: feat_stats.merge(file_stats))
+    return feat_stats
+
 def label_align_2_binary_label_list(cfg, in_label_align_file_list, out_binary_label_file_list):
     logger = make_logger("label_align_2_binary_label_list")
     from frontend.label_normalisation import HTSLabelNormalisation
@@ -301,15 +899,35 @@ def label_align_2_binary_label_list(cfg, in_label_align_file_list, out_binary_la
     label_normaliser.perform_normalisation(in_label_align_file_list, out_binary_label_file_list)
     # Single file function: label_normaliser.extract_linguistic_features(in_file, out_file)
 
+def init_label_normalisation_worker(cfg):
+    from frontend.label_normalisation import HTSLabelNormalisation
+    return {'label_normaliser': HTSLabelNormalisation(question_file_name=cfg.question_file_name)}
+
+def label_align_2_binary_label_worker(worker_state, in_label_align_file, out_binary_label_file):
+    worker_state['label_normaliser'].extract_linguistic_features(in_label_align_file, out_binary_label_file)
+
 def acoustic_2_cmp_list(cfg, in_file_list_dict, out_cmp_file_list):
     ''' Computes delta and ddelta, and stack to form cmp '''
     logger = make_logger("acoustic_2_cmp_list")
     logger.info('creating acoustic (output) features')
+    task_list = []
+    size_list = []
+    for i, out_cmp_file in enumerate(out_cmp_file_list):
+        in_file_dict = {feat_name: in_file_list_dict[feat_name][i] for feat_name in in_file_list_dict}
+        task_list.append((in_file_dict, out_cmp_file))
+        size_list.append(sum([get_task_size((f,)) for f in in_file_dict.values()]))
+    run_parallel_file_tasks(acoustic_2_cmp_worker, task_list, init_acoustic_composition_worker, (cfg,), num_workers=cfg.num_workers, size_list=size_list)
+
+def init_acoustic_composition_worker(cfg):
     from frontend.acoustic_composition import AcousticComposition
     delta_win = cfg.delta_win #[-0.5, 0.0, 0.5]
     acc_win = cfg.acc_win         #[1.0, -2.0, 1.0]
     acoustic_worker = AcousticComposition(delta_win = delta_win, acc_win = acc_win)
-    acoustic_worker.prepare_nn_data(in_file_list_dict, out_cmp_file_list, cfg.acoustic_in_dimension_dict, cfg.acoustic_out_dimension_dict)
+    return {'acoustic_worker': acoustic_worker, 'acoustic_in_dimension_dict': cfg.acoustic_in_dimension_dict, 'acoustic_out_dimension_dict': cfg.acoustic_out_dimension_dict}
+
+def acoustic_2_cmp_worker(worker_state, in_file_dict, out_cmp_file):
+    in_file_list_dict = {feat_name: [in_file_dict[feat_name]] for feat_name in in_file_dict}
+    worker_state['acoustic_worker'].prepare_nn_data(in_file_list_dict, [out_cmp_file], worker_state['acoustic_in_dimension_dict'], worker_state['acoustic_out_dimension_dict'])
 
 def cmp_2_acoustic_list(cfg, in_file_list, out_dir, do_MLPG=False):
     from frontend.parameter_generation_new import ParameterGeneration
@@ -322,9 +940,9 @@ def wav_2_wav_cmp(in_file_name, out_file_name, label_rate=200):
     ''' Make "cmp" style file, by reshaping waveform '''
     # find frame number, remove residual to make whole frames, quantise
     sr, data = scipy.io.wavfile.read(in_file_name)
-    dim = sr / label_rate
+    dim = sr // label_rate
     assert len(data.shape) == 1
-    num_frames = int(data.shape[0] / dim)
+    num_frames = data.shape[0] // dim
     # remove residual samples i.e. less than a frame
     num_samples = dim * num_frames
     new_data = numpy.array(data[:num_samples], dtype='float32')
@@ -332,10 +950,18 @@ def wav_2_wav_cmp(in_file_name, out_file_name, label_rate=200):
     BIC.array_to_binary_file(new_data, out_file_name)
     return sr
 
-def wav_2_wav_cmp_list(in_file_list, out_file_list, label_rate=200):
-    for (in_file_name, out_file_name) in zip(in_file_list, out_file_list):
-        sr = wav_2_wav_cmp(in_file_name, out_file_name, label_rate)
-    return sr
+def wav_2_wav_cmp_list(in_file_list, out_file_list, label_rate=200, num_workers=1):
+    ''' Returns the sample rate, which all files must share '''
+    if len(in_file_list) == 0:
+        raise ValueError('wav_2_wav_cmp_list: no input files')
+    sr_file_dict = {} # One file name per sample rate, for the error message
+    run_parallel_file_tasks(wav_2_wav_cmp_worker, [(x, y, label_rate) for (x, y) in zip(in_file_list, out_file_list)], num_workers=num_workers, result_fn=lambda task, sr: sr_file_dict.setdefault(sr, task[0]))
+    if len(sr_file_dict) > 1:
+        raise ValueError('wav_2_wav_cmp_list: files have different sample rates: %s' % ', '.join(['%i (%s)' % (sr, sr_file_dict[sr]) for sr in sorted(sr_file_dict)]))
+    return list(sr_file_dict)[0]
+
+def wav_2_wav_cmp_worker(worker_state, in_file_name, out_file_name, label_rate):
+    return wav_2_wav_cmp(in_file_name, out_file_name, label_rate)
 
 def wav_cmp_2_wav(in_file_name, out_file_name, sr=16000):
     from io_funcs.binary_io import BinaryIOCollection
@@ -377,22 +1003,55 @@ def invert_mu_law(in_file_name, out_file_name, mu_value=255.):
     check_within_range(ori_data, 1, -1)
     BIC.array_to_binary_file(ori_data, out_file_name)
 
+############################
+# PML vocoder (pulsemodel) #
+############################
+
+# Analysis and synthesis settings other than file names; bound once per worker by init_pml_vocoder_worker
+def make_pml_analysis_kwargs(acoustic_in_dimension_dict, verbose_level=0):
+    return {'shift': 0.005, 'dftlen': 4096,
+        'finf0txt': None, 'f0_min': 60, 'f0_max': 600, 'f0_log': True, 'finf0bin': None,
+        'spec_mceporder': acoustic_in_dimension_dict['mgc']-1, 'spec_fwceporder': None, 'spec_nbfwbnds': None,
+        'fpdd': None, 'pdd_mceporder': None, 'nm_nbfwbnds': acoustic_in_dimension_dict['bap'],
+        'verbose': verbose_level}
+
+def make_pml_synthesis_kwargs(verbose_level=0):
+    return {'shift': 0.005, 'dftlen': 4096,
+        'ff0': None, 'fspec': None, 'ffwlspec': None, 'ffwcep': None,
+        'fnm': None, 'nm_cont': False, 'fpdd': None, 'fmpdd': None,
+        'verbose': verbose_level}
+
 def wav_2_acoustic(in_file_name, out_file_dict, acoustic_in_dimension_dict, verbose_level=0):
     from pulsemodel.analysis import analysisf
-    analysisf(in_file_name,
-        shift=0.005, dftlen=4096,
-        finf0txt=None, f0_min=60, f0_max=600, ff0=out_file_dict['lf0'], f0_log=True, finf0bin=None,
-        fspec=out_file_dict['mgc'], spec_mceporder=acoustic_in_dimension_dict['mgc']-1, spec_fwceporder=None, spec_nbfwbnds=None,
-        fpdd=None, pdd_mceporder=None, fnm=out_file_dict['bap'], nm_nbfwbnds=acoustic_in_dimension_dict['bap'],
-        verbose=verbose_level)
+    analysisf(in_file_name, ff0=out_file_dict['lf0'], fspec=out_file_dict['mgc'], fnm=out_file_dict['bap'], **make_pml_analysis_kwargs(acoustic_in_dimension_dict, verbose_level))
 
 def acoustic_2_wav(in_file_dict, synthesis_wav_sr, out_file_name, verbose_level=0):
     from pulsemodel.synthesis import synthesizef
-    synthesizef(synthesis_wav_sr, shift=0.005, dftlen=4096, 
-        ff0=None, flf0=in_file_dict['lf0'], 
-        fspec=None, ffwlspec=None, ffwcep=None, fmcep=in_file_dict['mgc'], 
-        fnm=None, ffwnm=in_file_dict['bap'], nm_cont=False, fpdd=None, fmpdd=None, 
-        fsyn=out_file_name, verbose=verbose_level)
+    synthesizef(synthesis_wav_sr, flf0=in_file_dict['lf0'], fmcep=in_file_dict['mgc'], ffwnm=in_file_dict['bap'], fsyn=out_file_name, **make_pml_synthesis_kwargs(verbose_level))
+
+def init_pml_vocoder_worker(acoustic_in_dimension_dict, synthesis_wav_sr, verbose_level=0):
+    ''' pulsemodel is imported and its settings bound once per worker process; the worker then keeps them for all its files '''
+    from pulsemodel.analysis import analysisf
+    from pulsemodel.synthesis import synthesizef
+    return {'analysisf': analysisf, 'analysis_kwargs': make_pml_analysis_kwargs(acoustic_in_dimension_dict, verbose_level),
+        'synthesizef': synthesizef, 'synthesis_kwargs': make_pml_synthesis_kwargs(verbose_level), 'synthesis_wav_sr': synthesis_wav_sr}
+
+def wav_2_acoustic_worker(worker_state, in_file_name, out_file_dict):
+    worker_state['analysisf'](in_file_name, ff0=out_file_dict['lf0'], fspec=out_file_dict['mgc'], fnm=out_file_dict['bap'], **worker_state['analysis_kwargs'])
+
+def acoustic_2_wav_worker(worker_state, in_file_dict, out_file_name):
+    worker_state['synthesizef'](worker_state['synthesis_wav_sr'], flf0=in_file_dict['lf0'], fmcep=in_file_dict['mgc'], ffwnm=in_file_dict['bap'], fsyn=out_file_name, **worker_state['synthesis_kwargs'])
+
+def wav_2_acoustic_list(cfg, in_file_list, out_file_dict_list, verbose_level=0, num_workers=None):
+    ''' PML analysis of a wav file list, in cfg.num_workers persistent worker processes '''
+    if num_workers is None: num_workers = cfg.num_workers
+    run_parallel_file_tasks(wav_2_acoustic_worker, zip(in_file_list, out_file_dict_list), init_pml_vocoder_worker, (cfg.acoustic_in_dimension_dict, cfg.synthesis_wav_sr, verbose_level), num_workers=num_workers, task_name='wav files')
+
+def acoustic_2_wav_list(cfg, in_file_dict_list, out_file_list, verbose_level=0, num_workers=None):
+    ''' PML synthesis of a list of acoustic file dicts, in cfg.num_workers persistent worker processes '''
+    if num_workers is None: num_workers = cfg.num_workers
+    size_list = [sum([get_task_size((f,)) for f in in_file_dict.values()]) for in_file_dict in in_file_dict_list]
+    run_parallel_file_tasks(acoustic_2_wav_worker, zip(in_file_dict_list, out_file_list), init_pml_vocoder_worker, (cfg.acoustic_in_dimension_dict, cfg.synthesis_wav_sr, verbose_level), num_workers=num_workers, size_list=size_list, task_name='wav files')
 
 def acoustic_2_wav_cfg(cfg, in_file_dict, out_file_name, verbose_level=0):
     acoustic_2_wav(in_file_dict, cfg.synthesis_wav_sr, out_file_name, verbose_level=0)
@@ -400,125 +1059,196 @@ def acoustic_2_wav_cfg(cfg, in_file_dict, out_file_name, verbose_level=0):
 def wav_2_acoustic_cfg(cfg, in_file_name, out_file_dict, verbose_level=0):
     wav_2_acoustic(in_file_name, out_file_dict, cfg.acoustic_in_dimension_dict, verbose_level=0)
 
-def wav_2_norm_cmp(cfg, wav_file, target_dir, lab_file, cmp_norm_file):
+def make_acoustic_file_dict_list(cfg, file_id_list, target_dir):
+    return [{feat_name: os.path.join(target_dir, file_id+cfg.acoustic_file_ext_dict[feat_name]) for feat_name in cfg.acoustic_features} for file_id in file_id_list]
+
+def wav_2_norm_cmp_list(cfg, wav_file_list, target_dir, lab_file_list, cmp_norm_file):
     prepare_file_path(target_dir)
-    file_name = os.path.basename(wav_file).split('.')[0]
+    file_id_list = [os.path.basename(wav_file).split('.')[0] for wav_file in wav_file_list]
     ''' 1. wav to acoustic '''
-    acoustic_file_dict = {}
-    for feat_name in cfg.acoustic_features:
-        acoustic_file_dict[feat_name] = os.path.join(target_dir, file_name+cfg.acoustic_file_ext_dict[feat_name])
-    wav_2_acoustic(wav_file, acoustic_file_dict, cfg.acoustic_in_dimension_dict)
+    wav_2_acoustic_list(cfg, wav_file_list, make_acoustic_file_dict_list(cfg, file_id_list, target_dir))
 
     ''' 2. acoustic to cmp '''
     acoustic_file_list_dict = {}
     for feat_name in cfg.acoustic_features:
-        acoustic_file_list_dict[feat_name] = prepare_file_path_list([file_name], target_dir, cfg.acoustic_file_ext_dict[feat_name])
-    cmp_file_list = prepare_file_path_list([file_name], target_dir, '.cmp')
+        acoustic_file_list_dict[feat_name] = prepare_file_path_list(file_id_list, target_dir, cfg.acoustic_file_ext_dict[feat_name])
+    cmp_file_list = prepare_file_path_list(file_id_list, target_dir, '.cmp')
     acoustic_2_cmp_list(cfg, acoustic_file_list_dict, cmp_file_list)
 
     ''' 3. cmp to resil_cmp (requires label file) '''
-    from modules_2 import resil_nn_file_list
     feat_name = 'cmp'
-    label_align_file_list = [lab_file]
-    cmp_resil_file_list = prepare_file_path_list([file_name], target_dir, '.cmp.resil')
-    reduce_silence_list(cfg, cfg.nn_feature_dims[feat_name], cmp_file_list, label_align_file_list, cmp_resil_file_list)
+    cmp_resil_file_list = prepare_file_path_list(file_id_list, target_dir, '.cmp.resil')
+    reduce_silence_list(cfg, cfg.nn_feature_dims[feat_name], cmp_file_list, lab_file_list, cmp_resil_file_list)
 
     ''' 4. resil_cmp to norm_cmp (requires cmp_norm_info file) '''
-    cmp_resil_norm_file_list = prepare_file_path_list([file_name], target_dir, '.cmp.resil.norm')
-    perform_mean_var_normlisation_list(cfg.nn_feature_dims[feat_name], cfg.nn_feat_resil_norm_files[feat_name], cmp_resil_file_list, cmp_resil_norm_file_list)
+    cmp_resil_norm_file_list = prepare_file_path_list(file_id_list, target_dir, '.cmp.resil.norm')
+    perform_mean_var_normlisation_list(cfg.nn_feature_dims[feat_name], cfg.nn_feat_resil_norm_files[feat_name], cmp_resil_file_list, cmp_resil_norm_file_list, num_workers=cfg.num_workers)
 
-def norm_cmp_2_wav(cfg, cmp_resil_norm_file, target_dir, cmp_norm_file):
+def wav_2_norm_cmp(cfg, wav_file, target_dir, lab_file, cmp_norm_file):
+    wav_2_norm_cmp_list(cfg, [wav_file], target_dir, [lab_file], cmp_norm_file)
+
+def norm_cmp_2_wav_list(cfg, cmp_resil_norm_file_list, target_dir, cmp_norm_file):
     prepare_file_path(target_dir)
-    file_name = os.path.basename(cmp_resil_norm_file).split('.')[0]
+    file_id_list = [os.path.basename(cmp_resil_norm_file).split('.')[0] for cmp_resil_norm_file in cmp_resil_norm_file_list]
     feat_name = 'cmp'
     ''' 1. norm_cmp to resil_cmp (requires cmp_norm_info file) '''
-    cmp_resil_norm_file_list = [cmp_resil_norm_file]
-    cmp_resil_file_list      = prepare_file_path_list([file_name], target_dir, '.cmp')
+    cmp_resil_file_list = prepare_file_path_list(file_id_list, target_dir, '.cmp')
     perform_mean_var_denormlisation_list(cfg.nn_feature_dims[feat_name], cmp_norm_file, cmp_resil_norm_file_list, cmp_resil_file_list)
 
     ''' 2. cmp to acoustic '''
     cmp_2_acoustic_list(cfg, cmp_resil_file_list, target_dir, do_MLPG=False)
 
     ''' 3. acoustic to wav '''
-    acoustic_file_dict = {}
-    for feat_name in cfg.acoustic_features:
-        acoustic_file_dict[feat_name] = os.path.join(target_dir, file_name+cfg.acoustic_file_ext_dict[feat_name])
-    wav_file = os.path.join(target_dir, file_name+'.wav')
-    acoustic_2_wav(acoustic_file_dict, cfg.synthesis_wav_sr, wav_file)
-
+    wav_file_list = prepare_file_path_list(file_id_list, target_dir, '.wav')
+    acoustic_2_wav_list(cfg, make_acoustic_file_dict_list(cfg, file_id_list, target_dir), wav_file_list)
 
-def cal_mcd_dir(cfg, ref_data_dir, gen_denorm_no_sil_dir, file_id_list):
+def norm_cmp_2_wav(cfg, cmp_resil_norm_file, target_dir, cmp_norm_file):
+    norm_cmp_2_wav_list(cfg, [cmp_resil_norm_file], target_dir, cmp_norm_file)
+
+
+#####################
+# Objective metrics #
+#####################
+
+class Distortion_Stats(object):
+    ''' Sums behind MCD, BAP distortion, F0 RMSE, F0 correlation and V/UV error; same formulas as IndividualDistortionComp '''
+    ''' Per file or summed over files: two Distortion_Stats merge by adding, so workers, speakers and splits add up '''
+    stat_name_list = ['mgc_frames', 'bap_frames', 'lf0_frames', 'mgc_dist', 'bap_dist', 'f0_sq_err', 'num_voiced', 'num_vuv_err', 'f0_ref_sum', 'f0_gen_sum', 'f0_ref_sq_sum', 'f0_gen_sq_sum', 'f0_ref_gen_sum']
+
+    def __init__(self):
+        for k in self.stat_name_list:
+            setattr(self, k, 0.)
+        self.feat_name_set = set()
+
+    def merge(self, other):
+        for k in self.stat_name_list:
+            setattr(self, k, getattr(self, k) + getattr(other, k))
+        self.feat_name_set |= other.feat_name_set
+
+    def result(self, acoustic_feature_type='PML'):
+        ''' MCD and BAP in dB (STRAIGHT scaling as before), F0 RMSE in Hz; None for features not computed '''
+        result_dict = {'num_frames': int(max(self.mgc_frames, self.bap_frames, self.lf0_frames)), 'MCD': None, 'BAP': None, 'F0_RMSE': None, 'F0_CORR': None, 'VUV': None}
+        if 'mgc' in self.feat_name_set:
+            result_dict['MCD'] = self.mgc_dist / max(self.mgc_frames, 1.)
+            if acoustic_feature_type == 'STRAIGHT':
+                result_dict['MCD'] *= (10 / numpy.log(10)) * numpy.sqrt(2.0)
+        if 'bap' in self.feat_name_set:
+            result_dict['BAP'] = self.bap_dist / max(self.bap_frames, 1.)
+            if acoustic_feature_type == 'STRAIGHT':
+                # Cassia's bap is computed from 10*log|S(w)|. if use HTS/SPTK style, do the same as MGC
+                result_dict['BAP'] /= 10.0
+        if 'lf0' in self.feat_name_set:
+            n = self.num_voiced
+            result_dict['F0_RMSE'] = numpy.sqrt(self.f0_sq_err / max(n, 1.))
+            result_dict['VUV'] = self.num_vuv_err / max(self.lf0_frames, 1.)
+            # Pearson correlation of voiced F0 over all frames, from sums
+            cov   = self.f0_ref_gen_sum - self.f0_ref_sum * self.f0_gen_sum / max(n, 1.)
+            var_r = self.f0_ref_sq_sum - self.f0_ref_sum ** 2 / max(n, 1.)
+            var_g = self.f0_gen_sq_sum - self.f0_gen_sum ** 2 / max(n, 1.)
+            result_dict['F0_CORR'] = cov / numpy.sqrt(var_r * var_g) if (var_r > 0) and (var_g > 0) else 0.
+        return result_dict
+
+def load_ref_gen_data(ref_file_name, gen_file_name, feature_dim):
+    ''' Same frame rule as IndividualDistortionComp: up to 2 frames difference is trimmed, more is an error '''
+    ref_data = numpy.fromfile(ref_file_name, dtype=numpy.float32)
+    gen_data = numpy.fromfile(gen_file_name, dtype=numpy.float32)
+    ref_data = ref_data[:(ref_data.size // feature_dim) * feature_dim].reshape(-1, feature_dim).astype(numpy.float64)
+    gen_data = gen_data[:(gen_data.size // feature_dim) * feature_dim].reshape(-1, feature_dim).astype(numpy.float64)
+    if abs(ref_data.shape[0] - gen_data.shape[0]) > 2:
+        raise ValueError('%s has %i frames, %s has %i' % (ref_file_name, ref_data.shape[0], gen_file_name, gen_data.shape[0]))
+    num_frames = min(ref_data.shape[0], gen_data.shape[0])
+    return ref_data[:num_frames], gen_data[:num_frames]
+
+def euclidean_distance_sum(ref_data, gen_data):
+    ''' Sum over frames of the Euclidean distance between frames '''
+    return float(numpy.sum(numpy.sqrt(numpy.sum((ref_data - gen_data) ** 2, axis=1))))
+
+def add_f0_distortion(distortion_stats, ref_lf0, gen_lf0):
+    ''' Voiced where lf0 > 0; F0 errors on frames voiced in both, V/UV errors where exactly one is voiced '''
+    ref_voiced = ref_lf0 > 0.
+    gen_voiced = gen_lf0 > 0.
+    both_voiced = ref_voiced & gen_voiced
+    ref_f0 = numpy.exp(ref_lf0[both_voiced])
+    gen_f0 = numpy.exp(gen_lf0[both_voiced])
+    distortion_stats.f0_sq_err     += float(numpy.sum((ref_f0 - gen_f0) ** 2))
+    distortion_stats.num_voiced    += float(ref_f0.size)
+    distortion_stats.num_vuv_err   += float(numpy.sum(ref_voiced != gen_voiced))
+    distortion_stats.f0_ref_sum    += float(numpy.sum(ref_f0))
+    distortion_stats.f0_gen_sum    += float(numpy.sum(gen_f0))
+    distortion_stats.f0_ref_sq_sum += float(numpy.sum(ref_f0 ** 2))
+    distortion_stats.f0_gen_sq_sum += float(numpy.sum(gen_f0 ** 2))
+    distortion_stats.f0_ref_gen_sum += float(numpy.sum(ref_f0 * gen_f0))
+
+def init_distortion_worker(ref_data_dir, gen_data_dir, feat_name_list, acoustic_file_ext_dict, acoustic_in_dimension_dict):
+    return {'ref_data_dir': ref_data_dir, 'gen_data_dir': gen_data_dir, 'feat_name_list': feat_name_list, 'acoustic_file_ext_dict': acoustic_file_ext_dict, 'acoustic_in_dimension_dict': acoustic_in_dimension_dict}
+
+def distortion_worker(worker_state, file_id, tvt=None):
+    ''' Distortion_Stats of one file, all features in feat_name_list; tvt is not used, only carried in the task to result_fn '''
+    distortion_stats = Distortion_Stats()
+    for feat_name in worker_state['feat_name_list']:
+        file_ext = worker_state['acoustic_file_ext_dict'][feat_name]
+        ref_data, gen_data = load_ref_gen_data(os.path.join(worker_state['ref_data_dir'], file_id + file_ext), os.path.join(worker_state['gen_data_dir'], file_id + file_ext), worker_state['acoustic_in_dimension_dict'][feat_name])
+        if feat_name == 'mgc':
+            # c0 (energy) is not part of MCD
+            distortion_stats.mgc_dist += euclidean_distance_sum(ref_data[:, 1:], gen_data[:, 1:])
+        elif feat_name == 'bap':
+            distortion_stats.bap_dist += euclidean_distance_sum(ref_data, gen_data)
+        elif feat_name == 'lf0':
+            add_f0_distortion(distortion_stats, ref_data[:, 0], gen_data[:, 0])
+        # Each feature is averaged over its own frames, as in IndividualDistortionComp
+        setattr(distortion_stats, feat_name + '_frames', float(ref_data.shape[0]))
+        distortion_stats.feat_name_set.add(feat_name)
+    return distortion_stats
+
+def cal_mcd_dir(cfg, ref_data_dir, gen_denorm_no_sil_dir, file_id_list, result_table_file=None, num_workers=None):
+    ''' file_id_list: dict, split name (e.g. 'valid', 'test') to file id list; features of each file are in one directory, by extension '''
+    ''' Files run in parallel; per-file results are streamed to result_table_file (default gen_denorm_no_sil_dir/distortion.tsv) '''
+    ''' Returns {(split, speaker_id or 'all'): result dict of Distortion_Stats} '''
     logger = make_logger("cal_mcd_dir")
     logger.info('calculating MCD')
-    from utils.compute_distortion import IndividualDistortionComp
-    calculator = IndividualDistortionComp()
+    if num_workers is None: num_workers = cfg.num_workers
+    if result_table_file is None: result_table_file = os.path.join(gen_denorm_no_sil_dir, 'distortion.tsv')
+    feat_name_list = [feat_name for feat_name in ['mgc', 'bap', 'lf0'] if feat_name in cfg.acoustic_in_dimension_dict]
+    metric_name_list = ['MCD', 'BAP', 'F0_RMSE', 'F0_CORR', 'VUV']
 
-    error_dict = {}
+    task_list = []
     for tvt in file_id_list.keys():
-        for feat_name in cfg.acoustic_features:
-            if feat_name == 'lf0':
-                f0_mse, f0_corr, vuv_error  = calculator.compute_distortion(file_id_list[tvt], ref_data_dir, gen_denorm_no_sil_dir, cfg.acoustic_file_ext_dict[feat_name], cfg.acoustic_in_dimension_dict[feat_name])
-            else:
-                error_dict[(tvt, feat_name)] = calculator.compute_distortion(file_id_list[tvt], ref_data_dir, gen_denorm_no_sil_dir, cfg.acoustic_file_ext_dict[feat_name], cfg.acoustic_in_dimension_dict[feat_name])
-        if cfg.acoustic_feature_type == 'STRAIGHT':
-            error_dict[(tvt, 'mgc')] = error_dict[(tvt, 'mgc')] * (10 /numpy.log(10)) * numpy.sqrt(2.0)    ##MCD
-            error_dict[(tvt, 'bap')] = error_dict[(tvt, 'bap')] / 10.0    ##Cassia's bap is computed from 10*log|S(w)|. if use HTS/SPTK style, do the same as MGC
-        logger.info('%s: DNN -- MCD: %.3f dB; BAP: %.3f dB; F0:- RMSE: %.3f Hz; CORR: %.3f; VUV: %.3f%%' \
-                %(tvt, error_dict[(tvt, 'mgc')], error_dict[(tvt, 'bap')], f0_mse, f0_corr, vuv_error*100.))
-
-
-    if cfg.acoustic_in_dimension_dict.has_key('mgc'):
-        valid_spectral_distortion = calculator.compute_distortion(valid_file_id_list, ref_data_dir, gen_denorm_no_sil_dir, cfg.acoustic_file_ext_dict['mgc'], cfg.acoustic_in_dimension_dict['mgc'])
-        test_spectral_distortion  = calculator.compute_distortion(test_file_id_list , ref_data_dir, gen_denorm_no_sil_dir, cfg.acoustic_file_ext_dict['mgc'], cfg.acoustic_in_dimension_dict['mgc'])
-        
-    if cfg.acoustic_in_dimension_dict.has_key('bap'):
-        valid_bap_mse        = calculator.compute_distortion(valid_file_id_list, ref_data_dir, gen_denorm_no_sil_dir, cfg.bap_ext, cfg.bap_dim)
-        test_bap_mse         = calculator.compute_distortion(test_file_id_list , ref_data_dir, gen_denorm_no_sil_dir, cfg.bap_ext, cfg.bap_dim)
-
-    if cfg.acoustic_feature_type == 'STRAIGHT':
-        valid_spectral_distortion *= (10 /numpy.log(10)) * numpy.sqrt(2.0)    ##MCD
-        test_spectral_distortion  *= (10 /numpy.log(10)) * numpy.sqrt(2.0)    ##MCD
-        valid_bap_mse = valid_bap_mse / 10.0    ##Cassia's bap is computed from 10*log|S(w)|. if use HTS/SPTK style, do the same as MGC
-        test_bap_mse  = test_bap_mse / 10.0    ##Cassia's bap is computed from 10*log|S(w)|. if use HTS/SPTK style, do the same as MGC
-            
-    if cfg.acoustic_in_dimension_dict.has_key('lf0'):
-        valid_f0_mse, valid_f0_corr, valid_vuv_error  = calculator.compute_distortion(valid_file_id_list, ref_data_dir, gen_denorm_no_sil_dir, cfg.lf0_ext, cfg.lf0_dim)
-        test_f0_mse , test_f0_corr, test_vuv_error    = calculator.compute_distortion(test_file_id_list , ref_data_dir, gen_denorm_no_sil_dir, cfg.lf0_ext, cfg.lf0_dim)
-
-    logger.info('Valid: DNN -- MCD: %.3f dB; BAP: %.3f dB; F0:- RMSE: %.3f Hz; CORR: %.3f; VUV: %.3f%%' \
-                %(valid_spectral_distortion, valid_bap_mse, valid_f0_mse, valid_f0_corr, valid_vuv_error*100.))
-    logger.info('Test : DNN -- MCD: %.3f dB; BAP: %.3f dB; F0:- RMSE: %.3f Hz; CORR: %.3f; VUV: %.3f%%' \
-                %(test_spectral_distortion , test_bap_mse , test_f0_mse , test_f0_corr, test_vuv_error*100.))
-
-
-
-
-
-
-
-
+        for file_id in file_id_list[tvt]:
+            task_list.append((file_id, tvt))
+    size_list = [get_task_size((os.path.join(ref_data_dir, task[0] + cfg.acoustic_file_ext_dict[feat_name_list[0]]),)) for task in task_list]
+
+    stats_dict = {}
+    with open(result_table_file, 'w') as table_file:
+        table_file.write('\t'.join(['split', 'file_id', 'speaker_id', 'num_frames'] + metric_name_list) + '\n')
+        def add_file_stats(task, file_stats):
+            # A file id may be in several splits; each task keeps its own
+            file_id, tvt = task
+            speaker_id = file_id.split('_')[0]
+            for key in [(tvt, speaker_id), (tvt, 'all')]:
+                if key not in stats_dict:
+                    stats_dict[key] = Distortion_Stats()
+                stats_dict[key].merge(file_stats)
+            file_result = file_stats.result(cfg.acoustic_feature_type)
+            table_file.write('\t'.join([tvt, file_id, speaker_id, str(file_result['num_frames'])] + ['%.6f' % file_result[k] if file_result[k] is not None else '-' for k in metric_name_list]) + '\n')
+        run_parallel_file_tasks(distortion_worker, task_list, init_distortion_worker, (ref_data_dir, gen_denorm_no_sil_dir, feat_name_list, cfg.acoustic_file_ext_dict, cfg.acoustic_in_dimension_dict), \
+            num_workers=num_workers, size_list=size_list, result_fn=add_file_stats)
+
+    result_dict = {key: stats_dict[key].result(cfg.acoustic_feature_type) for key in stats_dict}
+    for tvt in file_id_list.keys():
+        if (tvt, 'all') not in result_dict:
+            continue
+        r = result_dict[(tvt, 'all')]
+        logger.info('%s: DNN -- MCD: %s dB; BAP: %s dB; F0:- RMSE: %s Hz; CORR: %s; VUV: %s' % (tvt, \
+            format_metric(r['MCD']), format_metric(r['BAP']), format_metric(r['F0_RMSE']), format_metric(r['F0_CORR']), format_metric(r['VUV'], 100., '%.3f%%')))
+    logger.info('Per-file results in %s' % result_table_file)
+    return result_dict
 
+def format_metric(value, multiplier=1., format_str='%.3f'):
+    return '-' if value is None else format_str % (value * multiplier)
 
 def reduce_silence(cfg, feature_dim, in_file, label_align_file, out_file, silence_pattern=['*-#+*']):
-    from frontend.silence_reducer_keep_sil import SilenceReducer
-    remover = SilenceReducer(n_cmp = feature_dim, silence_pattern = silence_pattern)
-    remover.reduce_silence([in_file], [label_align_file], [out_file], frames_silence_to_keep=cfg.frames_silence_to_keep,sil_pad=cfg.sil_pad)
+    reduce_silence_worker(init_silence_reducer_worker(cfg, feature_dim, silence_pattern), in_file, label_align_file, out_file)
 
 def reduce_silence_list_parallel(cfg, feature_dim, in_file_list, label_align_file_list, out_file_list, silence_pattern=['*-#+*'], num_threads=20):
-    logger = make_logger("reduce_silence_list_parallel")
-    # from multiprocessing import Pool
-    from pathos.multiprocessing import ProcessingPool as Pool
-    def reduce_silence_list_wrapper(args):
-        cfg, feature_dim, in_file_list, label_align_file_list, out_file_list, silence_pattern = args
-        reduce_silence_list(cfg, feature_dim, in_file_list, label_align_file_list, out_file_list)
-
-    args_list = []
-    index_list = find_index_list_for_parallel(num_threads, in_file_list)
-    for i in range(num_threads):
-        # Make sub-lists
-        x = index_list[i][0]
-        y = index_list[i][1]
-        args = (cfg, feature_dim, in_file_list[x: y], label_align_file_list[x: y], out_file_list[x: y])
-        args_list.append(args)
-    with Pool(num_threads) as p:
-        p.map(reduce_silence_list_wrapper, args_list)
+    ''' reduce_silence_list with num_threads worker processes, instead of cfg.num_workers '''
+    reduce_silence_list(cfg, feature_dim, in_file_list, label_align_file_list, out_file_list, silence_pattern, num_workers=num_threads)
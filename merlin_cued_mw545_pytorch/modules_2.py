@@ -1,7 +1,7 @@
 # modules_2.py
 
 import os, sys, pickle, time, shutil, logging
-import math, numpy, scipy
+import math, numpy
 numpy.random.seed(545)
 from io_funcs.binary_io import BinaryIOCollection
 io_fun = BinaryIOCollection()
@@ -20,7 +20,7 @@ def compute_feat_dim(model_cfg, cfg, feat_list):
         feat_dim = cfg.nn_feature_dims['lab']
         feat_index = range(cfg.nn_feature_dims['lab'])
     else:
-        if model_cfg.cmp_use_delta:
+        if model_cfg.cmp_use_delta and cfg.output_contain_delta:
             for feat in feat_list:
                 feat_dim += cfg.acoustic_in_dimension_dict[feat] * 3
                 feat_index.extend(range(cfg.acoustic_start_index[feat], cfg.acoustic_start_index[feat] + cfg.acoustic_in_dimension_dict[feat] * 3))
@@ -28,6 +28,9 @@ def compute_feat_dim(model_cfg, cfg, feat_list):
             for feat in feat_list:
                 feat_dim += cfg.acoustic_in_dimension_dict[feat]
                 feat_index.extend(range(cfg.acoustic_start_index[feat], cfg.acoustic_start_index[feat] + cfg.acoustic_in_dimension_dict[feat]))
+            if model_cfg.cmp_use_delta:
+                # Static-only cmp files: feat_index selects the statics, delta and acc are added in the loader (Delta_Composer)
+                feat_dim = feat_dim * 3
     
     feat_index = numpy.array(feat_index)
     return feat_dim, feat_index
@@ -62,7 +65,7 @@ def norm_nn_file_list(feat_name, cfg, file_id_list, nn_resil_file_list={}, nn_re
                 make_wav_min_max_normaliser(cfg.nn_feat_resil_norm_files[feat_name], cfg.nn_feature_dims[feat_name])
             else:    
                 from modules import compute_min_max_normaliser
-                compute_min_max_normaliser(cfg.nn_feature_dims[feat_name], nn_resil_file_list[feat_name+'_train'], cfg.nn_feat_resil_norm_files[feat_name], min_value=0.01, max_value=0.99)
+                compute_min_max_normaliser(cfg.nn_feature_dims[feat_name], nn_resil_file_list[feat_name+'_train'], cfg.nn_feat_resil_norm_files[feat_name], min_value=0.01, max_value=0.99, num_workers=cfg.num_workers)
         elif norm_type == 'MeanVar':
             from modules import compute_mean_var_normaliser
             if feat_name == 'cmp':
@@ -71,19 +74,97 @@ def norm_nn_file_list(feat_name, cfg, file_id_list, nn_resil_file_list={}, nn_re
             else:
                 var_file_dict = None
                 acoustic_out_dimension_dict = None
-            compute_mean_var_normaliser(cfg.nn_feature_dims[feat_name], nn_resil_file_list[feat_name+'_train'], cfg.nn_feat_resil_norm_files[feat_name], var_file_dict, acoustic_out_dimension_dict)
+            compute_mean_var_normaliser(cfg.nn_feature_dims[feat_name], nn_resil_file_list[feat_name+'_train'], cfg.nn_feat_resil_norm_files[feat_name], var_file_dict, acoustic_out_dimension_dict, num_workers=cfg.num_workers)
     else:
         print("Using norm file " + cfg.nn_feat_resil_norm_files[feat_name])
 
     if norm_type == 'MinMax':
         from modules import perform_min_max_normlisation_list
         if feat_name == 'wav':
-            perform_min_max_normlisation_list(cfg.nn_feature_dims[feat_name], cfg.nn_feat_resil_norm_files[feat_name], nn_resil_file_list[feat_name], nn_resil_norm_file_list[feat_name], min_value=-3.99, max_value=3.99)
+            perform_min_max_normlisation_list(cfg.nn_feature_dims[feat_name], cfg.nn_feat_resil_norm_files[feat_name], nn_resil_file_list[feat_name], nn_resil_norm_file_list[feat_name], min_value=-3.99, max_value=3.99, num_workers=cfg.num_workers)
         else:
-            perform_min_max_normlisation_list(cfg.nn_feature_dims[feat_name], cfg.nn_feat_resil_norm_files[feat_name], nn_resil_file_list[feat_name], nn_resil_norm_file_list[feat_name], min_value=0.01, max_value=0.99)
+            perform_min_max_normlisation_list(cfg.nn_feature_dims[feat_name], cfg.nn_feat_resil_norm_files[feat_name], nn_resil_file_list[feat_name], nn_resil_norm_file_list[feat_name], min_value=0.01, max_value=0.99, num_workers=cfg.num_workers)
     elif norm_type == 'MeanVar':
         from modules import perform_mean_var_normlisation_list
-        perform_mean_var_normlisation_list(cfg.nn_feature_dims[feat_name], cfg.nn_feat_resil_norm_files[feat_name], nn_resil_file_list[feat_name], nn_resil_norm_file_list[feat_name])
+        perform_mean_var_normlisation_list(cfg.nn_feature_dims[feat_name], cfg.nn_feat_resil_norm_files[feat_name], nn_resil_file_list[feat_name], nn_resil_norm_file_list[feat_name], num_workers=cfg.num_workers)
+
+def get_norm_min_max_value(feat_name):
+    ''' Normalised range of MinMax normalisation, as in norm_nn_file_list '''
+    if feat_name == 'wav':
+        return -3.99, 3.99
+    else:
+        return 0.01, 0.99
+
+def get_resil_norm_type(feat_name):
+    ''' Normalisation of the pipeline normalisers (cfg.nn_feat_resil_norm_files), as in resil_norm_nn_file_list calls '''
+    return {'lab': 'MinMax', 'cmp': 'MeanVar', 'wav': 'MinMax'}[feat_name]
+
+def keep_normaliser_file_id(cfg, file_id_list):
+    ''' Training speakers, without held-out file numbers '''
+    train_file_id_list = keep_by_speaker(file_id_list, cfg.speaker_id_list_dict['train'])
+    return remove_by_file_number(train_file_id_list, cfg.held_out_file_number)
+
+def compute_resil_normaliser(feat_name, cfg, in_file_list, label_align_file_list, norm_type='MinMax'):
+    ''' Normaliser of silence-reduced features, reduced in memory; in_file_list should be training files only '''
+    from modules import compute_resil_feat_stats_list, save_min_max_normaliser, save_mean_var_normaliser, make_wav_min_max_normaliser
+    feature_dim = cfg.nn_feature_dims[feat_name]
+    norm_file = cfg.nn_feat_resil_norm_files[feat_name]
+    if (norm_type == 'MinMax') and (feat_name == 'wav'):
+        make_wav_min_max_normaliser(norm_file, feature_dim)
+        return
+    feat_stats = compute_resil_feat_stats_list(cfg, feature_dim, in_file_list, label_align_file_list)
+    if norm_type == 'MinMax':
+        save_min_max_normaliser(feat_stats, norm_file)
+    elif norm_type == 'MeanVar':
+        if feat_name == 'cmp':
+            save_mean_var_normaliser(feat_stats, norm_file, cfg.var_file_dict, cfg.acoustic_out_dimension_dict)
+        else:
+            save_mean_var_normaliser(feat_stats, norm_file)
+
+def update_resil_normaliser(feat_name, cfg, new_file_list, new_label_align_file_list, norm_type='MinMax'):
+    ''' Add statistics of new silence-reduced files (e.g. new speakers) to the normaliser of compute_resil_normaliser; only the new files are read '''
+    from modules import compute_resil_feat_stats_list, save_min_max_normaliser, save_mean_var_normaliser, make_feat_stats_file_name, Feat_Stats
+    logger = make_logger("update_resil_normaliser")
+    feature_dim = cfg.nn_feature_dims[feat_name]
+    norm_file = cfg.nn_feat_resil_norm_files[feat_name]
+    stats_file = make_feat_stats_file_name(norm_file)
+    if not os.path.exists(stats_file):
+        raise IOError('No statistics file %s; compute the normaliser on the full list once first' % stats_file)
+    feat_stats = Feat_Stats(feature_dim)
+    feat_stats.load(stats_file)
+    n_old = feat_stats.n
+    feat_stats.merge(compute_resil_feat_stats_list(cfg, feature_dim, new_file_list, new_label_align_file_list))
+    logger.info('%i new files, %i frames added to %i frames' % (len(new_file_list), feat_stats.n - n_old, n_old))
+    if norm_type == 'MinMax':
+        save_min_max_normaliser(feat_stats, norm_file)
+    elif norm_type == 'MeanVar':
+        if feat_name == 'cmp':
+            save_mean_var_normaliser(feat_stats, norm_file, cfg.var_file_dict, cfg.acoustic_out_dimension_dict)
+        else:
+            save_mean_var_normaliser(feat_stats, norm_file)
+
+def resil_norm_nn_file_list(feat_name, cfg, file_id_list, nn_file_list={}, out_file_dir_dict=None, compute_normaliser=True, norm_type='MinMax'):
+    ''' Fused ResilX, NormX and copy_to_scratch: each raw nn_ file is read once, reduced and normalised in memory, written once '''
+    ''' Output goes to out_file_dir_dict[feat_name], default cfg.nn_feat_scratch_dirs; normaliser settings are those of norm_nn_file_list '''
+    from modules import resil_norm_list, check_feat_codec
+    check_feat_codec(feat_name, cfg.nn_feat_codec_dict[feat_name])
+    if out_file_dir_dict is None:
+        out_file_dir_dict = cfg.nn_feat_scratch_dirs
+    try:    nn_file_list[feat_name]
+    except: nn_file_list[feat_name] = prepare_file_path_list(file_id_list, cfg.nn_feat_dirs[feat_name], '.'+feat_name)
+    label_align_file_list = prepare_file_path_list(file_id_list, cfg.lab_dir, '.lab')
+    out_file_list = prepare_file_path_list(file_id_list, out_file_dir_dict[feat_name], '.'+feat_name)
+    norm_file = cfg.nn_feat_resil_norm_files[feat_name]
+    min_value, max_value = get_norm_min_max_value(feat_name)
+
+    if compute_normaliser:
+        train_file_id_set = set(keep_normaliser_file_id(cfg, file_id_list))
+        train_index_list = [i for i, file_id in enumerate(file_id_list) if file_id in train_file_id_set]
+        compute_resil_normaliser(feat_name, cfg, [nn_file_list[feat_name][i] for i in train_index_list], [label_align_file_list[i] for i in train_index_list], norm_type)
+    else:
+        print("Using norm file " + norm_file)
+
+    resil_norm_list(cfg, cfg.nn_feature_dims[feat_name], nn_file_list[feat_name], label_align_file_list, out_file_list, norm_file, norm_type, min_value, max_value, codec_name=cfg.nn_feat_codec_dict[feat_name])
 
 def get_utters_from_binary(file_list, num_files, min_file_len, feat_dim):
     # Draw n files from a list of full file paths
@@ -107,7 +188,201 @@ def get_utters_from_binary(file_list, num_files, min_file_len, feat_dim):
     # assert len(final_file_list) == num_files
     return (final_file_list, final_len_list)
 
-def get_utters_from_binary_dict(spk_num_utter, file_list, file_dir_dict, feat_name_list, feat_dim_list, min_file_len=0, random_seed=None):
+def make_index_slice(index_array):
+    ''' slice if index_array is contiguous and increasing, else index_array '''
+    if (index_array.shape[0] > 0) and numpy.all(numpy.diff(index_array) == 1):
+        return slice(int(index_array[0]), int(index_array[-1]) + 1)
+    return index_array
+
+class Feat_Decoder(object):
+    ''' Loads feature files of one feature type as float32, whatever the storage codec of their directory '''
+    ''' Codec decode and the normalisation affine (codec scale and offset) run as one pass into a float32 buffer '''
+    def __init__(self, mu_law_bits=None, mu_value=255., norm_min_max=(-1., 1.), norm_scale_offset=None):
+        self.codec_info_dict = {} # Per directory; None for plain float32
+        # Optional normalisation in the loader, of un-normalised files: (scale, offset) of load_stats_normaliser_values
+        # It is folded into the codec scale and offset of each directory, so decode stays one pass
+        self.norm_scale_offset = norm_scale_offset
+        # Optional mu-law companding (8 or 16 bit codes) of the decoded features, by one table lookup
+        # norm_min_max is the normalised range; it is mapped to [-1, 1] for companding, and the output back to it
+        self.mu_law_bits = mu_law_bits
+        if mu_law_bits is not None:
+            from modules import make_mu_law_transform_table
+            self.norm_mid  = (norm_min_max[1] + norm_min_max[0]) / 2.
+            self.norm_half = (norm_min_max[1] - norm_min_max[0]) / 2.
+            self.mu_law_table = make_mu_law_transform_table(mu_law_bits, mu_value) * numpy.float32(self.norm_half) + numpy.float32(self.norm_mid)
+
+    def get_codec_info(self, feat_dir):
+        if feat_dir not in self.codec_info_dict:
+            from modules import load_codec_info, make_mu_law_decode_table
+            codec_info = load_codec_info(feat_dir)
+            if self.norm_scale_offset is not None:
+                codec_info = self.fold_normaliser(codec_info)
+            if codec_info is not None:
+                codec_info['scale_32']  = numpy.array(codec_info['scale'], dtype=numpy.float32)
+                codec_info['offset_32'] = numpy.array(codec_info['offset'], dtype=numpy.float32)
+                if codec_info['codec_name'] == 'bitpack':
+                    binary_mask = codec_info['binary_mask']
+                    codec_info['binary_index']  = numpy.nonzero(binary_mask)[0]
+                    codec_info['numeric_index'] = numpy.nonzero(~binary_mask)[0]
+                    # Contiguous index arrays (e.g. binary questions, then numeric features) are written as slices
+                    codec_info['binary_cols']  = make_index_slice(codec_info['binary_index'])
+                    codec_info['numeric_cols'] = make_index_slice(codec_info['numeric_index'])
+                    codec_info['num_packed_bytes'] = (codec_info['binary_index'].shape[0] + 7) // 8
+                    codec_info['record_bytes'] = codec_info['num_packed_bytes'] + 4 * codec_info['numeric_index'].shape[0]
+                scale, offset = codec_info['scale'], codec_info['offset']
+                if numpy.all(scale == scale[0]) and numpy.all(offset == offset[0]):
+                    scale, offset = scale[:1], offset[:1]
+                if codec_info['codec_name'] == 'mulaw8':
+                    # Decoded and normalised value of each code, [256, D]; one column if all dimensions share scale and offset (wav)
+                    codec_info['table'] = numpy.array(make_mu_law_decode_table(8)[:, None] * scale[None, :] + offset[None, :], dtype=numpy.float32)
+                elif codec_info['codec_name'] == 'int16' and self.mu_law_bits is not None and scale.shape[0] == 1:
+                    # Decode and mu-law in one lookup, indexed by code + 32768
+                    codec_info['table'] = numpy.array((numpy.arange(65536) - 32768.)[:, None] * scale[None, :] + offset[None, :], dtype=numpy.float32)
+                if 'table' in codec_info and self.mu_law_bits is not None:
+                    codec_info['table'] = self.mu_law_transform(codec_info['table'])
+            self.codec_info_dict[feat_dir] = codec_info
+        return self.codec_info_dict[feat_dir]
+
+    def fold_normaliser(self, codec_info):
+        ''' Codec info of normalised features: norm_scale * decoded + norm_offset; plain float32 files become a float32 codec '''
+        norm_scale, norm_offset = self.norm_scale_offset
+        if codec_info is None:
+            codec_info = {'codec_name': 'float32', 'scale': numpy.ones(norm_scale.shape[0]), 'offset': numpy.zeros(norm_scale.shape[0])}
+        if codec_info['codec_name'] == 'bitpack':
+            # Non-binary dimensions are stored as they are; their affine is applied after unpacking
+            codec_info['numeric_affine'] = True
+        codec_info['scale']  = codec_info['scale'] * norm_scale
+        codec_info['offset'] = codec_info['offset'] * norm_scale + norm_offset
+        return codec_info
+
+    def mu_law_transform(self, features):
+        ''' Normalised float32 features to mu-law companded values, same range '''
+        pcm_index = numpy.rint((features - self.norm_mid) * (32768. / self.norm_half))
+        numpy.clip(pcm_index, -32768, 32767, out=pcm_index)
+        return self.mu_law_table[pcm_index.astype(numpy.int32) + 32768]
+
+    def unpack_bitpack(self, code, codec_info):
+        ''' Bits [N, num_binary] uint8 and other dimensions [N, num_other] float32 '''
+        record_bytes, num_packed_bytes = codec_info['record_bytes'], codec_info['num_packed_bytes']
+        code = code[:(code.size // record_bytes) * record_bytes].reshape(-1, record_bytes)
+        bits = numpy.unpackbits(code[:, :num_packed_bytes], axis=1, count=codec_info['binary_index'].shape[0])
+        numeric = numpy.ascontiguousarray(code[:, num_packed_bytes:]).view(numpy.float32)
+        return bits, numeric
+
+    def decode_bitpack(self, code, codec_info):
+        bits, numeric = self.unpack_bitpack(code, codec_info)
+        binary_cols = codec_info['binary_cols']
+        features = numpy.empty((bits.shape[0], codec_info['scale_32'].shape[0]), dtype=numpy.float32)
+        features[:, binary_cols] = bits * codec_info['scale_32'][binary_cols] + codec_info['offset_32'][binary_cols]
+        numeric_cols = codec_info['numeric_cols']
+        if codec_info.get('numeric_affine', False):
+            features[:, numeric_cols] = numeric * codec_info['scale_32'][numeric_cols] + codec_info['offset_32'][numeric_cols]
+        else:
+            features[:, numeric_cols] = numeric
+        return features
+
+    def decode(self, code, codec_info):
+        ''' code: stored array, flat; returns float32 [N, D_codec]; float32 code is overwritten '''
+        if codec_info['codec_name'] == 'bitpack':
+            return self.decode_bitpack(code, codec_info)
+        D = codec_info['scale_32'].shape[0]
+        code = code[:(code.size // D) * D].reshape(-1, D)
+        if 'table' in codec_info:
+            if codec_info['codec_name'] == 'int16':
+                code = code.view(numpy.uint16) ^ numpy.uint16(0x8000) # code + 32768
+            if codec_info['table'].shape[1] == 1:
+                return codec_info['table'][code, 0]
+            return codec_info['table'][code, numpy.arange(D)]
+        if code.dtype == numpy.float32:
+            # Freshly read float32 (e.g. un-normalised files with the loader normaliser): affine in place
+            features = numpy.multiply(code, codec_info['scale_32'], out=code)
+        else:
+            features = numpy.multiply(code, codec_info['scale_32'], dtype=numpy.float32)
+        features += codec_info['offset_32']
+        if self.mu_law_bits is not None:
+            features = self.mu_law_transform(features)
+        return features
+
+    def load(self, file_name, feat_dim):
+        ''' Same return as io_fun.load_binary_file_frame: features [frame_number, feat_dim], frame_number '''
+        codec_info = self.get_codec_info(os.path.dirname(file_name))
+        if codec_info is None:
+            features, frame_number = io_fun.load_binary_file_frame(file_name, feat_dim)
+            if self.mu_law_bits is not None:
+                features = self.mu_law_transform(numpy.asarray(features, dtype=numpy.float32))
+            return features, frame_number
+        from modules import feat_codec_dtype_dict
+        code = numpy.fromfile(file_name, dtype=feat_codec_dtype_dict[codec_info['codec_name']])
+        # Stored dimension (e.g. 80 wav samples per frame) may differ from the loading dimension
+        features = self.decode(code, codec_info).reshape(-1)
+        frame_number = features.size // feat_dim
+        return features[:frame_number * feat_dim].reshape(frame_number, feat_dim), frame_number
+
+def make_feat_decoder_dict(feat_name_list, mu_law_bits=None, mu_value=255., cfg=None, norm_type=None):
+    ''' mu_law_bits: companding of every feature in feat_name_list; with MinMax normalisation range of the feature '''
+    ''' norm_type: 'MinMax' or 'MeanVar' normalisation in the loader, with the statistics of cfg.nn_feat_resil_norm_files '''
+    from modules import load_stats_normaliser_values
+    feat_decoder_dict = {}
+    for feat_name in feat_name_list:
+        norm_min_max = get_norm_min_max_value(feat_name)
+        norm_scale_offset = None
+        if norm_type is not None:
+            norm_scale_offset = load_stats_normaliser_values(cfg.nn_feature_dims[feat_name], cfg.nn_feat_resil_norm_files[feat_name], norm_type, norm_min_max[0], norm_min_max[1], saved_norm_type=get_resil_norm_type(feat_name))
+        feat_decoder_dict[feat_name] = Feat_Decoder(mu_law_bits, mu_value, norm_min_max, norm_scale_offset)
+    return feat_decoder_dict
+
+def make_feat_dir_dict(model_cfg, cfg):
+    ''' Feature directories of the loader: normalised scratch copies, or un-normalised resil files with loader_norm_type '''
+    feat_dir_dict = dict(cfg.nn_feat_scratch_dirs)
+    if model_cfg.loader_norm_type is not None:
+        feat_dir_dict[model_cfg.y_feat_name] = cfg.nn_feat_resil_dirs[model_cfg.y_feat_name]
+    return feat_dir_dict
+
+class Delta_Composer(object):
+    ''' Delta and acceleration of static features in the loader, with the windows and layout of AcousticComposition '''
+    ''' Output columns: for each feature, its static, delta and acc columns; cmp files then keep statics only '''
+    ''' Inputs are normalised statics, so delta and acc are delta(x)/std(x): the offset cancels, but they are not normalised to their own mean and std as stored deltas are '''
+    def __init__(self, static_dim_list, delta_win, acc_win):
+        self.win_list  = [numpy.array(delta_win, dtype=numpy.float32), numpy.array(acc_win, dtype=numpy.float32)]
+        self.win_width = max([len(win) // 2 for win in self.win_list])
+        D = sum(static_dim_list)
+        out_index = []
+        d_start = 0
+        for d in static_dim_list:
+            for k in range(3):
+                out_index.extend(range(k * D + d_start, k * D + d_start + d))
+            d_start += d
+        self.out_index = numpy.array(out_index)
+
+    def compose(self, features, start_frame_index=0, end_frame_index=None, feat_index=None):
+        ''' features: a whole file [frame_number, D], or its static columns feat_index; returns [end-start, 3D] for frames start to end-1 '''
+        ''' Frames next to the segment are taken from the file; only the first and last frames of the file are repeated '''
+        frame_number = features.shape[0]
+        if end_frame_index is None: end_frame_index = frame_number
+        w = self.win_width
+        L = end_frame_index - start_frame_index
+        frame_index = numpy.clip(numpy.arange(start_frame_index - w, end_frame_index + w), 0, frame_number - 1)
+        padded = features[frame_index] if feat_index is None else features[numpy.ix_(frame_index, feat_index)]
+        feat_list = [padded[w:w+L]]
+        for win in self.win_list:
+            # One shifted slice per window tap, over all frames and dimensions
+            t_start = w - len(win) // 2
+            dynamic_features = numpy.zeros(feat_list[0].shape, dtype=padded.dtype)
+            for k in range(len(win)):
+                if win[k] != 0.:
+                    dynamic_features += win[k] * padded[t_start+k:t_start+k+L]
+            feat_list.append(dynamic_features)
+        return numpy.concatenate(feat_list, axis=1)[:, self.out_index]
+
+def make_delta_composer(model_cfg, cfg, feat_list):
+    ''' None unless deltas are used (cmp_use_delta) but not stored in the cmp files (cfg.output_contain_delta) '''
+    if ('wav' in feat_list) or ('lab' in feat_list):
+        return None
+    if (not model_cfg.cmp_use_delta) or cfg.output_contain_delta:
+        return None
+    return Delta_Composer([cfg.acoustic_in_dimension_dict[feat] for feat in feat_list], cfg.delta_win, cfg.acc_win)
+
+def get_utters_from_binary_dict(spk_num_utter, file_list, file_dir_dict, feat_name_list, feat_dim_list, min_file_len=0, random_seed=None, telemetry=None, feat_decoder_dict=None):
     if random_seed is not None:
         numpy.random.seed(random_seed)
     file_name_list = []
@@ -118,7 +393,9 @@ def get_utters_from_binary_dict(spk_num_utter, file_list, file_dir_dict, feat_na
         speaker_utter_list[feat_name] = []
     utter_counter = 0
     while utter_counter < spk_num_utter:
-        file_name, new_utter_len, feat_file_list = get_one_utter_from_binary_dict(file_list, file_dir_dict, feat_name_list, feat_dim_list)
+        if telemetry is not None: read_start_time = time.perf_counter()
+        file_name, new_utter_len, feat_file_list = get_one_utter_from_binary_dict(file_list, file_dir_dict, feat_name_list, feat_dim_list, feat_decoder_dict)
+        if telemetry is not None: telemetry.add_time('read', time.perf_counter() - read_start_time)
         if new_utter_len >= min_file_len:
             utter_counter += 1
             file_name_list.append(file_name)
@@ -127,20 +404,24 @@ def get_utters_from_binary_dict(spk_num_utter, file_list, file_dir_dict, feat_na
                 speaker_utter_list[feat_name].append(feat_file_list[feat_name])
     return file_name_list, speaker_utter_len_list, speaker_utter_list        
 
-def get_one_utter_from_binary_dict(file_list, file_dir_dict, feat_name_list, feat_dim_list):
+def get_one_utter_from_binary_dict(file_list, file_dir_dict, feat_name_list, feat_dim_list, feat_decoder_dict=None):
     # Draw a random file from file_list
     file_name = numpy.random.choice(file_list)
-    frame_number, feature_files = get_one_utter_by_name(file_name, file_dir_dict, feat_name_list, feat_dim_list)
+    frame_number, feature_files = get_one_utter_by_name(file_name, file_dir_dict, feat_name_list, feat_dim_list, feat_decoder_dict)
     return file_name, frame_number, feature_files
 
-def get_one_utter_by_name(file_name, file_dir_dict, feat_name_list, feat_dim_list):
+def get_one_utter_by_name(file_name, file_dir_dict, feat_name_list, feat_dim_list, feat_decoder_dict=None):
     # Given file_name and a list of directories, extension names and extension dimensions
     # Return the file length and the binary files
+    # feat_decoder_dict[feat_name]: Feat_Decoder, for files stored with a codec
     feature_files = {}
     len_list       = []
     for feat_name, feat_dim in zip(feat_name_list, feat_dim_list):
         full_file_name = os.path.join(file_dir_dict[feat_name], file_name+'.'+feat_name)
-        features, frame_number = io_fun.load_binary_file_frame(full_file_name, feat_dim)
+        if (feat_decoder_dict is not None) and (feat_name in feat_decoder_dict):
+            features, frame_number = feat_decoder_dict[feat_name].load(full_file_name, feat_dim)
+        else:
+            features, frame_number = io_fun.load_binary_file_frame(full_file_name, feat_dim)
         len_list.append(frame_number)
         feature_files[feat_name] = features
     # Check for length consistency; and use shortest
@@ -174,35 +455,71 @@ def shift_distance(y, d, l):
     return y_temp
 
 def compute_cosine_distance(lambda_1, lambda_2):
-    d = 0.
-    S = lambda_1.shape[0]
-    B = lambda_1.shape[1]
-    D = lambda_1.shape[2]
-    for i in range(S):
-        for j in range(B):
-            d += scipy.spatial.distance.cosine(lambda_1[i,j], lambda_2[i,j])
-    return d
+    ''' Sum of cosine distances over S and B; see modules_dv for other distances '''
+    from modules_dv import paired_distance
+    return float(numpy.sum(paired_distance(lambda_1, lambda_2, metric='cosine')))
 
 def get_file_id_from_file_name(file_name):
     file_id = file_name.split('/')[-1].split('.')[0]
     return file_id
 
 def linear_interpolate(lf0_data, t_space, t_start, t_end):
+    ''' t_start, t_end: scalars or arrays of any shape; lf0_data is a frame track with frame shift t_space '''
     # t_mid = float(t_start + t_end) / 2.
-    t_mid = float(t_start) / 2.
-    n = int(t_mid / t_space)
-    r = float(t_mid / t_space) - n
+    t_mid = numpy.asarray(t_start, dtype=numpy.float64) / 2.
+    n = numpy.floor(t_mid / t_space).astype(numpy.int64)
+    r = t_mid / t_space - n
     lf0_mid = lf0_data[n] * (1-r) + lf0_data[n+1] * r
     return lf0_mid
 
 def find_pitch_time(pitch_loc_list, t_start, t_end):
-    for t in pitch_loc_list:
-        if t > t_start:
-            if t <= t_end:
-                return t
-        elif t > t_end:
-            return 0
-    return 0
+    ''' First pitch mark in (t_start, t_end], 0 if none; pitch_loc_list is sorted, t_start and t_end may be arrays '''
+    pitch_loc = numpy.asarray(pitch_loc_list, dtype=numpy.float64)
+    t_end = numpy.asarray(t_end, dtype=numpy.float64)
+    pitch_index = numpy.searchsorted(pitch_loc, t_start, side='right')
+    pitch_time  = pitch_loc[numpy.minimum(pitch_index, pitch_loc.shape[0]-1)] if pitch_loc.shape[0] > 0 else numpy.zeros(pitch_index.shape)
+    return numpy.where((pitch_index < pitch_loc.shape[0]) & (pitch_time <= t_end), pitch_time, 0.)
+
+class Pitch_Store(object):
+    ''' Binary pitch stores (see reduce_silence_reaper_output) of one directory, loaded once per file '''
+    ''' Queries are vectorised over windows: pitch time (tau) and interpolated log-F0 at the window centre '''
+    def __init__(self, pitch_dir, pitch_ext='.pitch'):
+        self.pitch_dir = pitch_dir
+        self.pitch_ext = pitch_ext
+        self.pitch_data_dict = {}
+
+    def get_pitch_data(self, file_id):
+        ''' Time stamps, and time stamps and log-F0 of voiced pitch marks '''
+        if file_id not in self.pitch_data_dict:
+            from modules import load_pitch_data
+            pitch_data = load_pitch_data(os.path.join(self.pitch_dir, file_id + self.pitch_ext))
+            voiced = (pitch_data[:, 1] > 0) & (pitch_data[:, 2] > 0)
+            self.pitch_data_dict[file_id] = {'time': pitch_data[:, 0], 'voiced_time': pitch_data[voiced, 0], 'voiced_lf0': numpy.log(pitch_data[voiced, 2])}
+        return self.pitch_data_dict[file_id]
+
+    def query(self, file_id, t_start, t_end):
+        ''' t_start, t_end: arrays of any shape, in seconds; returns pitch time and log-F0, same shape '''
+        ''' Pitch time is the first pitch mark in (t_start, t_end], 0 if none; log-F0 is 0 if the file has no voiced mark '''
+        pitch_data = self.get_pitch_data(file_id)
+        pitch_time = find_pitch_time(pitch_data['time'], t_start, t_end)
+        if pitch_data['voiced_time'].shape[0] == 0:
+            return pitch_time, numpy.zeros(pitch_time.shape)
+        # Linear between voiced marks, constant beyond the first and last
+        t_mid = (numpy.asarray(t_start, dtype=numpy.float64) + t_end) / 2.
+        lf0 = numpy.interp(t_mid, pitch_data['voiced_time'], pitch_data['voiced_lf0'])
+        return pitch_time, lf0
+
+    def query_windows(self, file_id_list, start_index_SB, seq_len, sr):
+        ''' S files, B windows each: start_index_SB [S, B] in samples (frames) at rate sr, window length seq_len '''
+        ''' Returns pitch time relative to the window start, and log-F0, both [S, B] '''
+        t_start_SB = numpy.asarray(start_index_SB, dtype=numpy.float64) / float(sr)
+        t_end_SB   = t_start_SB + float(seq_len) / float(sr)
+        tau_SB = numpy.zeros(t_start_SB.shape)
+        lf0_SB = numpy.zeros(t_start_SB.shape)
+        for s, file_id in enumerate(file_id_list):
+            pitch_time, lf0_SB[s] = self.query(file_id, t_start_SB[s], t_end_SB[s])
+            tau_SB[s] = numpy.where(pitch_time > 0, pitch_time - t_start_SB[s], 0.)
+        return tau_SB, lf0_SB
 
 
 def count_male_female_class_errors(total_wrong_class, male_speaker_list):
@@ -218,6 +535,18 @@ def count_male_female_class_errors(total_wrong_class, male_speaker_list):
         wrong_list[str_temp] += count_temp
     return wrong_list
 
+def count_male_female_confusion(confusion_matrix, speaker_id_list, male_speaker_list):
+    ''' Same counts as count_male_female_class_errors, from confusion_matrix[true_idx, predict_idx] '''
+    ''' speaker_id_list gives the speaker of each index; 'mf' is a male speaker classified as female '''
+    is_male = numpy.array([speaker_id in male_speaker_list for speaker_id in speaker_id_list])
+    wrong_matrix = numpy.array(confusion_matrix, copy=True)
+    numpy.fill_diagonal(wrong_matrix, 0)
+    wrong_list = {'mm':0, 'ff':0, 'mf':0, 'fm':0}
+    for str_temp in wrong_list:
+        x_male, y_male = (str_temp[0] == 'm'), (str_temp[1] == 'm')
+        wrong_list[str_temp] = int(numpy.sum(wrong_matrix[numpy.ix_(is_male == x_male, is_male == y_male)]))
+    return wrong_list
+
 def print_f0_mean_var(norm_file=None):
     if norm_file == None:
         norm_file = 'data/nn_cmp_resil_norm_86_info.dat'
@@ -0,0 +1,516 @@
+# modules_dv.py
+
+import os, pickle, hashlib
+import numpy
+
+from modules import make_logger
+
+'''
+This file contains modules for storing and using d-vectors / lambdas, after the model is trained
+'''
+
+################
+# Lambda Store #
+################
+
+def make_lambda_store_key(nnets_file_name, dv_y_cfg, extra_list=None):
+    ''' sha1 of the model checkpoint and the settings that change lambda values '''
+    ''' Retraining, or changing window settings, gives a new key; old lambdas are never read '''
+    h = hashlib.sha1()
+    with open(nnets_file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(1048576), b''):
+            h.update(chunk)
+    for attri in ['y_feat_name', 'out_feat_list', 'feat_dim', 'feat_index', 'batch_seq_len', 'batch_seq_shift', 'nn_layer_config_list', 'dv_dim']:
+        v = getattr(dv_y_cfg, attri, None)
+        if isinstance(v, numpy.ndarray): v = v.tolist()
+        h.update(('%s=%s;' % (attri, repr(v))).encode())
+    # Settings added later are hashed only when set, so older keys stay valid
+    for attri in ['loader_norm_type', 'mu_law_bits', 'cmp_use_delta']:
+        v = getattr(dv_y_cfg, attri, None)
+        if v:
+            h.update(('%s=%s;' % (attri, repr(v))).encode())
+    delta_composer = getattr(dv_y_cfg, 'delta_composer', None)
+    if delta_composer is not None:
+        # Deltas computed in the loader, not read from the cmp files
+        h.update(('delta_composer=%s;' % repr([win.tolist() for win in delta_composer.win_list])).encode())
+    # Storage codec of the y_feat_name directory, with the loader normaliser folded in, as the decoder reads it
+    feat_dir = getattr(dv_y_cfg, 'feat_dir_dict', {}).get(dv_y_cfg.y_feat_name)
+    feat_decoder = (getattr(dv_y_cfg, 'feat_decoder_dict', None) or {}).get(dv_y_cfg.y_feat_name)
+    if (feat_dir is not None) and (feat_decoder is not None):
+        codec_info = feat_decoder.get_codec_info(feat_dir)
+        if codec_info is not None:
+            h.update(('codec_name=%s;' % codec_info['codec_name']).encode())
+            for k in ['scale', 'offset', 'binary_mask']:
+                if k in codec_info:
+                    h.update(numpy.ascontiguousarray(codec_info[k]).tobytes())
+    for v in (extra_list or []):
+        h.update(('%s;' % repr(v)).encode())
+    return h.hexdigest()
+
+class Lambda_Store(object):
+    ''' Per-utterance lambda_u and window count B_u, as a memory-mapped float32 matrix plus a file-id index '''
+    ''' Each row is [lambda_u (dv_dim), B_u]; rows are appended, so only new utterances are computed '''
+    ''' Files: lambda_store_<key>.dat (rows), lambda_store_<key>.idx (one file id per line) '''
+    def __init__(self, store_dir, store_key, dv_dim):
+        self.logger = make_logger("Lambda_Store")
+        self.dv_dim = dv_dim
+        self.row_dim = dv_dim + 1
+        self.row_bytes = self.row_dim * 4
+        if not os.path.exists(store_dir):
+            os.makedirs(store_dir)
+        self.data_file_name  = os.path.join(store_dir, 'lambda_store_%s.dat' % store_key)
+        self.index_file_name = os.path.join(store_dir, 'lambda_store_%s.idx' % store_key)
+        self.load_index()
+        self.logger.info('Opened %s, %i utterances' % (self.data_file_name, len(self.file_id_list)))
+
+    def load_index(self):
+        self.file_id_list = []
+        partial_line = False
+        if os.path.isfile(self.index_file_name):
+            with open(self.index_file_name, 'r') as f:
+                line_list = f.readlines()
+            # An interrupted append can leave a last line without its newline; drop it
+            if line_list and not line_list[-1].endswith('\n'):
+                partial_line = True
+                line_list = line_list[:-1]
+            self.file_id_list = [x.strip() for x in line_list if x.strip() != '']
+        if os.path.isfile(self.data_file_name):
+            data_size = os.path.getsize(self.data_file_name)
+        else:
+            data_size = 0
+        # A crash between the two appends leaves one file longer; keep the complete rows only
+        num_valid = min(data_size // self.row_bytes, len(self.file_id_list))
+        if partial_line or (num_valid < len(self.file_id_list)) or (data_size != num_valid * self.row_bytes):
+            self.logger.info('Truncating to %i complete rows' % num_valid)
+            self.file_id_list = self.file_id_list[:num_valid]
+            with open(self.data_file_name, 'ab') as f:
+                f.truncate(num_valid * self.row_bytes)
+            with open(self.index_file_name, 'w') as f:
+                for file_id in self.file_id_list:
+                    f.write(file_id + '\n')
+        self.file_id_index = {file_id: i for i, file_id in enumerate(self.file_id_list)}
+        self.matrix = None
+
+    def __len__(self):
+        return len(self.file_id_list)
+
+    def __contains__(self, file_id):
+        return file_id in self.file_id_index
+
+    def find_missing(self, file_id_list):
+        return [file_id for file_id in file_id_list if file_id not in self.file_id_index]
+
+    def append(self, file_id, lambda_u, B_u):
+        ''' Data first, then index; an interrupted append is dropped on next load '''
+        row = numpy.zeros(self.row_dim, dtype=numpy.float32)
+        row[:self.dv_dim] = lambda_u
+        row[self.dv_dim]  = B_u
+        with open(self.data_file_name, 'ab') as f:
+            f.write(row.tobytes())
+        with open(self.index_file_name, 'a') as f:
+            f.write(file_id + '\n')
+        self.file_id_index[file_id] = len(self.file_id_list)
+        self.file_id_list.append(file_id)
+        self.matrix = None
+
+    def get_matrix(self):
+        ''' Memory-mapped (N, dv_dim+1) view of all rows; re-mapped after appends '''
+        if self.matrix is None:
+            if len(self.file_id_list) == 0:
+                self.matrix = numpy.zeros((0, self.row_dim), dtype=numpy.float32)
+            else:
+                self.matrix = numpy.memmap(self.data_file_name, dtype=numpy.float32, mode='r', shape=(len(self.file_id_list), self.row_dim))
+        return self.matrix
+
+    def __getitem__(self, file_id):
+        ''' Same as lambda_u_dict[file_id]: [lambda_u, B_u] '''
+        row = self.get_matrix()[self.file_id_index[file_id]]
+        return [numpy.array(row[:self.dv_dim]), int(row[self.dv_dim])]
+
+    def get_lambda_B(self, file_id_list):
+        ''' Return lambda (N, dv_dim) and B (N,) arrays for file_id_list, in that order '''
+        index_list = [self.file_id_index[file_id] for file_id in file_id_list]
+        rows = self.get_matrix()[index_list]
+        return rows[:, :self.dv_dim], rows[:, self.dv_dim]
+
+###########################
+# Speaker Embedding Index #
+###########################
+
+class Speaker_Index(object):
+    ''' Enrolled d-vectors / lambdas, unit length, for cosine top-k search '''
+    ''' Rows can be per-speaker or per-utterance; search returns the speaker id of each hit row '''
+    ''' Enrolment appends rows (capacity doubles), so new speakers never need a rebuild '''
+    ''' build_ivf() adds an approximate inverted-file index: k-means lists, search probes num_probe lists only '''
+    def __init__(self, dv_dim):
+        self.dv_dim = dv_dim
+        self.num_rows = 0
+        self.dv_N_D = numpy.zeros((1024, dv_dim), dtype=numpy.float32)
+        self.speaker_id_list = []
+        self.centroid_L_D = None
+        self.list_index_N = numpy.zeros(1024, dtype=numpy.int32)
+        self.list_row_list = None # Row numbers of each IVF list
+
+    def enrol(self, speaker_id_list, dv_N_D):
+        dv_N_D = normalise_rows(numpy.atleast_2d(dv_N_D))
+        N = dv_N_D.shape[0]
+        assert N == len(speaker_id_list)
+        if self.num_rows + N > self.dv_N_D.shape[0]:
+            capacity = max(2 * self.dv_N_D.shape[0], self.num_rows + N)
+            dv_new = numpy.zeros((capacity, self.dv_dim), dtype=numpy.float32)
+            dv_new[:self.num_rows] = self.dv_N_D[:self.num_rows]
+            self.dv_N_D = dv_new
+            list_index_new = numpy.zeros(capacity, dtype=numpy.int32)
+            list_index_new[:self.num_rows] = self.list_index_N[:self.num_rows]
+            self.list_index_N = list_index_new
+        self.dv_N_D[self.num_rows:self.num_rows+N] = dv_N_D
+        if self.centroid_L_D is not None:
+            list_index_new = numpy.argmax(numpy.dot(dv_N_D, self.centroid_L_D.T), axis=1)
+            self.list_index_N[self.num_rows:self.num_rows+N] = list_index_new
+            if self.list_row_list is not None:
+                for l, row_list in zip(*group_rows_by_list(list_index_new, self.centroid_L_D.shape[0], self.num_rows)):
+                    self.list_row_list[l] = numpy.concatenate([self.list_row_list[l], row_list])
+        self.speaker_id_list.extend(speaker_id_list)
+        self.num_rows += N
+
+    def build_ivf(self, num_lists, num_iter=10):
+        ''' Spherical k-means over enrolled rows; later enrolments are assigned to the nearest list '''
+        dv_N_D = self.dv_N_D[:self.num_rows]
+        num_lists = min(num_lists, self.num_rows)
+        centroid_L_D = dv_N_D[numpy.random.choice(self.num_rows, num_lists, replace=False)].copy()
+        for i in range(num_iter):
+            list_index_N = numpy.argmax(numpy.dot(dv_N_D, centroid_L_D.T), axis=1)
+            sum_L_D = numpy.zeros_like(centroid_L_D)
+            numpy.add.at(sum_L_D, list_index_N, dv_N_D)
+            non_empty = numpy.linalg.norm(sum_L_D, axis=1) > 0
+            centroid_L_D[non_empty] = normalise_rows(sum_L_D[non_empty])
+        self.centroid_L_D = centroid_L_D
+        self.list_index_N[:self.num_rows] = numpy.argmax(numpy.dot(dv_N_D, centroid_L_D.T), axis=1)
+        self.make_list_rows()
+
+    def make_list_rows(self):
+        ''' Row numbers of each list, so search reads the probed lists only '''
+        self.list_row_list = [numpy.zeros(0, dtype=numpy.int64) for l in range(self.centroid_L_D.shape[0])]
+        for l, row_list in zip(*group_rows_by_list(self.list_index_N[:self.num_rows], self.centroid_L_D.shape[0])):
+            self.list_row_list[l] = row_list
+
+    def search(self, query_Q_D, k=1, num_probe=0):
+        ''' Return speaker ids (Q * k) and cosine scores (Q * k), best first '''
+        ''' num_probe > 0 uses the IVF lists; 0 is exact search '''
+        ''' If the probed lists hold fewer than k rows, the remaining slots are id -1, score -inf '''
+        query_Q_D = normalise_rows(numpy.atleast_2d(query_Q_D))
+        k = min(k, self.num_rows)
+        if num_probe > 0 and self.centroid_L_D is not None:
+            Q = query_Q_D.shape[0]
+            row_Q_K   = numpy.full((Q, k), -1, dtype=numpy.int64)
+            score_Q_K = numpy.full((Q, k), -numpy.inf, dtype=numpy.float32)
+            probe_Q_P = top_k_index(numpy.dot(query_Q_D, self.centroid_L_D.T), num_probe)
+            for q in range(Q):
+                row_list = numpy.concatenate([self.list_row_list[l] for l in probe_Q_P[q]])
+                if row_list.shape[0] == 0:
+                    continue
+                score_list = numpy.dot(self.dv_N_D[row_list], query_Q_D[q])
+                top = top_k_index(score_list[numpy.newaxis], k)[0]
+                row_Q_K[q, :len(top)]   = row_list[top]
+                score_Q_K[q, :len(top)] = score_list[top]
+        else:
+            score_Q_N = numpy.dot(query_Q_D, self.dv_N_D[:self.num_rows].T)
+            row_Q_K   = top_k_index(score_Q_N, k)
+            score_Q_K = numpy.take_along_axis(score_Q_N, row_Q_K, axis=1)
+        speaker_id_Q_K = numpy.full(row_Q_K.shape, -1, dtype=object)
+        found = row_Q_K >= 0
+        speaker_id_Q_K[found] = numpy.array(self.speaker_id_list, dtype=object)[row_Q_K[found]]
+        return speaker_id_Q_K, score_Q_K
+
+    def save(self, index_file_name):
+        pickle.dump({'dv_N_D': self.dv_N_D[:self.num_rows], 'speaker_id_list': self.speaker_id_list, 'centroid_L_D': self.centroid_L_D, 'list_index_N': self.list_index_N[:self.num_rows]}, open(index_file_name, 'wb'))
+
+    def load(self, index_file_name):
+        ''' dv_dim is taken from the file '''
+        index_dict = pickle.load(open(index_file_name, 'rb'))
+        self.__init__(index_dict['dv_N_D'].shape[1])
+        self.enrol(index_dict['speaker_id_list'], index_dict['dv_N_D'])
+        self.centroid_L_D = index_dict['centroid_L_D']
+        if self.centroid_L_D is not None:
+            self.list_index_N[:self.num_rows] = index_dict['list_index_N']
+            self.make_list_rows()
+
+def group_rows_by_list(list_index_N, num_lists, row_offset=0):
+    ''' Non-empty lists, and the (offset) row numbers in each; one stable sort '''
+    order_N = numpy.argsort(list_index_N, kind='stable')
+    bound_L = numpy.searchsorted(list_index_N[order_N], numpy.arange(num_lists+1))
+    l_list = [l for l in range(num_lists) if bound_L[l+1] > bound_L[l]]
+    return l_list, [order_N[bound_L[l]:bound_L[l+1]] + row_offset for l in l_list]
+
+def normalise_rows(x_N_D):
+    x_N_D = numpy.asarray(x_N_D, dtype=numpy.float32)
+    norm_N = numpy.linalg.norm(x_N_D, axis=1, keepdims=True)
+    return x_N_D / numpy.maximum(norm_N, 1e-12)
+
+def top_k_index(score_Q_N, k):
+    ''' Indices of the k largest scores per row, best first; argpartition then sort k only '''
+    k = min(k, score_Q_N.shape[1])
+    if k < score_Q_N.shape[1]:
+        part_Q_K = numpy.argpartition(-score_Q_N, k-1, axis=1)[:, :k]
+    else:
+        part_Q_K = numpy.tile(numpy.arange(k), (score_Q_N.shape[0], 1))
+    order_Q_K = numpy.argsort(-numpy.take_along_axis(score_Q_N, part_Q_K, axis=1), axis=1)
+    return numpy.take_along_axis(part_Q_K, order_Q_K, axis=1)
+
+def make_speaker_index_from_lambda_store(lambda_store, file_id_list, per_speaker=True):
+    ''' per_speaker: one row per speaker, lambda_u averaged with B_u weights; else one row per utterance '''
+    lambda_N_D, B_N = lambda_store.get_lambda_B(file_id_list)
+    speaker_id_N = [file_id.split('/')[-1].split('.')[0].split('_')[0] for file_id in file_id_list]
+    speaker_index = Speaker_Index(lambda_store.dv_dim)
+    if per_speaker:
+        speaker_id_list, spk_idx_N = numpy.unique(speaker_id_N, return_inverse=True)
+        sum_S_D = numpy.zeros((len(speaker_id_list), lambda_store.dv_dim))
+        numpy.add.at(sum_S_D, spk_idx_N, lambda_N_D * B_N[:, numpy.newaxis])
+        sum_S = numpy.bincount(spk_idx_N, weights=B_N)
+        speaker_index.enrol(list(speaker_id_list), sum_S_D / sum_S[:, numpy.newaxis])
+    else:
+        speaker_index.enrol(speaker_id_N, lambda_N_D)
+    return speaker_index
+
+def make_speaker_index_from_dv_file(dv_file_name, num_lists=0):
+    ''' One row per speaker, from the dict[speaker_id] = dv pickle written by gen_dv_y_model '''
+    dv_values = pickle.load(open(dv_file_name, 'rb'))
+    speaker_id_list = sorted(dv_values.keys())
+    dv_N_D = numpy.stack([numpy.asarray(dv_values[speaker_id], dtype=numpy.float32) for speaker_id in speaker_id_list])
+    speaker_index = Speaker_Index(dv_N_D.shape[1])
+    speaker_index.enrol(speaker_id_list, dv_N_D)
+    if num_lists > 0:
+        speaker_index.build_ivf(num_lists)
+    return speaker_index
+
+def load_speaker_index(dv_file_name, index_file_name, num_lists=0):
+    ''' Speaker index saved next to dv_file_name; rebuilt and saved if missing or older than dv_file_name '''
+    if os.path.isfile(index_file_name) and os.path.getmtime(index_file_name) >= os.path.getmtime(dv_file_name):
+        speaker_index = Speaker_Index(0)
+        speaker_index.load(index_file_name)
+    else:
+        speaker_index = make_speaker_index_from_dv_file(dv_file_name, num_lists)
+        speaker_index.save(index_file_name)
+    return speaker_index
+
+########################
+# Speaker Verification #
+########################
+
+class Score_Histogram(object):
+    ''' Counts of target and non-target cosine scores, in num_bins equal bins over [-1, 1] '''
+    ''' Memory is 2 * num_bins counts, whatever the number of trials; DET thresholds are the bin edges '''
+    def __init__(self, num_bins=20000):
+        self.num_bins = num_bins
+        self.edges = numpy.linspace(-1., 1., num_bins + 1)
+        self.target_count    = numpy.zeros(num_bins, dtype=numpy.int64)
+        self.nontarget_count = numpy.zeros(num_bins, dtype=numpy.int64)
+
+    def count_bins(self, scores):
+        bin_index = numpy.clip(numpy.floor((numpy.asarray(scores, dtype=numpy.float64) + 1.) * (self.num_bins / 2.)), 0, self.num_bins - 1).astype(numpy.int64)
+        return numpy.bincount(bin_index, minlength=self.num_bins)
+
+    def add(self, target_scores, nontarget_scores):
+        self.target_count    += self.count_bins(target_scores)
+        self.nontarget_count += self.count_bins(nontarget_scores)
+
+    def merge(self, other):
+        self.target_count    += other.target_count
+        self.nontarget_count += other.nontarget_count
+
+    def compute_det_curve(self):
+        ''' As compute_det_curve; threshold[k] accepts bins k on, so EER and minDCF are within one bin width of the exact ones '''
+        thresholds = numpy.concatenate([[-numpy.inf], self.edges[1:]])
+        P_miss = numpy.concatenate([[0], numpy.cumsum(self.target_count)]) / float(numpy.sum(self.target_count))
+        P_fa   = 1. - numpy.concatenate([[0], numpy.cumsum(self.nontarget_count)]) / float(numpy.sum(self.nontarget_count))
+        return P_miss, P_fa, thresholds
+
+    def compute_verification_metrics(self, P_target=0.01, C_miss=1., C_fa=1., num_det_points=1000):
+        P_miss, P_fa, thresholds = self.compute_det_curve()
+        return make_verification_metrics(P_miss, P_fa, thresholds, int(numpy.sum(self.target_count)), int(numpy.sum(self.nontarget_count)), P_target, C_miss, C_fa, num_det_points)
+
+def score_all_pair_trials(lambda_N_D, speaker_idx_N, block_size=2048, num_threads=4, num_bins=20000):
+    ''' Score_Histogram of the cosine scores of all utterance pairs i<j, target and non-target '''
+    ''' Row blocks of the score matrix are computed in parallel threads and reduced to counts; memory is bounded by block_size * N '''
+    from concurrent.futures import ThreadPoolExecutor
+    x_N_D = normalise_rows(lambda_N_D)
+    speaker_idx_N = numpy.asarray(speaker_idx_N)
+    N = x_N_D.shape[0]
+    score_histogram = Score_Histogram(num_bins)
+
+    def score_block(n_start):
+        n_end = min(n_start + block_size, N)
+        score_b_N = numpy.dot(x_N_D[n_start:n_end], x_N_D.T)
+        # Upper triangle only: column j > row i
+        keep_b_N = numpy.arange(N)[numpy.newaxis, :] > numpy.arange(n_start, n_end)[:, numpy.newaxis]
+        target_b_N = speaker_idx_N[n_start:n_end, numpy.newaxis] == speaker_idx_N[numpy.newaxis, :]
+        block_histogram = Score_Histogram(num_bins)
+        block_histogram.add(score_b_N[keep_b_N & target_b_N], score_b_N[keep_b_N & ~target_b_N])
+        return block_histogram
+
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        for block_histogram in executor.map(score_block, range(0, N, block_size)):
+            score_histogram.merge(block_histogram)
+    return score_histogram
+
+def make_sampled_trial_list(speaker_idx_N, num_nontarget, seed=545):
+    ''' All target pairs i<j, plus num_nontarget random non-target pairs; (M, 2) row indices and (M,) is_target '''
+    speaker_idx_N = numpy.asarray(speaker_idx_N)
+    if num_nontarget > 0 and numpy.unique(speaker_idx_N).shape[0] < 2:
+        raise ValueError('Non-target trials need at least two speakers')
+    target_list = []
+    for speaker_idx in numpy.unique(speaker_idx_N):
+        row_list = numpy.flatnonzero(speaker_idx_N == speaker_idx)
+        i, j = numpy.triu_indices(row_list.shape[0], k=1)
+        target_list.append(numpy.stack([row_list[i], row_list[j]], axis=1))
+    target_M_2 = numpy.concatenate(target_list, axis=0)
+    # Draw pairs until there are enough non-target ones; mostly one round when there are many speakers
+    rng = numpy.random.RandomState(seed)
+    N = speaker_idx_N.shape[0]
+    nontarget_list = []
+    num_drawn = 0
+    while num_drawn < num_nontarget:
+        pair_M_2 = rng.randint(N, size=(2 * (num_nontarget - num_drawn), 2))
+        pair_M_2 = pair_M_2[speaker_idx_N[pair_M_2[:,0]] != speaker_idx_N[pair_M_2[:,1]]][:num_nontarget - num_drawn]
+        nontarget_list.append(pair_M_2)
+        num_drawn += pair_M_2.shape[0]
+    nontarget_M_2 = numpy.concatenate(nontarget_list, axis=0) if nontarget_list else numpy.zeros((0, 2), dtype=int)
+    is_target_M = numpy.concatenate([numpy.ones(target_M_2.shape[0], dtype=bool), numpy.zeros(nontarget_M_2.shape[0], dtype=bool)])
+    return numpy.concatenate([target_M_2, nontarget_M_2], axis=0), is_target_M
+
+def score_trial_list(lambda_N_D, trial_index_M_2, block_size=1000000, num_threads=4):
+    ''' Cosine scores of explicit trials (pairs of row indices), in parallel chunks '''
+    from concurrent.futures import ThreadPoolExecutor
+    x_N_D = normalise_rows(lambda_N_D)
+    M = trial_index_M_2.shape[0]
+
+    def score_chunk(m_start):
+        idx = trial_index_M_2[m_start:m_start+block_size]
+        return numpy.einsum('md,md->m', x_N_D[idx[:,0]], x_N_D[idx[:,1]])
+
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        return numpy.concatenate(list(executor.map(score_chunk, range(0, M, block_size))))
+
+def compute_det_curve(target_scores, nontarget_scores):
+    ''' Sort each score set once; P_miss and P_fa at every threshold by searchsorted '''
+    ''' Returns P_miss, P_fa, thresholds; threshold[i] accepts scores > threshold[i] '''
+    target_sorted    = numpy.sort(target_scores)
+    nontarget_sorted = numpy.sort(nontarget_scores)
+    # Merge of two sorted runs
+    thresholds = numpy.concatenate([[-numpy.inf], numpy.sort(numpy.concatenate([target_sorted, nontarget_sorted]), kind='mergesort')])
+    P_miss = numpy.searchsorted(target_sorted, thresholds, side='right') / float(target_sorted.shape[0])
+    P_fa   = 1. - numpy.searchsorted(nontarget_sorted, thresholds, side='right') / float(nontarget_sorted.shape[0])
+    return P_miss, P_fa, thresholds
+
+def compute_eer(P_miss, P_fa, thresholds):
+    ''' Linear interpolation at the crossing of P_miss and P_fa '''
+    i = numpy.searchsorted(P_miss - P_fa, 0.)
+    i = min(max(i, 1), P_miss.shape[0]-1)
+    d0 = P_fa[i-1] - P_miss[i-1]
+    d1 = P_fa[i]   - P_miss[i]
+    a = d0 / (d0 - d1) if d0 != d1 else 0.
+    eer = P_miss[i-1] + a * (P_miss[i] - P_miss[i-1])
+    return eer, thresholds[i]
+
+def compute_min_dcf(P_miss, P_fa, thresholds, P_target=0.01, C_miss=1., C_fa=1.):
+    ''' Normalised minimum detection cost '''
+    dcf = C_miss * P_target * P_miss + C_fa * (1. - P_target) * P_fa
+    i = numpy.argmin(dcf)
+    return dcf[i] / min(C_miss * P_target, C_fa * (1. - P_target)), thresholds[i]
+
+def compute_verification_metrics(target_scores, nontarget_scores, P_target=0.01, C_miss=1., C_fa=1., num_det_points=1000):
+    ''' EER, minDCF, and DET points (P_miss, P_fa) reduced to about num_det_points '''
+    P_miss, P_fa, thresholds = compute_det_curve(target_scores, nontarget_scores)
+    return make_verification_metrics(P_miss, P_fa, thresholds, target_scores.shape[0], nontarget_scores.shape[0], P_target, C_miss, C_fa, num_det_points)
+
+def make_verification_metrics(P_miss, P_fa, thresholds, num_target, num_nontarget, P_target=0.01, C_miss=1., C_fa=1., num_det_points=1000):
+    eer, eer_threshold = compute_eer(P_miss, P_fa, thresholds)
+    min_dcf, dcf_threshold = compute_min_dcf(P_miss, P_fa, thresholds, P_target, C_miss, C_fa)
+    det_index = numpy.unique(numpy.linspace(0, P_miss.shape[0]-1, num_det_points).astype(int))
+    return {'eer': eer, 'eer_threshold': eer_threshold, 'min_dcf': min_dcf, 'min_dcf_threshold': dcf_threshold, \
+            'num_target': num_target, 'num_nontarget': num_nontarget, \
+            'det_P_miss': P_miss[det_index], 'det_P_fa': P_fa[det_index], 'det_threshold': thresholds[det_index]}
+
+#############
+# Distances #
+#############
+
+''' Distances between lambdas / d-vectors; numpy arrays or torch tensors (computed on their device) '''
+''' metric: 'cosine' (1 - cosine similarity), 'euclidean', 'dot' (negative dot product, smaller is closer) '''
+''' dtype: accumulation type; None keeps float64 for numpy and the tensor dtype for torch '''
+
+def paired_distance(x_1, x_2, metric='cosine', dtype=None, chunk_size=65536):
+    ''' Distance between x_1[...] and x_2[...] along the last axis, e.g. S*B*D -> S*B '''
+    is_torch = not isinstance(x_1, numpy.ndarray)
+    D = x_1.shape[-1]
+    out_shape = x_1.shape[:-1]
+    x_1 = x_1.reshape(-1, D)
+    x_2 = x_2.reshape(-1, D)
+    d_list = []
+    for n_start in range(0, x_1.shape[0], chunk_size):
+        a = cast_to_dtype(x_1[n_start:n_start+chunk_size], dtype, is_torch)
+        b = cast_to_dtype(x_2[n_start:n_start+chunk_size], dtype, is_torch)
+        ab = (a * b).sum(-1)
+        if metric == 'dot':
+            d = -ab
+        elif metric == 'euclidean':
+            d = ((a - b) ** 2).sum(-1) ** 0.5
+        elif metric == 'cosine':
+            d = 1. - ab / clip_min(row_norm(a, is_torch) * row_norm(b, is_torch), 1e-12, is_torch)
+        else:
+            raise ValueError('Unknown metric %s' % metric)
+        d_list.append(d)
+    if is_torch:
+        import torch
+        return torch.cat(d_list).reshape(out_shape)
+    else:
+        return numpy.concatenate(d_list).reshape(out_shape)
+
+def pairwise_distance(x_N_D, y_M_D, metric='cosine', dtype=None, chunk_size=4096):
+    ''' All-pairs distance matrix N*M; x is processed in row chunks, so memory is chunk_size*M '''
+    is_torch = not isinstance(x_N_D, numpy.ndarray)
+    y_M_D = cast_to_dtype(y_M_D, dtype, is_torch)
+    if metric == 'cosine':
+        y_M_D = y_M_D / clip_min(row_norm(y_M_D, is_torch)[:, None], 1e-12, is_torch)
+    elif metric == 'euclidean':
+        y_sq_M = (y_M_D ** 2).sum(-1)
+    elif metric != 'dot':
+        raise ValueError('Unknown metric %s' % metric)
+    d_list = []
+    for n_start in range(0, x_N_D.shape[0], chunk_size):
+        a = cast_to_dtype(x_N_D[n_start:n_start+chunk_size], dtype, is_torch)
+        if metric == 'cosine':
+            a = a / clip_min(row_norm(a, is_torch)[:, None], 1e-12, is_torch)
+        ab = a @ y_M_D.T
+        if metric == 'dot':
+            d = -ab
+        elif metric == 'cosine':
+            d = 1. - ab
+        elif metric == 'euclidean':
+            # |a-b|^2 = |a|^2 + |b|^2 - 2ab; clip rounding below 0
+            d_sq = (a ** 2).sum(-1)[:, None] + y_sq_M[None, :] - 2. * ab
+            d = clip_min(d_sq, 0., is_torch) ** 0.5
+        d_list.append(d)
+    if is_torch:
+        import torch
+        return torch.cat(d_list, 0)
+    else:
+        return numpy.concatenate(d_list, axis=0)
+
+def cast_to_dtype(x, dtype, is_torch):
+    if is_torch:
+        return x if dtype is None else x.to(dtype)
+    else:
+        return numpy.asarray(x, dtype=numpy.float64 if dtype is None else dtype)
+
+def row_norm(x, is_torch):
+    if is_torch:
+        return x.norm(dim=-1)
+    else:
+        return numpy.linalg.norm(x, axis=-1)
+
+def clip_min(x, min_value, is_torch):
+    if is_torch:
+        return x.clamp(min=min_value)
+    else:
+        return numpy.maximum(x, min_value)
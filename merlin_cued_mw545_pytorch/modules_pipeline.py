@@ -0,0 +1,296 @@
+# modules_pipeline.py
+
+import os, hashlib, json
+import numpy
+
+from modules import make_logger, prepare_file_path, run_parallel_file_tasks
+
+'''
+This file contains an incremental data preparation pipeline
+Each stage declares its inputs, outputs and parameters; a manifest keeps content hashes
+Only files whose inputs or parameters changed are rebuilt, and changes propagate to later stages through file contents
+'''
+
+############
+# Manifest #
+############
+
+def hash_file_worker(worker_state, file_name):
+    h = hashlib.sha1()
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(1048576), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def make_param_hash(param_dict):
+    ''' sha1 of stage parameters; numpy arrays as lists '''
+    param_dict = {k: (v.tolist() if isinstance(v, numpy.ndarray) else v) for k, v in param_dict.items()}
+    return hashlib.sha1(json.dumps(param_dict, sort_keys=True, default=str).encode()).hexdigest()
+
+def make_record_key(param_hash, input_hash_list):
+    return hashlib.sha1((param_hash + ';' + ';'.join(input_hash_list)).encode()).hexdigest()
+
+class Pipeline_Manifest(object):
+    ''' JSON file; file_hash[path] = [size, mtime_ns, sha1], stage_records[stage_name][record_name] = key of the parameters and input hashes it was built from '''
+    ''' A file is only re-hashed when its size or mtime changes '''
+    def __init__(self, manifest_file):
+        self.logger = make_logger("Pipeline_Manifest")
+        self.manifest_file = manifest_file
+        self.file_hash = {}
+        self.stage_records = {}
+        if os.path.exists(manifest_file):
+            with open(manifest_file, 'r') as f:
+                manifest_dict = json.load(f)
+            self.file_hash = manifest_dict['file_hash']
+            self.stage_records = manifest_dict['stage_records']
+        self.logger.info('Opened %s, %i file hashes' % (manifest_file, len(self.file_hash)))
+
+    def save(self):
+        ''' Written to a temporary file first, so an interrupted save keeps the old manifest '''
+        prepare_file_path(os.path.dirname(self.manifest_file))
+        temp_file = self.manifest_file + '.tmp'
+        with open(temp_file, 'w') as f:
+            json.dump({'file_hash': self.file_hash, 'stage_records': self.stage_records}, f)
+        os.replace(temp_file, self.manifest_file)
+
+    def update_hashes(self, file_list, num_workers=1):
+        ''' Re-hash files that are new, or changed size or mtime; missing files are dropped '''
+        new_file_list = []
+        for file_name in set(file_list):
+            if not os.path.exists(file_name):
+                self.file_hash.pop(file_name, None)
+                continue
+            st = os.stat(file_name)
+            if (file_name not in self.file_hash) or (self.file_hash[file_name][:2] != [st.st_size, st.st_mtime_ns]):
+                new_file_list.append(file_name)
+        if len(new_file_list) > 0:
+            def record_hash(task, file_sha1):
+                st = os.stat(task[0])
+                self.file_hash[task[0]] = [st.st_size, st.st_mtime_ns, file_sha1]
+            run_parallel_file_tasks(hash_file_worker, [(x,) for x in new_file_list], num_workers=num_workers, result_fn=record_hash, task_name='hashed files')
+
+    def get_hash(self, file_name):
+        ''' None if the file does not exist; call update_hashes first '''
+        if file_name in self.file_hash:
+            return self.file_hash[file_name][2]
+        return None
+
+    def get_record(self, stage_name, record_name):
+        return self.stage_records.get(stage_name, {}).get(record_name, None)
+
+    def set_record(self, stage_name, record_name, record_key):
+        if stage_name not in self.stage_records:
+            self.stage_records[stage_name] = {}
+        self.stage_records[stage_name][record_name] = record_key
+
+##########
+# Stages #
+##########
+
+class File_Stage(object):
+    ''' One record per file_id: input_fn(file_id) and output_fn(file_id) give file lists, task_fn(file_id) the task tuple of process_fn '''
+    ''' process_fn and init_fn follow run_parallel_file_tasks '''
+    def __init__(self, stage_name, param_dict, input_fn, output_fn, process_fn, task_fn, init_fn=None, init_args=()):
+        self.stage_name = stage_name
+        self.param_dict = param_dict
+        self.input_fn   = input_fn
+        self.output_fn  = output_fn
+        self.process_fn = process_fn
+        self.task_fn    = task_fn
+        self.init_fn    = init_fn
+        self.init_args  = init_args
+
+class Aggregate_Stage(object):
+    ''' One record from many files, e.g. a normaliser: input_fn(file_id_list) and output_list are file lists, run_fn(file_id_list) builds it '''
+    ''' update_fn(file_id_list, new_input_list), optional: adds new inputs to the outputs, when parameters and all old inputs are unchanged '''
+    def __init__(self, stage_name, param_dict, input_fn, output_list, run_fn, update_fn=None):
+        self.stage_name  = stage_name
+        self.param_dict  = param_dict
+        self.input_fn    = input_fn
+        self.output_list = output_list
+        self.run_fn      = run_fn
+        self.update_fn   = update_fn
+
+def file_stage_worker(worker_state, file_id, process_fn, task):
+    process_fn(worker_state, *task)
+    return file_id
+
+def run_file_stage(stage, file_id_list, manifest, num_workers=1, force=False):
+    ''' Rebuild files whose inputs or parameters changed, or whose outputs are missing; returns the number rebuilt '''
+    logger = make_logger("pipeline")
+    param_hash = make_param_hash(stage.param_dict)
+    input_dict = {file_id: stage.input_fn(file_id) for file_id in file_id_list}
+    manifest.update_hashes([x for file_id in file_id_list for x in input_dict[file_id]], num_workers)
+
+    rebuild_key_dict = {}
+    num_missing_input = 0
+    for file_id in file_id_list:
+        input_hash_list = [manifest.get_hash(x) for x in input_dict[file_id]]
+        if None in input_hash_list:
+            num_missing_input += 1
+            continue
+        record_key = make_record_key(param_hash, input_hash_list)
+        if force or (manifest.get_record(stage.stage_name, file_id) != record_key) or (not all([os.path.exists(x) for x in stage.output_fn(file_id)])):
+            rebuild_key_dict[file_id] = record_key
+    logger.info('%s: %i of %i files to rebuild; %i with missing inputs' % (stage.stage_name, len(rebuild_key_dict), len(file_id_list), num_missing_input))
+    if len(rebuild_key_dict) == 0:
+        return 0
+
+    task_list = [(file_id, stage.process_fn, stage.task_fn(file_id)) for file_id in rebuild_key_dict]
+    size_list = [sum([manifest.file_hash[x][0] for x in input_dict[file_id]]) for file_id in rebuild_key_dict]
+    done_list = []
+    try:
+        run_parallel_file_tasks(file_stage_worker, task_list, stage.init_fn, stage.init_args, num_workers=num_workers, size_list=size_list, result_fn=lambda task, file_id: done_list.append(file_id), task_name=stage.stage_name+' files')
+    finally:
+        # Record finished files, also when some failed
+        for file_id in done_list:
+            manifest.set_record(stage.stage_name, file_id, rebuild_key_dict[file_id])
+        manifest.save()
+    return len(done_list)
+
+def run_aggregate_stage(stage, file_id_list, manifest, num_workers=1, force=False):
+    logger = make_logger("pipeline")
+    param_hash = make_param_hash(stage.param_dict)
+    input_list = sorted(stage.input_fn(file_id_list))
+    manifest.update_hashes(input_list, num_workers)
+    input_hash_list = [manifest.get_hash(x) for x in input_list]
+    if None in input_hash_list:
+        raise IOError('%s: %i input files missing' % (stage.stage_name, input_hash_list.count(None)))
+    record_key = make_record_key(param_hash, input_hash_list)
+    outputs_exist = all([os.path.exists(x) for x in stage.output_list])
+    if (not force) and (manifest.get_record(stage.stage_name, 'all') == record_key) and outputs_exist:
+        logger.info('%s: up to date' % stage.stage_name)
+        return 0
+    input_hash_dict = dict(zip(input_list, input_hash_list))
+    # Inputs only added: merged into the outputs, old inputs are not read again
+    old_input_hash_dict = manifest.get_record(stage.stage_name, 'input_hash')
+    if (stage.update_fn is not None) and (not force) and outputs_exist and (old_input_hash_dict is not None) \
+        and (manifest.get_record(stage.stage_name, 'param_hash') == param_hash) and all([input_hash_dict.get(x) == h for x, h in old_input_hash_dict.items()]):
+        new_input_list = [x for x in input_list if x not in old_input_hash_dict]
+        logger.info('%s: adding %i of %i files' % (stage.stage_name, len(new_input_list), len(input_list)))
+        stage.update_fn(file_id_list, new_input_list)
+    else:
+        logger.info('%s: rebuilding from %i files' % (stage.stage_name, len(input_list)))
+        stage.run_fn(file_id_list)
+    manifest.set_record(stage.stage_name, 'all', record_key)
+    if stage.update_fn is not None:
+        manifest.set_record(stage.stage_name, 'param_hash', param_hash)
+        manifest.set_record(stage.stage_name, 'input_hash', input_hash_dict)
+    manifest.save()
+    return 1
+
+def run_pipeline(stage_list, file_id_list, manifest, num_workers=1, force_stage_list=[]):
+    ''' Stages run in list order; a later stage sees new outputs of an earlier one as changed inputs '''
+    for stage in stage_list:
+        force = stage.stage_name in force_stage_list
+        if isinstance(stage, Aggregate_Stage):
+            run_aggregate_stage(stage, file_id_list, manifest, num_workers, force)
+        else:
+            run_file_stage(stage, file_id_list, manifest, num_workers, force)
+
+###################################
+# Stages of run_nn_iv_batch_T4_DV #
+###################################
+
+def make_data_pipeline(cfg, file_id_list):
+    ''' MakeLab, MakeCmp, MakeWav, SilenceIndex, then per feature a normaliser stage and a fused ResilNorm stage writing to scratch '''
+    ''' Normalisers of new training files (e.g. new speakers) are merged into the saved statistics, as update_normaliser '''
+    ''' Features in cfg.pipeline_resil_feat_list also get a Resil stage: un-normalised files, for normalisation in the loader '''
+    from modules import acoustic_2_cmp_worker, init_acoustic_composition_worker, wav_2_wav_cmp_worker, resil_worker, resil_norm_worker, init_resil_norm_worker
+    from modules import label_align_2_binary_label_worker, init_label_normalisation_worker
+    from modules import make_codec_info_file_name, save_resil_norm_codec_info, make_silence_index, make_feat_stats_file_name, check_feat_codec
+    from modules_2 import get_norm_min_max_value, get_resil_norm_type, keep_normaliser_file_id, compute_resil_normaliser, update_resil_normaliser
+    for d in list(cfg.nn_feat_dirs.values()) + list(cfg.nn_feat_scratch_dirs.values()) + [cfg.nn_feat_resil_dirs[feat_name] for feat_name in cfg.pipeline_resil_feat_list]:
+        prepare_file_path(d)
+
+    def nn_file(feat_name, file_id):
+        return os.path.join(cfg.nn_feat_dirs[feat_name], file_id + '.' + feat_name)
+    def lab_file(file_id):
+        return os.path.join(cfg.lab_dir, file_id + '.lab')
+    def acoustic_file_dict(file_id):
+        return {feat_name: os.path.join(cfg.acoustic_dir_dict[feat_name], file_id + cfg.acoustic_file_ext_dict[feat_name]) for feat_name in cfg.acoustic_features}
+
+    stage_list = []
+    if 'lab' in cfg.pipeline_feat_list:
+        # Binary labels of the label alignments; the question file is an input, so editing it rebuilds all
+        stage_list.append(File_Stage('MakeLab', {'feature_dim': cfg.nn_feature_dims['lab']}, lambda file_id: [lab_file(file_id), cfg.question_file_name], lambda file_id: [nn_file('lab', file_id)], \
+            label_align_2_binary_label_worker, lambda file_id: (lab_file(file_id), nn_file('lab', file_id)), init_label_normalisation_worker, (cfg,)))
+    if 'cmp' in cfg.pipeline_feat_list:
+        param_dict = {'delta_win': cfg.delta_win, 'acc_win': cfg.acc_win, 'acoustic_in_dimension_dict': cfg.acoustic_in_dimension_dict, 'acoustic_out_dimension_dict': cfg.acoustic_out_dimension_dict}
+        stage_list.append(File_Stage('MakeCmp', param_dict, lambda file_id: [acoustic_file_dict(file_id)[k] for k in cfg.acoustic_features], lambda file_id: [nn_file('cmp', file_id)], \
+            acoustic_2_cmp_worker, lambda file_id: (acoustic_file_dict(file_id), nn_file('cmp', file_id)), init_acoustic_composition_worker, (cfg,)))
+    if 'wav' in cfg.pipeline_feat_list:
+        wav_file = lambda file_id: os.path.join(cfg.wav_dir, file_id + '.wav')
+        stage_list.append(File_Stage('MakeWav', {'frame_sr': cfg.frame_sr}, lambda file_id: [wav_file(file_id)], lambda file_id: [nn_file('wav', file_id)], \
+            wav_2_wav_cmp_worker, lambda file_id: (wav_file(file_id), nn_file('wav', file_id), cfg.frame_sr)))
+
+    # Silence boundaries of all label files; rebuilt when any label file changes
+    # Any label change reruns the stage; make_silence_index then re-parses only new or changed label files
+    stage_list.append(Aggregate_Stage('SilenceIndex', {'silence_pattern': ['*-#+*']}, lambda file_id_list: [lab_file(file_id) for file_id in file_id_list], [cfg.silence_index_file], \
+        lambda file_id_list: make_silence_index(cfg, [lab_file(file_id) for file_id in file_id_list])))
+
+    for feat_name in cfg.pipeline_feat_list:
+        norm_type = get_resil_norm_type(feat_name)
+        min_value, max_value = get_norm_min_max_value(feat_name)
+        feature_dim = cfg.nn_feature_dims[feat_name]
+        norm_file = cfg.nn_feat_resil_norm_files[feat_name]
+
+        if feat_name in cfg.pipeline_resil_feat_list:
+            resil_file = lambda file_id, feat_name=feat_name: os.path.join(cfg.nn_feat_resil_dirs[feat_name], file_id + '.' + feat_name)
+            stage_list.append(File_Stage('Resil'+feat_name.capitalize(), {'frames_silence_to_keep': cfg.frames_silence_to_keep, 'sil_pad': cfg.sil_pad, 'feature_dim': feature_dim}, \
+                lambda file_id, feat_name=feat_name: [nn_file(feat_name, file_id), lab_file(file_id)], \
+                lambda file_id, resil_file=resil_file: [resil_file(file_id)], \
+                resil_worker, \
+                lambda file_id, feat_name=feat_name, resil_file=resil_file: (nn_file(feat_name, file_id), lab_file(file_id), resil_file(file_id)), \
+                init_resil_norm_worker, (cfg, feature_dim, None, None, None, None, ['*-#+*'], 'float32', cfg.silence_index_file)))
+
+        param_dict = {'frames_silence_to_keep': cfg.frames_silence_to_keep, 'sil_pad': cfg.sil_pad, 'norm_type': norm_type, 'feature_dim': feature_dim, 'min_value': min_value, 'max_value': max_value}
+
+        def norm_run_fn(file_id_list, feat_name=feat_name, norm_type=norm_type):
+            train_file_id_list = keep_normaliser_file_id(cfg, file_id_list)
+            compute_resil_normaliser(feat_name, cfg, [nn_file(feat_name, file_id) for file_id in train_file_id_list], [lab_file(file_id) for file_id in train_file_id_list], norm_type)
+        if feat_name == 'wav':
+            # Fixed normaliser, from feature_dim only
+            stage_list.append(Aggregate_Stage('Norm'+feat_name.capitalize(), param_dict, lambda file_id_list: [], [norm_file], norm_run_fn))
+        else:
+            def norm_input_fn(file_id_list, feat_name=feat_name):
+                train_file_id_list = keep_normaliser_file_id(cfg, file_id_list)
+                return [nn_file(feat_name, file_id) for file_id in train_file_id_list] + [lab_file(file_id) for file_id in train_file_id_list]
+            def norm_update_fn(file_id_list, new_input_list, feat_name=feat_name, norm_type=norm_type):
+                # Training files with a new feature or label file; the statistics sidecar keeps those of the others
+                new_input_set = set(new_input_list)
+                new_file_id_list = [file_id for file_id in keep_normaliser_file_id(cfg, file_id_list) if (nn_file(feat_name, file_id) in new_input_set) or (lab_file(file_id) in new_input_set)]
+                update_resil_normaliser(feat_name, cfg, [nn_file(feat_name, file_id) for file_id in new_file_id_list], [lab_file(file_id) for file_id in new_file_id_list], norm_type)
+            stage_list.append(Aggregate_Stage('Norm'+feat_name.capitalize(), param_dict, norm_input_fn, [norm_file, make_feat_stats_file_name(norm_file)], norm_run_fn, norm_update_fn))
+
+        # Storage codec; codec_info.json depends on the normaliser
+        codec_name = cfg.nn_feat_codec_dict[feat_name]
+        check_feat_codec(feat_name, codec_name)
+        param_dict = dict(param_dict, codec_name=codec_name)
+        codec_info_list = [] if codec_name == 'float32' else [make_codec_info_file_name(cfg.nn_feat_scratch_dirs[feat_name])]
+        # bitpack takes its binary dimensions from the .stats sidecar of the normaliser, less those with other values in any file
+        if codec_name == 'bitpack':
+            codec_input_fn = lambda file_id_list, feat_name=feat_name, norm_file=norm_file: [norm_file, make_feat_stats_file_name(norm_file)] + [nn_file(feat_name, file_id) for file_id in file_id_list]
+            codec_file_fn  = lambda file_id_list, feat_name=feat_name: [nn_file(feat_name, file_id) for file_id in file_id_list]
+        else:
+            codec_input_fn = lambda file_id_list, norm_file=norm_file: [norm_file]
+            codec_file_fn  = lambda file_id_list: []
+        stage_list.append(Aggregate_Stage('Codec'+feat_name.capitalize(), param_dict, codec_input_fn, codec_info_list, \
+            lambda file_id_list, feat_name=feat_name, codec_name=codec_name, feature_dim=feature_dim, norm_file=norm_file, norm_type=norm_type, min_value=min_value, max_value=max_value, codec_file_fn=codec_file_fn: \
+            save_resil_norm_codec_info(cfg.nn_feat_scratch_dirs[feat_name], codec_name, feature_dim, norm_file, norm_type, min_value, max_value, codec_file_fn(file_id_list), cfg.num_workers)))
+
+        out_file = lambda file_id, feat_name=feat_name: os.path.join(cfg.nn_feat_scratch_dirs[feat_name], file_id + '.' + feat_name)
+        stage_list.append(File_Stage('ResilNorm'+feat_name.capitalize(), param_dict, \
+            lambda file_id, feat_name=feat_name, norm_file=norm_file, codec_info_list=codec_info_list: [nn_file(feat_name, file_id), lab_file(file_id), norm_file] + codec_info_list, \
+            lambda file_id, out_file=out_file: [out_file(file_id)], \
+            resil_norm_worker, \
+            lambda file_id, feat_name=feat_name, out_file=out_file: (nn_file(feat_name, file_id), lab_file(file_id), out_file(file_id)), \
+            init_resil_norm_worker, (cfg, feature_dim, norm_file, norm_type, min_value, max_value, ['*-#+*'], codec_name, cfg.silence_index_file, cfg.nn_feat_scratch_dirs[feat_name])))
+    return stage_list
+
+def run_data_pipeline(cfg, file_id_list):
+    logger = make_logger("pipeline")
+    manifest = Pipeline_Manifest(cfg.pipeline_manifest_file)
+    stage_list = make_data_pipeline(cfg, file_id_list)
+    logger.info('Stages: %s' % ', '.join([stage.stage_name for stage in stage_list]))
+    run_pipeline(stage_list, file_id_list, manifest, cfg.num_workers, cfg.pipeline_force_stage_list)
@@ -1,6 +1,6 @@
 # modules_torch.py
 
-import os, sys, pickle, time, shutil, logging, copy
+import os, sys, pickle, time, shutil, logging, copy, json, resource, cProfile, pstats
 import math, numpy, scipy
 numpy.random.seed(545)
 import torch
@@ -127,8 +127,18 @@ class Build_NN_Layer(torch.nn.Module):
             self.dropout_fn = lambda a: a # Do nothing, just return same tensor
 
     def forward(self, x):
-        x = self.reshape_fn(x)
-        x = self.layer_fn(x)
+        if isinstance(x, Pitch_Input):
+            # First layer only; Sinenet with nlf and tau of each window from the feed
+            x = self.layer_fn(self.reshape_fn(x.x), x.nlf, x.tau)
+        else:
+            x = self.reshape_fn(x)
+            x = self.layer_fn(x)
+        x = self.dropout_fn(x)
+        return x
+
+    def forward_conv_window(self, x, window_len, window_shift):
+        ''' First layer only; x is S*U*L*D segments, output S*B*D as forward() on all windows '''
+        x = self.layer_fn.forward_conv_window(x, window_len, window_shift)
         x = self.dropout_fn(x)
         return x
 
@@ -190,6 +200,14 @@ class Build_NN_Layer(torch.nn.Module):
         self.layer_fn = SinenetLayerV1(time_len, output_dim, num_channels)
         self.params["output_dim_values"]['D'] += 1 # +1 to append nlf F0 values
 
+class Pitch_Input(object):
+    ''' Input of a Sinenet first layer: dense S*B*(T*D) windows x, and nlf, tau (S*B*1*1) of each window '''
+    ''' nlf and tau are read from the binary pitch stores; see exp_dv_wav_baseline.make_pitch_feed '''
+    def __init__(self, x, nlf, tau):
+        self.x = x
+        self.nlf = nlf
+        self.tau = tau
+
 class ReLUDVMaxLayer(torch.nn.Module):
     def __init__(self, input_dim, output_dim, num_channels):
         super().__init__()
@@ -214,6 +232,29 @@ class ReLUDVMaxLayer(torch.nn.Module):
         h_max, _indices = torch.max(h_stack, dim=0, keepdim=False)
         return h_max
 
+    def forward_conv_window(self, x, window_len, window_shift):
+        '''
+        Same as forward() on every window of every segment, without cutting windows
+        Input x: S*U*L*D segments; windows of window_len frames, every window_shift frames
+        Each Linear on a flattened T*D window is a conv1d with kernel T and stride shift
+        Output: S*B*output_dim, B = U * number of windows per segment, in window order
+        '''
+        S, U, L, D = x.shape
+        x_N_D_L = x.reshape(S*U, L, D).permute(0, 2, 1)
+        h_list = []
+        for i in range(self.num_channels):
+            # Flattened window index is t*D+d; weight out*(T*D) -> out*D*T
+            w = self.fc_list[i].weight.view(self.output_dim, window_len, D).permute(0, 2, 1)
+            h_i = torch.nn.functional.conv1d(x_N_D_L, w, self.fc_list[i].bias, stride=window_shift)
+            h_i = self.relu_fn(h_i)
+            h_list.append(h_i)
+
+        h_stack = torch.stack(h_list, dim=0)
+        # MaxOut
+        h_max, _indices = torch.max(h_stack, dim=0, keepdim=False) # (S*U)*output_dim*num_windows
+        num_windows = h_max.shape[2]
+        return h_max.permute(0, 2, 1).reshape(S, U*num_windows, self.output_dim)
+
 class SinenetLayerIndiv(torch.nn.Module):
     ''' Try to build per frequency '''
     def __init__(self, time_len, output_dim, num_channels):
@@ -508,6 +549,13 @@ class DV_Y_CMP_NN_model(torch.nn.Module):
         self.num_nn_layers = dv_y_cfg.num_nn_layers
         self.train_by_window = dv_y_cfg.train_by_window
 
+        # Input is S*U*L*D segments; first layer runs over all windows as a convolution
+        self.conv_window_exec = dv_y_cfg.conv_window_exec
+        if self.conv_window_exec:
+            assert dv_y_cfg.nn_layer_config_list[0]['type'] == 'ReLUDVMax'
+            self.batch_seq_len   = dv_y_cfg.batch_seq_len
+            self.batch_seq_shift = dv_y_cfg.batch_seq_shift
+
         self.input_layer = Build_S_B_TD_Input_Layer(dv_y_cfg)
         self.input_dim   = self.input_layer.input_dim
         prev_layer = self.input_layer
@@ -529,7 +577,12 @@ class DV_Y_CMP_NN_model(torch.nn.Module):
 
     def gen_lambda_SBD(self, x):
         ''' Simple sequential feed-forward '''
-        for i in range(self.num_nn_layers):
+        if self.conv_window_exec:
+            x = self.layer_list[0].forward_conv_window(x, self.batch_seq_len, self.batch_seq_shift)
+            i_start = 1
+        else:
+            i_start = 0
+        for i in range(i_start, self.num_nn_layers):
             layer_temp = self.layer_list[i]
             x = layer_temp(x)
         return x
@@ -567,6 +620,7 @@ class General_Model(object):
 
     def __init__(self):
         self.nn_model = None
+        self.telemetry = None
 
     def build_optimiser(self):
         pass
@@ -577,9 +631,6 @@ class General_Model(object):
     def gen_lambda_SBD(self, feed_dict):
         pass
 
-    def cal_accuracy(self, feed_dict):
-        pass
-
     def numpy_to_tensor(self, feed_dict):
         pass
 
@@ -624,18 +675,20 @@ class General_Model(object):
         self.loss = self.gen_loss(feed_dict)
         # perform a backward pass, and update the weights.
         self.loss.backward()
+        self.telemetry_toc('backward')
         self.optimiser.step()
+        self.telemetry_toc('optimiser')
+
+    def telemetry_toc(self, phase):
+        ''' Close a timed phase; does nothing when telemetry is off '''
+        if self.telemetry is not None:
+            self.telemetry.toc(phase)
 
     def update_learning_rate(self, learning_rate):
         self.learning_rate = learning_rate
         # Re-build an optimiser, use new learning rate, and reset gradients
         self.build_optimiser()
 
-    def gen_loss_value(self, feed_dict):
-        ''' Return the numpy value of self.loss '''
-        self.loss = self.gen_loss(feed_dict)
-        return self.loss.item()
-
     def save_nn_model(self, nnets_file_name):
         ''' Model Only '''
         save_dict = {'model_state_dict': self.nn_model.state_dict()}
@@ -674,12 +727,14 @@ class DV_Y_CMP_model(General_Model):
         self.optimiser.zero_grad()
 
     def gen_loss(self, feed_dict):
-        ''' Returns Tensor, not value! For value, use gen_loss_value '''
+        ''' Returns Tensor, not value! For values, use accumulate_metrics '''
         x, y = self.numpy_to_tensor(feed_dict)
+        self.telemetry_toc('to_tensor')
         y_pred = self.nn_model(x)
         # TODO: Add dimension check
         # Compute and print loss
         self.loss = self.criterion(y_pred, y)
+        self.telemetry_toc('forward')
         return self.loss
 
     def gen_lambda_SBD_value(self, feed_dict):
@@ -694,20 +749,22 @@ class DV_Y_CMP_model(General_Model):
         _values, predict_idx_list = torch.max(logit_SBD.data, -1)
         return predict_idx_list.cpu().detach().numpy()
 
-    def cal_accuracy(self, feed_dict):
-        x, y = self.numpy_to_tensor(feed_dict)
-        outputs = self.nn_model(x)
-        _values, predict_idx_list = torch.max(outputs.data, 1)
-        total = y.size(0)
-        correct = (predict_idx_list == y).sum().item()
-        accuracy = correct/total
-        return correct, total, accuracy
+    def accumulate_metrics(self, feed_dict, metrics):
+        ''' Evaluation forward; loss, correct count and confusion stay on device in metrics '''
+        with torch.no_grad():
+            x, y = self.numpy_to_tensor(feed_dict)
+            y_pred = self.nn_model(x)
+            metrics.update(self.criterion(y_pred, y), y_pred, y)
 
     def numpy_to_tensor(self, feed_dict):
         if 'x' in feed_dict:
             x_val = feed_dict['x']
             x = torch.tensor(x_val, dtype=torch.float)
             x = x.to(self.device_id)
+            if 'tau' in feed_dict:
+                nlf = torch.tensor(feed_dict['nlf'], dtype=torch.float).to(self.device_id)
+                tau = torch.tensor(feed_dict['tau'], dtype=torch.float).to(self.device_id)
+                x = Pitch_Input(x, nlf, tau)
         else:
             x = None
         if 'y' in feed_dict:
@@ -739,6 +796,196 @@ def torch_initialisation(dv_y_cfg):
     #     model.DataParallel()
     return model
 
+######################
+# Evaluation Metrics #
+######################
+
+class Metrics_Accumulator(object):
+    ''' Loss sum and speaker confusion matrix, kept as tensors on device_id; correct count is its trace '''
+    ''' confusion_matrix[true_idx, predict_idx]; one host synchronisation per result() '''
+    def __init__(self, num_classes, device_id):
+        self.num_classes = num_classes
+        self.device_id = device_id
+        self.reset()
+
+    def reset(self):
+        self.loss_sum    = torch.zeros((), dtype=torch.float64, device=self.device_id)
+        self.confusion   = torch.zeros(self.num_classes * self.num_classes, dtype=torch.long, device=self.device_id)
+        self.num_batches = 0
+        self.num_samples = 0
+
+    def update(self, loss, logit_N_C, y_N):
+        ''' loss is the batch mean; no .item(), nothing leaves the device '''
+        predict_N = torch.argmax(logit_N_C.detach(), dim=1)
+        self.loss_sum += loss.detach().to(torch.float64)
+        # index_add_, not bincount: bincount reads min and max back to the host on CUDA
+        self.confusion.index_add_(0, y_N * self.num_classes + predict_N, torch.ones_like(y_N))
+        self.num_batches += 1
+        self.num_samples += y_N.size(0)
+
+    def result(self):
+        ''' Copy to host once; mean batch loss, accuracy, confusion matrix (numpy, C * C) '''
+        confusion = self.confusion.cpu().numpy().reshape(self.num_classes, self.num_classes)
+        loss_sum  = float(self.loss_sum.cpu())
+        num_correct = int(numpy.trace(confusion))
+        result_dict = {'loss': loss_sum / max(self.num_batches, 1), 'accuracy': num_correct / float(max(self.num_samples, 1))}
+        result_dict['num_correct'] = num_correct
+        result_dict['num_samples'] = self.num_samples
+        result_dict['confusion_matrix'] = confusion
+        return result_dict
+
+######################
+# Training Telemetry #
+######################
+
+class Train_Telemetry(object):
+    ''' Per-step time breakdown, throughput and peak memory, written as JSONL '''
+    ''' Phases: read, assembly, to_tensor, forward, backward, optimiser '''
+    def __init__(self, telemetry_file, device_id, log_steps=True):
+        self.telemetry_file = telemetry_file
+        self.log_steps = log_steps
+        # Forward and backward are asynchronous on GPU; synchronise before reading the clock
+        self.use_cuda = (device_id.type == 'cuda')
+        self.device_id = device_id
+        self.phase_list = ['read', 'assembly', 'to_tensor', 'forward', 'backward', 'optimiser']
+        self.active = False
+        self.line_list = []
+
+    def start_epoch(self, epoch):
+        self.epoch = epoch
+        self.epoch_step = 0
+        self.epoch_time = {p: 0. for p in self.phase_list}
+        self.epoch_windows = 0
+        self.epoch_samples = 0
+        if self.use_cuda:
+            torch.cuda.reset_max_memory_allocated(self.device_id)
+
+    def start_step(self):
+        self.step_time = {p: 0. for p in self.phase_list}
+        self.active = True
+        self.tic_time = time.perf_counter()
+
+    def add_time(self, phase, t):
+        ''' For phases measured outside the sequence, e.g. file reads inside data assembly '''
+        if self.active:
+            self.step_time[phase] += t
+
+    def toc(self, phase):
+        ''' Charge time since the last toc to phase '''
+        if self.active:
+            if self.use_cuda:
+                torch.cuda.synchronize(self.device_id)
+            t = time.perf_counter()
+            self.step_time[phase] += t - self.tic_time
+            self.tic_time = t
+
+    def end_step(self, num_windows, num_samples):
+        self.active = False
+        # File reads happen inside data assembly; report them separately
+        self.step_time['assembly'] -= self.step_time['read']
+        step_total = sum(self.step_time.values())
+        for p in self.phase_list:
+            self.epoch_time[p] += self.step_time[p]
+        self.epoch_step += 1
+        self.epoch_windows += num_windows
+        self.epoch_samples += num_samples
+        if self.log_steps:
+            step_dict = {'type':'step', 'epoch':self.epoch, 'step':self.epoch_step, 'time':self.step_time, 'total_time':step_total}
+            step_dict['windows_per_s'] = num_windows / step_total
+            step_dict['samples_per_s'] = num_samples / step_total
+            step_dict['peak_gpu_mem_mb'] = self.peak_gpu_mem_mb()
+            self.line_list.append(json.dumps(step_dict))
+
+    def end_epoch(self, train_time, valid_time, loss_dict=None, accuracy_dict=None):
+        ''' Write the epoch summary line, with any buffered step lines '''
+        epoch_total = sum(self.epoch_time.values())
+        epoch_dict = {'type':'epoch', 'epoch':self.epoch, 'num_steps':self.epoch_step, 'time':self.epoch_time, 'total_time':epoch_total}
+        epoch_dict['train_time'] = train_time
+        epoch_dict['valid_time'] = valid_time
+        epoch_dict['windows_per_s'] = self.epoch_windows / max(epoch_total, 1e-12)
+        epoch_dict['samples_per_s'] = self.epoch_samples / max(epoch_total, 1e-12)
+        epoch_dict['peak_gpu_mem_mb']  = self.peak_gpu_mem_mb()
+        epoch_dict['peak_host_mem_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+        if loss_dict is not None:
+            epoch_dict['loss'] = loss_dict
+        if accuracy_dict is not None:
+            epoch_dict['accuracy'] = accuracy_dict
+        self.line_list.append(json.dumps(epoch_dict))
+        with open(self.telemetry_file, 'a') as f:
+            for l in self.line_list:
+                f.write(l + '\n')
+        self.line_list = []
+        return epoch_dict
+
+    def peak_gpu_mem_mb(self):
+        if self.use_cuda:
+            return torch.cuda.max_memory_allocated(self.device_id) / 1048576.
+        else:
+            return 0.
+
+class Train_Profiler(object):
+    ''' Capture a window of steps after warm-up: torch profiler (operators, memory), cProfile of data assembly '''
+    ''' Files are written to profile_dir, prefixed by profile_name '''
+    def __init__(self, profile_dir, profile_name, device_id, warmup_steps, num_steps):
+        self.file_prefix  = os.path.join(profile_dir, profile_name)
+        self.use_cuda     = (device_id.type == 'cuda')
+        self.warmup_steps = warmup_steps
+        self.num_steps    = num_steps
+        self.step = 0
+        self.capturing = False
+        self.finished  = False
+        self.data_profiler = cProfile.Profile()
+
+    def start_step(self):
+        self.step += 1
+        if (self.step == self.warmup_steps + 1) and not self.finished:
+            self.capturing = True
+            if hasattr(torch, 'profiler'):
+                activities = [torch.profiler.ProfilerActivity.CPU]
+                if self.use_cuda:
+                    activities.append(torch.profiler.ProfilerActivity.CUDA)
+                self.torch_profiler = torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True)
+            else:
+                # Older PyTorch; no memory view
+                self.torch_profiler = torch.autograd.profiler.profile(use_cuda=self.use_cuda)
+            self.torch_profiler.__enter__()
+
+    def data_start(self):
+        if self.capturing:
+            self.data_profiler.enable()
+
+    def data_stop(self):
+        if self.capturing:
+            self.data_profiler.disable()
+
+    def end_step(self):
+        if self.capturing and (self.step == self.warmup_steps + self.num_steps):
+            self.stop()
+
+    def stop(self):
+        ''' Write results; also call at the end of a loop shorter than the window '''
+        if not self.capturing:
+            return
+        self.capturing = False
+        self.finished  = True
+        if self.use_cuda:
+            torch.cuda.synchronize()
+        self.torch_profiler.__exit__(None, None, None)
+        logger = make_logger("Train_Profiler")
+        self.torch_profiler.export_chrome_trace(self.file_prefix + '_torch_trace.json')
+        key_averages = self.torch_profiler.key_averages()
+        sort_by = 'self_cuda_time_total' if self.use_cuda else 'self_cpu_time_total'
+        with open(self.file_prefix + '_torch_ops.txt', 'w') as f:
+            f.write(key_averages.table(sort_by=sort_by, row_limit=50))
+        if hasattr(torch, 'profiler'):
+            sort_by = 'self_cuda_memory_usage' if self.use_cuda else 'self_cpu_memory_usage'
+            with open(self.file_prefix + '_torch_memory.txt', 'w') as f:
+                f.write(key_averages.table(sort_by=sort_by, row_limit=50))
+        self.data_profiler.dump_stats(self.file_prefix + '_data.prof')
+        with open(self.file_prefix + '_data.txt', 'w') as f:
+            pstats.Stats(self.data_profiler, stream=f).sort_stats('cumulative').print_stats(50)
+        logger.info('Saved profiles of steps %i to %i to %s_*' % (self.warmup_steps+1, self.step, self.file_prefix))
+
 #############################
 # PyTorch-based Simple Test #
 #############################
@@ -760,13 +1007,15 @@ def data_format_test(dv_y_cfg, dv_y_model):
 
     feed_dict = {'x':x_val, 'y':y_val}
     
+    metrics = Metrics_Accumulator(D_out, dv_y_model.device_id)
     for t in range(1,501):
         dv_y_model.nn_model.train()
         dv_y_model.update_parameters(feed_dict)
         if t % 100 == 0:
             dv_y_model.nn_model.eval()
-            loss = dv_y_model.gen_loss_value(feed_dict)
-            logger.info('%i, %f' % (t, loss))
+            metrics.reset()
+            dv_y_model.accumulate_metrics(feed_dict, metrics)
+            logger.info('%i, %f' % (t, metrics.result()['loss']))
 
 ###########################
 # Useless Tensorflow Code #
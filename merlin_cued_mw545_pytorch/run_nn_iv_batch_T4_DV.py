@@ -3,7 +3,7 @@ import math, numpy, scipy, scipy.io.wavfile#, sigproc, sigproc.pystraight
 
 from modules import make_logger, read_file_list, prepare_file_path, prepare_file_path_list, make_held_out_file_number, copy_to_scratch
 from modules import keep_by_speaker, remove_by_speaker, keep_by_file_number, remove_by_file_number
-from modules_2 import log_class_attri, resil_nn_file_list, norm_nn_file_list
+from modules_2 import log_class_attri, resil_nn_file_list, norm_nn_file_list, resil_norm_nn_file_list
 
 class configuration(object):
     def __init__(self, work_dir=None):
@@ -21,7 +21,13 @@ class configuration(object):
         self.Processes['NormLab']  = False
         self.Processes['NormCmp']  = False
         self.Processes['NormWav']  = False
-        # self.Processes['MuLawWav'] = False
+        # Resil, Norm and copy_to_scratch in one pass; raw nn_ files to scratch
+        self.Processes['ResilNormLab'] = False
+        self.Processes['ResilNormCmp'] = False
+        self.Processes['ResilNormWav'] = False
+        # MakeCmp, MakeWav, Norm and ResilNorm stages; only files with changed inputs or parameters are rebuilt
+        self.Processes['DataPipeline'] = False
+        # Mu-law wav: set dv_y_cfg.mu_law_bits, companding runs in the loader
         self.Processes['ResilPitch']   = False
 
         # self.Processes['TrainCMPTorch'] = True
@@ -29,9 +35,13 @@ class configuration(object):
 
         self.Processes['TrainCMPDVY'] = False
         self.Processes['TestCMPDVY']  = False
+        self.Processes['SweepCMPDVY'] = False
+        self.Processes['VerifCMPDVY'] = False
+        self.Processes['ServeCMPDVY'] = False
 
         self.Processes['TrainWavDVY'] = False
         self.Processes['TestWavDVY']  = False
+        self.Processes['VerifWavDVY'] = False
 
         # Experiments where REAPER F0 and phase shift info are predicted
         self.Processes['TrainWavSineV1'] = True
@@ -88,6 +98,7 @@ class configuration(object):
         self.file_id_list_file  = os.path.join('/home/dawna/tts/mw545/TorchDV', 'file_id_list.scp')
         self.frames_silence_to_keep = 50
         self.sil_pad = 5
+        self.num_workers = 20 # Worker processes of file-level data preparation stages
         self.delta_win = [-0.5, 0.0, 0.5]
         self.acc_win   = [1.0, -2.0, 1.0]
 
@@ -161,6 +172,18 @@ class configuration(object):
             self.nn_feat_resil_norm_files[nn_feat] = self.nn_feat_resil_norm_dirs[nn_feat] +'_info.dat'
             self.nn_feat_scratch_dirs[nn_feat]     = os.path.join(self.nn_feat_scratch_dir_root, self.nn_feat_resil_norm_dirs[nn_feat].split('/')[-1])
         self.nn_feat_scratch_dirs['pitch'] = os.path.join(self.nn_feat_scratch_dir_root, 'pitch')
+        # Storage codec of ResilNorm outputs: 'float32', 'float16'; 'int16' or 'mulaw8' for PCM wav; decoded by the loader
+        # 'bitpack' for lab is opt-in: 0/1 dimensions as bits, about 20x smaller
+        self.nn_feat_codec_dict = {'lab': 'float32', 'cmp': 'float32', 'wav': 'float32'}
+
+        # Non-silence start and end frame of every file in lab_dir, parsed once; read by all Resil stages
+        self.silence_index_file = os.path.join(self.nn_feat_scratch_dir_root, 'silence_index.npz')
+
+        # Incremental data pipeline; content hashes of inputs and per-file stage records
+        self.pipeline_manifest_file = os.path.join(self.nn_feat_scratch_dir_root, 'data_pipeline_manifest.json')
+        self.pipeline_feat_list = ['lab', 'cmp', 'wav']
+        self.pipeline_force_stage_list = [] # Stage names to rebuild fully, e.g. ['NormCmp']
+        self.pipeline_resil_feat_list  = [] # Also keep un-normalised resil files in nn_feat_resil_dirs, e.g. ['cmp'], for loader_norm_type
 
         self.held_out_file_number = make_held_out_file_number(80)
         self.AM_held_out_file_number = make_held_out_file_number(40)
@@ -186,7 +209,7 @@ class configuration(object):
 
 
     def need_to_load_file_id_list(self):
-        need_list = ['copy_to_scratch', 'MakeCmp', 'MakeWav', 'ResilLab', 'ResilCmp', 'ResilWav', 'ResilPitch', 'NormLab', 'NormCmp', 'NormWav', 'remakePML']
+        need_list = ['copy_to_scratch', 'MakeCmp', 'MakeWav', 'ResilLab', 'ResilCmp', 'ResilWav', 'ResilPitch', 'NormLab', 'NormCmp', 'NormWav', 'ResilNormLab', 'ResilNormCmp', 'ResilNormWav', 'DataPipeline', 'remakePML']
         for process_name in need_list:
             if self.Processes[process_name]:
                 return True
@@ -223,7 +246,7 @@ def main_function(cfg):
         from modules import wav_2_wav_cmp_list
         wav_file_list = prepare_file_path_list(file_id_list, cfg.wav_dir, '.wav')
         nn_file_list['wav'] = prepare_file_path_list(file_id_list, cfg.nn_feat_dirs['wav'], '.wav')
-        wav_2_wav_cmp_list(wav_file_list, nn_file_list['wav'])
+        wav_2_wav_cmp_list(wav_file_list, nn_file_list['wav'], num_workers=cfg.num_workers)
 
     if cfg.Processes['ResilLab']:
         logger.info('ResilLab')
@@ -242,8 +265,10 @@ def main_function(cfg):
         from modules import reduce_silence_reaper_output_list
         reaper_output_dir = '/home/dawna/tts/mw545/Data/Data_Voicebank_48kHz_Pitch'
         label_align_dir   = '/data/vectra2/tts/mw545/Data/data_voicebank/label_state_align'
-        out_dir           = '/home/dawna/tts/mw545/Data/Data_Voicebank_48kHz_Pitch_Resil'
-        reduce_silence_reaper_output_list(cfg, file_id_list, reaper_output_dir, label_align_dir, out_dir, reaper_output_ext='.used.pm', label_align_ext='.lab', out_ext='.pm')
+        # Binary pitch stores, read by modules_2.Pitch_Store
+        out_dir           = cfg.nn_feat_scratch_dirs['pitch']
+        prepare_file_path(out_dir)
+        reduce_silence_reaper_output_list(cfg, file_id_list, reaper_output_dir, label_align_dir, out_dir, reaper_output_ext='.used.pm', label_align_ext='.lab', out_ext='.pitch')
 
     if cfg.Processes['NormLab']:
         logger.info('NormLab')
@@ -257,13 +282,22 @@ def main_function(cfg):
         logger.info('NormWav')
         norm_nn_file_list('wav', cfg, file_id_list, nn_resil_file_list, nn_resil_norm_file_list, compute_normaliser=True, norm_type='MinMax')
 
-    # if cfg.Processes['MuLawWav']:
-    #     logger.info('MuLawWav')
-    #     from modules import perform_mu_law_list
-    #     feat_name = 'wav'
-    #     nn_resil_norm_file_list[feat_name] = prepare_file_path_list(file_id_list, cfg.nn_feat_resil_norm_dirs[feat_name], '.'+feat_name)
-    #     nn_resil_norm_file_list[feat_name+'_mu'] = prepare_file_path_list(file_id_list, cfg.nn_feat_resil_norm_dirs[feat_name], '.mu.'+feat_name)
-    #     perform_mu_law_list(nn_resil_norm_file_list[feat_name], nn_resil_norm_file_list[feat_name+'_mu'], mu_value=255.)
+    if cfg.Processes['ResilNormLab']:
+        logger.info('ResilNormLab')
+        resil_norm_nn_file_list('lab', cfg, file_id_list, nn_file_list, compute_normaliser=True, norm_type='MinMax')
+
+    if cfg.Processes['ResilNormCmp']:
+        logger.info('ResilNormCmp')
+        resil_norm_nn_file_list('cmp', cfg, file_id_list, nn_file_list, compute_normaliser=True, norm_type='MeanVar')
+
+    if cfg.Processes['ResilNormWav']:
+        logger.info('ResilNormWav')
+        resil_norm_nn_file_list('wav', cfg, file_id_list, nn_file_list, compute_normaliser=True, norm_type='MinMax')
+
+    if cfg.Processes['DataPipeline']:
+        logger.info('DataPipeline')
+        from modules_pipeline import run_data_pipeline
+        run_data_pipeline(cfg, file_id_list)
 
     # if cfg.Processes['TrainCMPTorch']:
     #     from exp_mw545.exp_dv_cmp_baseline import train_dv_y_cmp_model
@@ -283,6 +317,18 @@ def main_function(cfg):
         from exp_mw545.exp_dv_cmp_baseline import test_dv_y_cmp_model
         test_dv_y_cmp_model(cfg)
 
+    if cfg.Processes['SweepCMPDVY']:
+        from exp_mw545.exp_dv_sweep import sweep_dv_y_cmp_model
+        sweep_dv_y_cmp_model(cfg)
+
+    if cfg.Processes['VerifCMPDVY']:
+        from exp_mw545.exp_dv_cmp_baseline import verification_test_dv_y_cmp_model
+        verification_test_dv_y_cmp_model(cfg)
+
+    if cfg.Processes['ServeCMPDVY']:
+        from exp_mw545.exp_dv_server import serve_dv_y_cmp_model
+        serve_dv_y_cmp_model(cfg)
+
     
 
 
@@ -297,6 +343,10 @@ def main_function(cfg):
         from exp_mw545.exp_dv_wav_baseline import test_dv_y_wav_model
         test_dv_y_wav_model(cfg)
 
+    if cfg.Processes['VerifWavDVY']:
+        from exp_mw545.exp_dv_wav_baseline import verification_test_dv_y_wav_model
+        verification_test_dv_y_wav_model(cfg)
+
 
     if cfg.Processes['TrainWavSineV1']:
         from exp_mw545.exp_dv_wav_sinenet_v1 import train_dv_y_wav_model
@@ -404,14 +454,18 @@ def main_function(cfg):
 
 
     if cfg.Processes['remakePML']:
-        from modules import wav_2_acoustic
+        from modules import wav_2_acoustic_list
         # file_id_list_new = keep_by_speaker(file_id_list, cfg.valid_speaker_list + cfg.test_speaker_list)
+        wav_file_list = []
+        out_file_dict_list = []
         for file_id in file_id_list:
             wav_file = "/home/dawna/tts/mw545/TorchDV/debug/data/wav_16kHz/%s.wav" % file_id
             out_file_dict = {}
             for feat_name in cfg.acoustic_features:
                 out_file_dict[feat_name] = os.path.join(cfg.acoustic_dir_dict[feat_name], file_id + cfg.acoustic_file_ext_dict[feat_name])
-            wav_2_acoustic(wav_file, out_file_dict, cfg.acoustic_in_dimension_dict, verbose_level=0)
+            wav_file_list.append(wav_file)
+            out_file_dict_list.append(out_file_dict)
+        wav_2_acoustic_list(cfg, wav_file_list, out_file_dict_list, verbose_level=0)
         
         
 
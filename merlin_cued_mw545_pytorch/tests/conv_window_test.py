@@ -0,0 +1,145 @@
+# conv_window_test.py
+
+# Equivalence of conv_window_exec and the windowed (stacked-frame) path
+# Same weights; windowed model gets S*B*(T*D) windows, conv model gets the S*U*L*D segments they are cut from
+# Test feeds: conv segments (cut_conv_window_test_segment) and generation feeds hold the same windows as the windowed feed
+# Run from merlin_cued_mw545_pytorch: python tests/conv_window_test.py
+
+import os, sys, copy, tempfile
+import numpy, torch
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from modules_torch import DV_Y_CMP_NN_model
+
+class test_dv_y_configuration(object):
+    def __init__(self, feat_dim, batch_seq_len, batch_seq_shift, utter_num_seq):
+        self.batch_num_spk   = 3
+        self.spk_num_utter   = 2
+        self.utter_num_seq   = utter_num_seq
+        self.spk_num_seq     = self.spk_num_utter * self.utter_num_seq
+        self.utter_seg_len   = (utter_num_seq - 1) * batch_seq_shift + batch_seq_len
+        self.feat_dim        = feat_dim
+        self.batch_seq_len   = batch_seq_len
+        self.batch_seq_shift = batch_seq_shift
+        self.dv_dim = 16
+        self.nn_layer_config_list = [
+            {'type':'ReLUDVMax', 'size':32, 'num_channels':2, 'dropout_p':0},
+            {'type':'ReLUDVMax', 'size':32, 'num_channels':2, 'dropout_p':0},
+            {'type':'LinDV', 'size':self.dv_dim, 'num_channels':1, 'dropout_p':0}
+        ]
+        self.num_nn_layers = len(self.nn_layer_config_list)
+        self.num_speaker_dict = {'train': 5}
+        self.train_by_window  = True
+        self.conv_window_exec = False
+
+def segments_to_windows(seg_SULD, cfg):
+    S, U, L, D = seg_SULD.shape
+    x = numpy.zeros((S, U * cfg.utter_num_seq, cfg.batch_seq_len * D))
+    for u in range(U):
+        for n in range(cfg.utter_num_seq):
+            start_i = n * cfg.batch_seq_shift
+            x[:, u*cfg.utter_num_seq+n] = seg_SULD[:, u, start_i:start_i+cfg.batch_seq_len].reshape(S, -1)
+    return x
+
+def check_conv_window_exec(feat_dim, batch_seq_len, batch_seq_shift, utter_num_seq):
+    cfg = test_dv_y_configuration(feat_dim, batch_seq_len, batch_seq_shift, utter_num_seq)
+    model_window = DV_Y_CMP_NN_model(cfg).double()
+    cfg_conv = copy.copy(cfg)
+    cfg_conv.conv_window_exec = True
+    model_conv = DV_Y_CMP_NN_model(cfg_conv).double()
+    model_conv.load_state_dict(model_window.state_dict())
+
+    seg = numpy.random.randn(cfg.batch_num_spk, cfg.spk_num_utter, cfg.utter_seg_len, feat_dim)
+    x_window = torch.tensor(segments_to_windows(seg, cfg))
+    x_conv   = torch.tensor(seg)
+
+    # Forward
+    lambda_window = model_window.gen_lambda_SBD(x_window)
+    lambda_conv   = model_conv.gen_lambda_SBD(x_conv)
+    forward_error = (lambda_window - lambda_conv).abs().max().item()
+
+    # Gradients; the expansion layer is not used by gen_lambda_SBD
+    lambda_window.sum().backward()
+    lambda_conv.sum().backward()
+    grad_error = max([(p_w.grad - p_c.grad).abs().max().item() for p_w, p_c in zip(model_window.parameters(), model_conv.parameters()) if p_w.grad is not None])
+
+    print('D %i, T %i, shift %i: max forward error %.3g, max gradient error %.3g' % (feat_dim, batch_seq_len, batch_seq_shift, forward_error, grad_error))
+    assert forward_error < 1e-8 and grad_error < 1e-8
+
+def test_conv_window_exec_cmp_train():
+    check_conv_window_exec(feat_dim=86, batch_seq_len=40, batch_seq_shift=5, utter_num_seq=10)
+
+def test_conv_window_exec_cmp_class_test():
+    check_conv_window_exec(feat_dim=86, batch_seq_len=40, batch_seq_shift=1, utter_num_seq=20)
+
+def test_conv_window_exec_wav():
+    # Scaled down
+    check_conv_window_exec(feat_dim=1, batch_seq_len=320, batch_seq_shift=40, utter_num_seq=5)
+
+class test_feed_configuration(test_dv_y_configuration):
+    ''' Enough of dv_y_cmp_configuration for make_feed_dict_y_cmp_test '''
+    def __init__(self, conv_window_exec, spk_num_seq):
+        super().__init__(feat_dim=86, batch_seq_len=40, batch_seq_shift=5, utter_num_seq=1)
+        from exp_mw545.exp_dv_cmp_baseline import make_feed_dict_y_cmp_test
+        self.make_feed_dict_method_test = make_feed_dict_y_cmp_test
+        self.y_feat_name = 'cmp'
+        self.batch_num_spk = 1
+        self.spk_num_seq   = spk_num_seq
+        self.nn_feature_dims = self.feat_dim
+        self.feat_index = numpy.arange(self.feat_dim)
+        self.feat_decoder_dict = None
+        self.delta_composer = None
+        self.frames_silence_to_keep = 0
+        self.sil_pad = 5
+        self.speaker_id_list_dict = {'train': ['p001']}
+        self.conv_window_exec = conv_window_exec
+
+def collect_test_windows(feed_cfg, file_dir_dict, file_name):
+    ''' All windows of one file from the test feed, (num_windows, T*D); conv segments are cut as the first layer would '''
+    from exp_mw545.exp_dv_cmp_pytorch import segment_to_windows
+    window_list = []
+    gen_finish = False
+    BTD_feat_remain = None
+    while not (gen_finish):
+        feed_dict, gen_finish, batch_size, BTD_feat_remain = feed_cfg.make_feed_dict_method_test(feed_cfg, file_dir_dict, 'p001', file_name, 0, BTD_feat_remain)
+        if feed_cfg.conv_window_exec:
+            assert feed_dict['x'].shape[:2] == (1, 1)
+            if batch_size > 0:
+                window_list.append(segment_to_windows(feed_dict['x'][0, 0], feed_cfg.batch_seq_len, feed_cfg.batch_seq_shift))
+                assert window_list[-1].shape[0] == batch_size
+        else:
+            window_list.append(feed_dict['x'][0, :batch_size])
+    if len(window_list) == 0:
+        return numpy.zeros((0, feed_cfg.batch_seq_len * feed_cfg.feat_dim))
+    return numpy.concatenate(window_list, axis=0)
+
+def test_conv_window_test_feed():
+    from exp_mw545.exp_dv_cmp_pytorch import make_gen_feed_model_cfg, load_gen_feeds, segment_to_windows
+    file_dir = tempfile.mkdtemp()
+    file_dir_dict = {'cmp': file_dir}
+    # Frames: one window, several feeds, several feeds with a partial last shift, too short
+    for file_name, num_frames in [('p001_001', 50), ('p001_002', 400), ('p001_003', 403), ('p001_004', 47)]:
+        numpy.random.randn(num_frames, 86).astype(numpy.float32).tofile(os.path.join(file_dir, file_name + '.cmp'))
+        windows_cfg = test_feed_configuration(conv_window_exec=False, spk_num_seq=20)
+        conv_cfg    = test_feed_configuration(conv_window_exec=True,  spk_num_seq=20)
+        x_window = collect_test_windows(windows_cfg, file_dir_dict, file_name)
+        x_conv   = collect_test_windows(conv_cfg, file_dir_dict, file_name)
+        assert x_conv.shape == x_window.shape and numpy.array_equal(x_conv, x_window)
+        print('%s, %i frames: %i windows' % (file_name, num_frames, x_window.shape[0]))
+        # Generation: feeds of up to capacity windows, loaded ahead in threads; segments only for a conv model
+        for dv_y_cfg in [windows_cfg, conv_cfg]:
+            feed_cfg, _model_cfg = make_gen_feed_model_cfg(dv_y_cfg, 7)
+            [(gen_file_name, feed_list)] = list(load_gen_feeds(feed_cfg, file_dir_dict, [('p001', file_name)], 2, 2))
+            if dv_y_cfg.conv_window_exec:
+                gen_window_list = [segment_to_windows(feed_dict['x'][0, 0], feed_cfg.batch_seq_len, feed_cfg.batch_seq_shift) for feed_dict, batch_size in feed_list]
+            else:
+                gen_window_list = [feed_dict['x'][0, :batch_size] for feed_dict, batch_size in feed_list]
+            assert all([batch_size <= 7 for feed_dict, batch_size in feed_list])
+            x_gen = numpy.concatenate(gen_window_list, axis=0) if gen_window_list else numpy.zeros((0, x_window.shape[1]))
+            assert gen_file_name == file_name
+            assert x_gen.shape == x_window.shape and numpy.array_equal(x_gen, x_window)
+
+if __name__ == '__main__':
+    test_conv_window_exec_cmp_train()
+    test_conv_window_exec_cmp_class_test()
+    test_conv_window_exec_wav()
+    test_conv_window_test_feed()
@@ -0,0 +1,137 @@
+# data_pipeline_test.py
+
+# Incremental data pipeline: manifest hashes, selective rebuild of File_Stage, merge of new inputs in Aggregate_Stage
+# Changing one input rebuilds only that file_id; a missing output is rebuilt; a changed old input of an aggregate rebuilds it in full
+# Run from merlin_cued_mw545_pytorch: python tests/data_pipeline_test.py
+
+import os, sys, tempfile
+import numpy
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from modules import Feat_Stats
+from modules_pipeline import Pipeline_Manifest, File_Stage, Aggregate_Stage, run_file_stage, run_aggregate_stage
+
+def double_worker(worker_state, in_file_name, out_file_name):
+    (numpy.fromfile(in_file_name, dtype=numpy.float32) * 2).tofile(out_file_name)
+
+def make_input_files(work_dir, file_id_list, seed=545):
+    rng = numpy.random.RandomState(seed)
+    for file_id in file_id_list:
+        rng.randn(100, 3).astype(numpy.float32).tofile(os.path.join(work_dir, file_id + '.in'))
+
+def make_double_stage(work_dir, scale=2):
+    in_file  = lambda file_id: os.path.join(work_dir, file_id + '.in')
+    out_file = lambda file_id: os.path.join(work_dir, file_id + '.out')
+    return File_Stage('Double', {'scale': scale}, lambda file_id: [in_file(file_id)], lambda file_id: [out_file(file_id)], double_worker, lambda file_id: (in_file(file_id), out_file(file_id)))
+
+def test_manifest():
+    work_dir = tempfile.mkdtemp()
+    make_input_files(work_dir, ['a', 'b'])
+    manifest_file = os.path.join(work_dir, 'manifest.json')
+    manifest = Pipeline_Manifest(manifest_file)
+    file_list = [os.path.join(work_dir, x + '.in') for x in ['a', 'b']]
+    manifest.update_hashes(file_list + [os.path.join(work_dir, 'missing.in')])
+    assert manifest.get_hash(file_list[0]) is not None and manifest.get_hash(os.path.join(work_dir, 'missing.in')) is None
+    manifest.set_record('Double', 'a', 'key_a')
+    manifest.save()
+
+    manifest = Pipeline_Manifest(manifest_file)
+    assert manifest.get_record('Double', 'a') == 'key_a' and manifest.get_record('Double', 'b') is None
+    # Same size and mtime: the old hash is kept, even if stale
+    manifest.file_hash[file_list[0]][2] = 'stale'
+    manifest.update_hashes(file_list)
+    assert manifest.get_hash(file_list[0]) == 'stale'
+    # New mtime: re-hashed
+    st = os.stat(file_list[0])
+    os.utime(file_list[0], ns=(st.st_atime_ns, st.st_mtime_ns + 1000000))
+    manifest.update_hashes(file_list)
+    assert manifest.get_hash(file_list[0]) not in ['stale', None]
+    # Deleted: dropped
+    os.remove(file_list[1])
+    manifest.update_hashes(file_list)
+    assert manifest.get_hash(file_list[1]) is None
+
+def test_file_stage_selective_rebuild():
+    work_dir = tempfile.mkdtemp()
+    file_id_list = ['a', 'b', 'c', 'd']
+    make_input_files(work_dir, file_id_list)
+    manifest = Pipeline_Manifest(os.path.join(work_dir, 'manifest.json'))
+    stage = make_double_stage(work_dir)
+    assert run_file_stage(stage, file_id_list, manifest) == 4
+    assert run_file_stage(stage, file_id_list, manifest) == 0
+    mtime_dict = {file_id: os.stat(os.path.join(work_dir, file_id + '.out')).st_mtime_ns for file_id in file_id_list}
+
+    # One input changed, from a fresh manifest object: only that file_id is rebuilt
+    numpy.ones((100, 3), dtype=numpy.float32).tofile(os.path.join(work_dir, 'b.in'))
+    manifest = Pipeline_Manifest(os.path.join(work_dir, 'manifest.json'))
+    assert run_file_stage(stage, file_id_list, manifest) == 1
+    assert numpy.all(numpy.fromfile(os.path.join(work_dir, 'b.out'), dtype=numpy.float32) == 2)
+    for file_id in ['a', 'c', 'd']:
+        assert os.stat(os.path.join(work_dir, file_id + '.out')).st_mtime_ns == mtime_dict[file_id]
+
+    # Touched, same content: nothing to rebuild
+    os.utime(os.path.join(work_dir, 'c.in'))
+    assert run_file_stage(stage, file_id_list, manifest) == 0
+    # Missing output
+    os.remove(os.path.join(work_dir, 'd.out'))
+    assert run_file_stage(stage, file_id_list, manifest) == 1
+    # Missing input: skipped, not failed
+    os.remove(os.path.join(work_dir, 'a.in'))
+    assert run_file_stage(stage, file_id_list, manifest) == 0
+    # New parameters or force: all with inputs
+    assert run_file_stage(make_double_stage(work_dir, scale=3), file_id_list, manifest) == 3
+    assert run_file_stage(stage, file_id_list, manifest, force=True) == 3
+
+def test_aggregate_stage_update():
+    ''' Feat_Stats of all inputs, as the normaliser stages: new inputs are merged, a changed old input rebuilds all '''
+    work_dir = tempfile.mkdtemp()
+    stats_file = os.path.join(work_dir, 'all.stats')
+    call_list = []
+    in_file = lambda file_id: os.path.join(work_dir, file_id + '.in')
+    def run_fn(file_id_list):
+        call_list.append(('run', len(file_id_list)))
+        feat_stats = Feat_Stats(3)
+        for file_id in file_id_list:
+            feat_stats.add_file(in_file(file_id))
+        feat_stats.save(stats_file)
+    def update_fn(file_id_list, new_input_list):
+        call_list.append(('update', len(new_input_list)))
+        feat_stats = Feat_Stats(3)
+        feat_stats.load(stats_file)
+        for file_name in new_input_list:
+            new_stats = Feat_Stats(3)
+            new_stats.add_file(file_name)
+            feat_stats.merge(new_stats)
+        feat_stats.save(stats_file)
+    stage = Aggregate_Stage('Stats', {'feature_dim': 3}, lambda file_id_list: [in_file(file_id) for file_id in file_id_list], [stats_file], run_fn, update_fn)
+    manifest = Pipeline_Manifest(os.path.join(work_dir, 'manifest.json'))
+
+    make_input_files(work_dir, ['a', 'b'])
+    assert run_aggregate_stage(stage, ['a', 'b'], manifest) == 1
+    assert run_aggregate_stage(stage, ['a', 'b'], manifest) == 0
+    # New speakers: only their files are read, the merge equals statistics of all files
+    make_input_files(work_dir, ['c', 'd', 'e'], seed=546)
+    manifest = Pipeline_Manifest(os.path.join(work_dir, 'manifest.json'))
+    assert run_aggregate_stage(stage, ['a', 'b', 'c', 'd', 'e'], manifest) == 1
+    assert call_list == [('run', 2), ('update', 3)]
+    merged_stats = Feat_Stats(3)
+    merged_stats.load(stats_file)
+    data_T_D = numpy.concatenate([numpy.fromfile(in_file(x), dtype=numpy.float32).reshape(-1, 3) for x in ['a', 'b', 'c', 'd', 'e']])
+    assert merged_stats.n == data_T_D.shape[0]
+    assert numpy.allclose(merged_stats.mean, data_T_D.mean(axis=0), atol=1e-6)
+    assert numpy.allclose(merged_stats.std(), data_T_D.std(axis=0), atol=1e-5)
+    assert numpy.allclose(merged_stats.min, data_T_D.min(axis=0)) and numpy.allclose(merged_stats.max, data_T_D.max(axis=0))
+
+    # An old input changed, or removed: statistics cannot be taken out, so all are recomputed
+    numpy.ones((100, 3), dtype=numpy.float32).tofile(in_file('a'))
+    assert run_aggregate_stage(stage, ['a', 'b', 'c', 'd', 'e'], manifest) == 1
+    assert run_aggregate_stage(stage, ['b', 'c', 'd', 'e'], manifest) == 1
+    assert call_list[2:] == [('run', 5), ('run', 4)]
+    # Lost output: recomputed
+    os.remove(stats_file)
+    assert run_aggregate_stage(stage, ['b', 'c', 'd', 'e', 'a'], manifest) == 1
+    assert call_list[4:] == [('run', 5)]
+
+if __name__ == '__main__':
+    test_manifest()
+    test_file_stage_selective_rebuild()
+    test_aggregate_stage_update()
@@ -0,0 +1,95 @@
+# distortion_test.py
+
+# cal_mcd_dir on synthetic mgc, bap and lf0 files: per split and per speaker results against IndividualDistortionComp run on the same file lists
+# Without merlin's utils on the path, against reference_distortion, the formulas of IndividualDistortionComp.compute_distortion
+# Run from merlin_cued_mw545_pytorch: python tests/distortion_test.py
+
+import os, sys, tempfile
+import numpy
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from modules import cal_mcd_dir
+
+class test_cfg(object):
+    def __init__(self):
+        self.num_workers = 2
+        self.acoustic_feature_type = 'STRAIGHT'
+        self.acoustic_in_dimension_dict = {'mgc': 60, 'bap': 25, 'lf0': 1}
+        self.acoustic_file_ext_dict = {'mgc': '.mgc', 'bap': '.bap', 'lf0': '.lf0'}
+
+def reference_distortion(file_id_list, ref_dir, gen_dir, file_ext, feature_dim):
+    ''' Whole-list distortion of one feature: mean frame distance; for lf0 voiced F0 RMSE, F0 correlation and V/UV error rate '''
+    distortion, num_frames = 0., 0
+    ref_f0_list, gen_f0_list, num_vuv_err = [], [], 0
+    for file_id in file_id_list:
+        ref_data = numpy.fromfile(os.path.join(ref_dir, file_id + file_ext), dtype=numpy.float32).reshape(-1, feature_dim).astype(numpy.float64)
+        gen_data = numpy.fromfile(os.path.join(gen_dir, file_id + file_ext), dtype=numpy.float32).reshape(-1, feature_dim).astype(numpy.float64)
+        T = min(ref_data.shape[0], gen_data.shape[0])
+        ref_data, gen_data = ref_data[:T], gen_data[:T]
+        num_frames += T
+        if file_ext == '.lf0':
+            ref_voiced, gen_voiced = ref_data[:, 0] > 0, gen_data[:, 0] > 0
+            ref_f0_list.append(numpy.exp(ref_data[ref_voiced & gen_voiced, 0]))
+            gen_f0_list.append(numpy.exp(gen_data[ref_voiced & gen_voiced, 0]))
+            num_vuv_err += numpy.sum(ref_voiced != gen_voiced)
+        else:
+            if file_ext == '.mgc':
+                ref_data, gen_data = ref_data[:, 1:], gen_data[:, 1:]
+            distortion += numpy.sum(numpy.sqrt(numpy.sum((ref_data - gen_data) ** 2, axis=1)))
+    if file_ext == '.lf0':
+        ref_f0, gen_f0 = numpy.concatenate(ref_f0_list), numpy.concatenate(gen_f0_list)
+        return numpy.sqrt(numpy.mean((ref_f0 - gen_f0) ** 2)), numpy.corrcoef(ref_f0, gen_f0)[0, 1], num_vuv_err / float(num_frames)
+    return distortion / num_frames
+
+def get_distortion_fn():
+    try:
+        from utils.compute_distortion import IndividualDistortionComp
+        return IndividualDistortionComp().compute_distortion
+    except ImportError:
+        return reference_distortion
+
+def make_distortion_files(ref_dir, gen_dir, file_id_list, cfg, seed=545):
+    rng = numpy.random.RandomState(seed)
+    for file_id in file_id_list:
+        T = rng.randint(80, 200)
+        for feat_name, feature_dim in cfg.acoustic_in_dimension_dict.items():
+            if feat_name == 'lf0':
+                ref_data = numpy.where(rng.uniform(size=(T, 1)) > 0.3, rng.uniform(4.5, 5.5, size=(T, 1)), -1.0e10)
+                gen_data = numpy.where(rng.uniform(size=(T, 1)) > 0.1, ref_data + rng.normal(0, 0.05, size=(T, 1)), -1.0e10)
+                gen_data[(ref_data <= 0) & (rng.uniform(size=(T, 1)) > 0.8)] = 5.
+            else:
+                ref_data = rng.randn(T, feature_dim)
+                gen_data = ref_data + rng.normal(0, 0.2, size=(T, feature_dim))
+            # Generated files may be up to 2 frames longer
+            gen_data = numpy.concatenate([gen_data, gen_data[:rng.randint(3)]], axis=0)
+            ref_data.astype(numpy.float32).tofile(os.path.join(ref_dir, file_id + cfg.acoustic_file_ext_dict[feat_name]))
+            gen_data.astype(numpy.float32).tofile(os.path.join(gen_dir, file_id + cfg.acoustic_file_ext_dict[feat_name]))
+
+def test_cal_mcd_dir():
+    ref_dir, gen_dir = tempfile.mkdtemp(), tempfile.mkdtemp()
+    cfg = test_cfg()
+    file_id_list = {'valid': ['p0_001', 'p0_002', 'p1_003'], 'test': ['p1_004', 'p2_005', 'p2_006', 'p2_007']}
+    make_distortion_files(ref_dir, gen_dir, file_id_list['valid'] + file_id_list['test'], cfg)
+    result_dict = cal_mcd_dir(cfg, ref_dir, gen_dir, file_id_list)
+    distortion_fn = get_distortion_fn()
+
+    for tvt in file_id_list:
+        speaker_list = sorted(set([file_id.split('_')[0] for file_id in file_id_list[tvt]]))
+        assert set([k for k in result_dict if k[0] == tvt]) == set([(tvt, 'all')] + [(tvt, s) for s in speaker_list])
+        for speaker_id in speaker_list + ['all']:
+            sub_file_id_list = [file_id for file_id in file_id_list[tvt] if speaker_id in ['all', file_id.split('_')[0]]]
+            r = result_dict[(tvt, speaker_id)]
+            MCD = distortion_fn(sub_file_id_list, ref_dir, gen_dir, '.mgc', 60) * (10 / numpy.log(10)) * numpy.sqrt(2.0)
+            BAP = distortion_fn(sub_file_id_list, ref_dir, gen_dir, '.bap', 25) / 10.0
+            F0_RMSE, F0_CORR, VUV = distortion_fn(sub_file_id_list, ref_dir, gen_dir, '.lf0', 1)
+            assert numpy.allclose([r['MCD'], r['BAP'], r['F0_RMSE'], r['F0_CORR'], r['VUV']], [MCD, BAP, F0_RMSE, F0_CORR, VUV], rtol=1e-6)
+
+    # One row per file, with the result of that file alone
+    with open(os.path.join(gen_dir, 'distortion.tsv'), 'r') as f:
+        line_list = [l.rstrip('\n').split('\t') for l in f.readlines()]
+    assert line_list[0] == ['split', 'file_id', 'speaker_id', 'num_frames', 'MCD', 'BAP', 'F0_RMSE', 'F0_CORR', 'VUV']
+    assert sorted([(l[0], l[1]) for l in line_list[1:]]) == sorted([(tvt, file_id) for tvt in file_id_list for file_id in file_id_list[tvt]])
+    for l in line_list[1:]:
+        assert abs(float(l[4]) - distortion_fn([l[1]], ref_dir, gen_dir, '.mgc', 60) * (10 / numpy.log(10)) * numpy.sqrt(2.0)) < 1e-5
+
+if __name__ == '__main__':
+    test_cal_mcd_dir()
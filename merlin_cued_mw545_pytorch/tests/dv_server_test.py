@@ -0,0 +1,140 @@
+# dv_server_test.py
+
+# d-vector extraction server on a Unix socket, with a tiny model: lambdas of concurrent requests against the offline path (gen_lambda_store)
+# cmp file paths and buffers; a RIFF wav path for a wav model, against the same samples converted and normalised offline; then /stats
+# A Sinenet model with a pitch feed: nlf and tau of each window are batched with x; buffers, which have no pitch store, are refused
+# Run from merlin_cued_mw545_pytorch: python tests/dv_server_test.py
+
+import os, sys, json, socket, threading, tempfile, base64, http.client
+import numpy, scipy.io.wavfile, torch
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from modules import make_wav_min_max_normaliser
+from modules_torch import torch_initialisation
+from tests.gen_lambda_test import test_gen_configuration, make_cmp_configuration, make_sinenet_configuration
+
+class test_cfg(object):
+    def __init__(self, work_dir):
+        self.nn_feat_resil_norm_files = {'wav': os.path.join(work_dir, 'nn_wav_resil_norm_80_info.dat')}
+        make_wav_min_max_normaliser(self.nn_feat_resil_norm_files['wav'], 80)
+
+class Unix_HTTP_Connection(http.client.HTTPConnection):
+    def __init__(self, unix_socket_file_name):
+        super().__init__('localhost')
+        self.unix_socket_file_name = unix_socket_file_name
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.unix_socket_file_name)
+
+def send_request(unix_socket_file_name, method, path, request_dict=None):
+    connection = Unix_HTTP_Connection(unix_socket_file_name)
+    connection.request(method, path, body=None if request_dict is None else json.dumps(request_dict))
+    response = connection.getresponse()
+    result_dict = json.loads(response.read())
+    connection.close()
+    return response.status, result_dict
+
+def start_server(work_dir, dv_y_cfg):
+    from exp_mw545.exp_dv_server import dv_y_server_configuration, make_dv_y_server
+    dv_y_cfg.dv_file_name = os.path.join(work_dir, 'DV.dat') # Not generated: no speaker index
+    dv_y_cfg.dv_index_file_name  = os.path.join(work_dir, 'DV_index.npz')
+    dv_y_cfg.dv_index_num_lists  = 1
+    dv_y_cfg.dv_index_num_probe  = 1
+    server_cfg = dv_y_server_configuration(test_cfg(work_dir))
+    server_cfg.unix_socket_file_name = os.path.join(work_dir, 'dv.sock')
+    server_cfg.batch_num_spk = 2
+    server_cfg.max_wait_ms   = 50.
+    server = make_dv_y_server(dv_y_cfg, server_cfg)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, server_cfg.unix_socket_file_name
+
+def gen_offline_lambda(dv_y_cfg, file_list):
+    from exp_mw545.exp_dv_cmp_pytorch import gen_lambda_store
+    torch.manual_seed(545)
+    dv_y_model = torch_initialisation(dv_y_cfg)
+    dv_y_model.save_nn_model(dv_y_cfg.nnets_file_name)
+    lambda_u_dict = gen_lambda_store(None, dv_y_cfg, dv_y_model, [(file_name.split('_')[0], [file_name]) for file_name in file_list], 'dv_server_test')
+    return lambda_u_dict.get_lambda_B(file_list)
+
+def test_server_cmp():
+    work_dir = tempfile.mkdtemp()
+    dv_y_cfg, file_list = make_cmp_configuration(work_dir, conv_window_exec=False)
+    file_list = file_list[1:] # The first is too short for one window
+    lambda_N_D, B_N = gen_offline_lambda(dv_y_cfg, file_list)
+    server, unix_socket_file_name = start_server(work_dir, dv_y_cfg)
+
+    # Concurrent requests share batches of 2*20 windows
+    result_dict_list = [None] * len(file_list)
+    def request_file(i):
+        result_dict_list[i] = send_request(unix_socket_file_name, 'POST', '/lambda', {'file_path': os.path.join(dv_y_cfg.feat_dir_dict['cmp'], file_list[i] + '.cmp')})[1]
+    thread_list = [threading.Thread(target=request_file, args=(i,)) for i in range(len(file_list))]
+    [t.start() for t in thread_list]
+    [t.join() for t in thread_list]
+    for i, result_dict in enumerate(result_dict_list):
+        assert result_dict['B'] == B_N[i]
+        assert numpy.allclose(result_dict['lambda'], lambda_N_D[i], atol=1e-5)
+
+    # Buffer of the same features
+    buffer = open(os.path.join(dv_y_cfg.feat_dir_dict['cmp'], file_list[-1] + '.cmp'), 'rb').read()
+    status, result_dict = send_request(unix_socket_file_name, 'POST', '/lambda', {'buffer': base64.b64encode(buffer).decode()})
+    assert status == 200 and numpy.allclose(result_dict['lambda'], lambda_N_D[-1], atol=1e-5)
+
+    # Errors are returned, not raised in the server
+    status, result_dict = send_request(unix_socket_file_name, 'POST', '/lambda', {'file_path': os.path.join(work_dir, 'p0_001.lab')})
+    assert status == 400 and 'error' in result_dict
+
+    status, stats_dict = send_request(unix_socket_file_name, 'GET', '/stats')
+    print(stats_dict)
+    assert status == 200
+    assert stats_dict['num_requests'] == len(file_list) + 1
+    assert stats_dict['num_windows'] == numpy.sum(B_N) + B_N[-1]
+    assert 0 < stats_dict['batch_fill'] <= 1 and stats_dict['latency_ms_p99'] >= stats_dict['latency_ms_p50'] > 0
+    server.shutdown()
+    server.server_close()
+
+def test_server_riff_wav():
+    from exp_mw545.exp_dv_wav_baseline import make_feed_dict_y_wav_cmp_test
+    work_dir = tempfile.mkdtemp()
+    dv_y_cfg = test_gen_configuration(work_dir, 'wav', feat_dim=1, batch_seq_len=320, batch_seq_shift=80, first_layer_type='ReLUDVMax')
+    dv_y_cfg.make_feed_dict_method_test = make_feed_dict_y_wav_cmp_test
+    dv_y_cfg.wav_sr = 16000
+    riff_dir = os.path.join(work_dir, 'riff')
+    os.makedirs(riff_dir)
+    os.makedirs(dv_y_cfg.feat_dir_dict['wav'])
+    rng = numpy.random.RandomState(545)
+    file_list = ['p0_001', 'p1_002']
+    for file_name, num_samples in zip(file_list, [16000, 12345]):
+        pcm = (rng.randn(num_samples) * 3000).astype(numpy.int16)
+        scipy.io.wavfile.write(os.path.join(riff_dir, file_name + '.wav'), 16000, pcm)
+        # Offline: whole 80-sample frames, MinMax normalised from [-32768, 32768] to [-3.99, 3.99]
+        pcm = pcm[:(num_samples // 80) * 80].astype(numpy.float64)
+        ((pcm + 32768.) * (7.98 / 65536.) - 3.99).astype(numpy.float32).tofile(os.path.join(dv_y_cfg.feat_dir_dict['wav'], file_name + '.wav'))
+    lambda_N_D, B_N = gen_offline_lambda(dv_y_cfg, file_list)
+    server, unix_socket_file_name = start_server(work_dir, dv_y_cfg)
+    for i, file_name in enumerate(file_list):
+        status, result_dict = send_request(unix_socket_file_name, 'POST', '/lambda', {'file_path': os.path.join(riff_dir, file_name + '.wav')})
+        assert status == 200 and result_dict['B'] == B_N[i]
+        assert numpy.allclose(result_dict['lambda'], lambda_N_D[i], atol=1e-5)
+    server.shutdown()
+    server.server_close()
+
+def test_server_sinenet_pitch_feed():
+    work_dir = tempfile.mkdtemp()
+    dv_y_cfg, file_list = make_sinenet_configuration(work_dir)
+    dv_y_cfg.use_pitch_feed = True
+    lambda_N_D, B_N = gen_offline_lambda(dv_y_cfg, file_list)
+    server, unix_socket_file_name = start_server(work_dir, dv_y_cfg)
+    for i, file_name in enumerate(file_list):
+        status, result_dict = send_request(unix_socket_file_name, 'POST', '/lambda', {'file_path': os.path.join(dv_y_cfg.feat_dir_dict['wav'], file_name + '.wav')})
+        assert status == 200 and result_dict['B'] == B_N[i]
+        assert numpy.allclose(result_dict['lambda'], lambda_N_D[i], atol=1e-5)
+    buffer = open(os.path.join(dv_y_cfg.feat_dir_dict['wav'], file_list[0] + '.wav'), 'rb').read()
+    status, result_dict = send_request(unix_socket_file_name, 'POST', '/lambda', {'buffer': base64.b64encode(buffer).decode()})
+    assert status == 400 and 'use_pitch_feed' in result_dict['error']
+    server.shutdown()
+    server.server_close()
+
+if __name__ == '__main__':
+    test_server_cmp()
+    test_server_riff_wav()
+    test_server_sinenet_pitch_feed()
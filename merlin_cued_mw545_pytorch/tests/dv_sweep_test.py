@@ -0,0 +1,91 @@
+# dv_sweep_test.py
+
+# Sweep scheduler pieces that need no training: parameter grid, median stopping rule, per-trial exp_dir
+# A small configuration class stands in for dv_y_cmp_configuration; its exp_dir ignores learning_rate, so trials collide
+# Run from merlin_cued_mw545_pytorch: python tests/dv_sweep_test.py
+
+import os, sys, tempfile
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from modules import make_logger
+from exp_mw545.exp_dv_sweep import make_sweep_param_list, make_sweep_trial_list, make_dv_y_cfg_from_params, is_trial_losing
+
+class test_cfg(object):
+    def __init__(self, work_dir):
+        self.work_dir = work_dir
+
+class test_dv_y_configuration(object):
+    ''' Makes exp_dir in auto_complete, at the end of the constructor, as dv_y_configuration does '''
+    def __init__(self, cfg):
+        self.learning_rate = 0.0001
+        self.batch_seq_len = 40
+        self.dv_dim = 8
+        self.nn_layer_config_list = [{'type':'ReLUDVMax', 'size':16}, {'type':'LinDV', 'size':self.dv_dim}]
+        self.exp_dir_suffix = ''
+        self.auto_complete(cfg)
+
+    def auto_complete(self, cfg):
+        self.exp_dir = os.path.join(cfg.work_dir, 'DV%iT%i%s' % (self.nn_layer_config_list[-1]['size'], self.batch_seq_len, self.exp_dir_suffix))
+        self.telemetry_file_name = os.path.join(self.exp_dir, 'telemetry.jsonl')
+        if not os.path.exists(self.exp_dir):
+            os.makedirs(self.exp_dir)
+
+class test_sweep_configuration(object):
+    def __init__(self, work_dir, param_grid):
+        self.config_module = __name__
+        self.config_class  = 'test_dv_y_configuration'
+        self.param_grid = param_grid
+        self.sweep_dir  = work_dir
+        self.kill_grace_epoch    = 2
+        self.kill_margin         = 0.05
+        self.kill_min_num_trials = 2
+
+def test_make_sweep_param_list():
+    param_list = make_sweep_param_list({'learning_rate': [0.001, 0.0001], 'dv_dim': [16, 32, 64]})
+    assert len(param_list) == 6
+    # Keys in sorted order, the last one changing fastest
+    assert param_list[0] == {'dv_dim': 16, 'learning_rate': 0.001}
+    assert param_list[1] == {'dv_dim': 16, 'learning_rate': 0.0001}
+    assert param_list[-1] == {'dv_dim': 64, 'learning_rate': 0.0001}
+    assert make_sweep_param_list({}) == [{}]
+
+def test_trial_exp_dir():
+    work_dir = tempfile.mkdtemp()
+    cfg = test_cfg(work_dir)
+    dv_y_cfg = make_dv_y_cfg_from_params(cfg, __name__, 'test_dv_y_configuration', {'dv_dim': 32, 'batch_seq_len': 20})
+    assert type(dv_y_cfg) is test_dv_y_configuration
+    # dv_dim resizes the bottleneck layer; the exp_dir of the base configuration (DV8T40) is never made
+    assert dv_y_cfg.nn_layer_config_list[-1]['size'] == 32
+    assert os.listdir(work_dir) == ['DV32T20']
+
+    # learning_rate is not in exp_dir: the second trial of each pair gets a suffix
+    sweep_cfg = test_sweep_configuration(work_dir, {'learning_rate': [0.001, 0.0001], 'dv_dim': [16, 32]})
+    trial_list = make_sweep_trial_list(cfg, sweep_cfg, [], make_logger('dv_sweep_test'))
+    exp_dir_list = [os.path.basename(trial['exp_dir']) for trial in trial_list]
+    assert exp_dir_list == ['DV16T40', 'DV16T40_sweep001', 'DV32T40', 'DV32T40_sweep003']
+    assert [trial['exp_dir_suffix'] for trial in trial_list] == ['', '_sweep001', '', '_sweep003']
+    assert sorted(os.listdir(work_dir)) == sorted(exp_dir_list + ['DV32T20'])
+
+def make_trial(best_valid_loss_list):
+    return {'best_valid_loss_list': best_valid_loss_list}
+
+def test_is_trial_losing():
+    sweep_cfg = test_sweep_configuration(None, {})
+    other_list = [make_trial([2.0, 1.0, 0.9]), make_trial([2.0, 1.2, 1.1]), make_trial([2.0, 1.4])]
+    # Median of the others at epoch 2 is 1.2; losing above 1.2 * 1.05
+    trial = make_trial([2.0, 1.3])
+    assert is_trial_losing(trial, other_list + [trial], sweep_cfg)
+    trial = make_trial([2.0, 1.25])
+    assert not is_trial_losing(trial, other_list + [trial], sweep_cfg)
+    # Within the grace epochs
+    trial = make_trial([9.0])
+    assert not is_trial_losing(trial, other_list + [trial], sweep_cfg)
+    # Two other trials have reached epoch 3 (median 1.0), none epoch 4
+    trial = make_trial([2.0, 1.1, 1.1])
+    assert is_trial_losing(trial, other_list + [trial], sweep_cfg)
+    trial = make_trial([2.0, 1.1, 1.1, 1.1])
+    assert not is_trial_losing(trial, other_list + [trial], sweep_cfg)
+
+if __name__ == '__main__':
+    test_make_sweep_param_list()
+    test_trial_exp_dir()
+    test_is_trial_losing()
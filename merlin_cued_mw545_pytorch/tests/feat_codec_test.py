@@ -0,0 +1,82 @@
+# feat_codec_test.py
+
+# Feature file codecs: encode_features, codec_info.json, then Feat_Decoder.load, against the normalised features
+# float16 and int16 within half a quantisation step, mulaw8 within half a mu-law step, bitpack exact
+# Run from merlin_cued_mw545_pytorch: python tests/feat_codec_test.py
+
+import os, sys, tempfile
+import numpy
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from modules import encode_features, make_codec_scale_offset, save_codec_info, feat_codec_dtype_dict
+from modules_2 import Feat_Decoder
+
+def round_trip(norm_features, codec_name, norm_scale, norm_offset, binary_mask=None):
+    ''' Stored in a directory of its own, as the codec is per directory '''
+    feat_dir = tempfile.mkdtemp()
+    scale, offset = make_codec_scale_offset(codec_name, norm_scale, norm_offset, binary_mask)
+    code = encode_features(norm_features, codec_name, scale, offset, binary_mask)
+    assert code.dtype == feat_codec_dtype_dict[codec_name]
+    code.tofile(os.path.join(feat_dir, 'p0_001.feat'))
+    save_codec_info(feat_dir, codec_name, scale, offset, binary_mask)
+    features, frame_number = Feat_Decoder().load(os.path.join(feat_dir, 'p0_001.feat'), norm_features.shape[1])
+    assert features.dtype == numpy.float32 and frame_number == norm_features.shape[0]
+    return features
+
+def make_wav_norm_features(rng, num_frames=200):
+    ''' PCM samples, 80 per frame, MinMax normalised from [-32768, 32768] to [-3.99, 3.99], as make_wav_min_max_normaliser '''
+    norm_scale  = numpy.full(80, 7.98 / 65536.)
+    norm_offset = numpy.full(80, 32768. * 7.98 / 65536. - 3.99)
+    pcm = numpy.clip(rng.laplace(scale=3000., size=(num_frames, 80)), -32768, 32767)
+    return pcm * norm_scale + norm_offset, norm_scale, norm_offset
+
+def test_float16():
+    rng = numpy.random.RandomState(545)
+    norm_features = rng.uniform(0.01, 0.99, size=(100, 86))
+    features = round_trip(norm_features, 'float16', numpy.ones(86), numpy.zeros(86))
+    # 11-bit mantissa: relative error at most 2**-11
+    assert numpy.all(numpy.abs(features - norm_features) <= numpy.abs(norm_features) * 2. ** -11 + 1e-7)
+
+def test_int16():
+    rng = numpy.random.RandomState(545)
+    norm_features, norm_scale, norm_offset = make_wav_norm_features(rng)
+    features = round_trip(norm_features, 'int16', norm_scale, norm_offset)
+    assert numpy.max(numpy.abs(features - norm_features)) <= norm_scale[0] / 2. + 1e-6
+
+def test_mulaw8():
+    rng = numpy.random.RandomState(545)
+    norm_features, norm_scale, norm_offset = make_wav_norm_features(rng)
+    features = round_trip(norm_features, 'mulaw8', norm_scale, norm_offset)
+    # Half a code is 1/255 in the companded domain; its slope in the linear domain is log(1+mu)/mu * (1+mu|x|)
+    x_unit = (norm_features - norm_offset) / (norm_scale * 32768.)
+    x_unit_hat = (features - norm_offset) / (norm_scale * 32768.)
+    mu = 255.
+    assert numpy.all(numpy.abs(x_unit_hat - x_unit) <= numpy.log1p(mu) / mu * (1. + mu * numpy.abs(x_unit)) / 255. * 1.01 + 2. / 32768.)
+    # Small samples are kept finer than large ones
+    small = numpy.abs(x_unit) < 0.01
+    assert numpy.max(numpy.abs(x_unit_hat - x_unit)[small]) < numpy.max(numpy.abs(x_unit_hat - x_unit)[~small])
+
+def test_bitpack():
+    rng = numpy.random.RandomState(545)
+    # 11 binary dimensions (two packed bytes), then 5 numeric, as binary questions before numeric label features
+    binary_mask = numpy.array([True] * 11 + [False] * 5)
+    raw = numpy.concatenate([rng.randint(2, size=(60, 11)), rng.randn(60, 5)], axis=1)
+    norm_scale  = rng.uniform(0.5, 2., size=16)
+    norm_offset = rng.uniform(-0.5, 0.5, size=16)
+    norm_features = numpy.array(raw * norm_scale + norm_offset, dtype=numpy.float32)
+    features = round_trip(norm_features, 'bitpack', norm_scale, norm_offset, binary_mask)
+    assert numpy.allclose(features, norm_features, atol=1e-6)
+    assert numpy.array_equal(features[:, ~binary_mask], norm_features[:, ~binary_mask])
+    # A binary dimension with another value cannot be packed
+    norm_features[3, 2] = 0.5
+    scale, offset = make_codec_scale_offset('bitpack', norm_scale, norm_offset, binary_mask)
+    try:
+        encode_features(norm_features, 'bitpack', scale, offset, binary_mask)
+        assert False
+    except ValueError:
+        pass
+
+if __name__ == '__main__':
+    test_float16()
+    test_int16()
+    test_mulaw8()
+    test_bitpack()
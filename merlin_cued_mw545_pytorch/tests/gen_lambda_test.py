@@ -0,0 +1,121 @@
+# gen_lambda_test.py
+
+# Batched generation (gen_lambda_store_batched) against the per-file path (gen_lambda_store): same lambda_u and B_u per file
+# Batches mix windows of several files; cmp windowed and conv_window_exec models, and a wav Sinenet model with a pitch feed
+# Run from merlin_cued_mw545_pytorch: python tests/gen_lambda_test.py
+
+import os, sys, tempfile
+import numpy, torch
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from modules import make_logger
+from modules_2 import Pitch_Store
+from modules_dv import Lambda_Store
+from modules_torch import DV_Y_CMP_model, torch_initialisation
+
+class test_gen_configuration(object):
+    ''' Enough of dv_y_configuration for gen_lambda_store and gen_lambda_store_batched '''
+    def __init__(self, work_dir, y_feat_name, feat_dim, batch_seq_len, batch_seq_shift, first_layer_type):
+        self.y_feat_name = y_feat_name
+        self.feat_dim    = feat_dim
+        self.nn_feature_dims = feat_dim
+        self.feat_index  = numpy.arange(feat_dim)
+        self.feat_decoder_dict = None
+        self.delta_composer    = None
+        self.batch_seq_len   = batch_seq_len
+        self.batch_seq_shift = batch_seq_shift
+        self.frames_silence_to_keep = 0
+        self.sil_pad = 5
+        self.batch_num_spk = 1
+        self.spk_num_seq   = 20
+        self.dv_dim = 8
+        self.nn_layer_config_list = [
+            {'type':first_layer_type, 'size':16, 'num_channels':2, 'dropout_p':0},
+            {'type':'LinDV', 'size':self.dv_dim, 'num_channels':1, 'dropout_p':0}
+        ]
+        self.num_nn_layers = len(self.nn_layer_config_list)
+        self.num_speaker_dict = {'train': 3}
+        self.speaker_id_list_dict = {'train': ['p0', 'p1', 'p2']}
+        self.train_by_window  = True
+        self.conv_window_exec = False
+        self.learning_rate = 0.0001
+        self.gpu_id = 'cpu'
+        self.dv_y_model_class = DV_Y_CMP_model
+        self.feat_dir_dict = {y_feat_name: os.path.join(work_dir, 'data')}
+        self.lambda_store_dir = os.path.join(work_dir, 'lambda')
+        self.nnets_file_name  = os.path.join(work_dir, 'model.pt')
+        self.profiler_switch  = False
+        self.gen_num_load_threads = 2
+        self.gen_num_load_ahead   = 3
+
+def make_cmp_configuration(work_dir, conv_window_exec):
+    from exp_mw545.exp_dv_cmp_baseline import make_feed_dict_y_cmp_test
+    dv_y_cfg = test_gen_configuration(work_dir, 'cmp', feat_dim=86, batch_seq_len=40, batch_seq_shift=5, first_layer_type='ReLUDVMax')
+    dv_y_cfg.conv_window_exec = conv_window_exec
+    dv_y_cfg.make_feed_dict_method_test = make_feed_dict_y_cmp_test
+    os.makedirs(dv_y_cfg.feat_dir_dict['cmp'])
+    rng = numpy.random.RandomState(545)
+    # Frames: too short, one window, several feeds, several feeds with a partial last shift
+    file_list = ['p0_001', 'p0_002', 'p1_003', 'p1_004', 'p2_005']
+    for file_name, num_frames in zip(file_list, [47, 50, 400, 403, 260]):
+        rng.randn(num_frames, 86).astype(numpy.float32).tofile(os.path.join(dv_y_cfg.feat_dir_dict['cmp'], file_name + '.cmp'))
+    return dv_y_cfg, file_list
+
+def make_sinenet_configuration(work_dir):
+    from tests.pitch_store_test import make_pitch_files
+    from exp_mw545.exp_dv_wav_baseline import make_feed_dict_y_wav_sinenet_test
+    dv_y_cfg = test_gen_configuration(work_dir, 'wav', feat_dim=1, batch_seq_len=3200, batch_seq_shift=400, first_layer_type='Sinenet')
+    dv_y_cfg.make_feed_dict_method_test = make_feed_dict_y_wav_sinenet_test
+    dv_y_cfg.wav_sr   = 16000
+    dv_y_cfg.lf0_mean = 5.02654
+    dv_y_cfg.lf0_std  = 0.373288
+    pitch_dir = os.path.join(work_dir, 'pitch')
+    os.makedirs(pitch_dir)
+    file_list, boundary_list = make_pitch_files(pitch_dir, num_files=4)
+    dv_y_cfg.pitch_store = Pitch_Store(pitch_dir)
+    os.makedirs(dv_y_cfg.feat_dir_dict['wav'])
+    rng = numpy.random.RandomState(545)
+    # Silence-reduced wav, 80 samples per frame
+    for file_name, (start, end) in zip(file_list, boundary_list):
+        rng.randn((end - start) * 80).astype(numpy.float32).tofile(os.path.join(dv_y_cfg.feat_dir_dict['wav'], file_name + '.wav'))
+    return dv_y_cfg, file_list
+
+def check_gen_lambda(dv_y_cfg, file_list, capacity=7):
+    from exp_mw545.exp_dv_cmp_pytorch import gen_lambda_store, gen_lambda_store_batched, make_gen_feed_model_cfg
+    torch.manual_seed(545)
+    dv_y_model = torch_initialisation(dv_y_cfg)
+    dv_y_model.save_nn_model(dv_y_cfg.nnets_file_name)
+    speaker_file_list = [(file_name.split('_')[0], file_name) for file_name in file_list]
+
+    # Per-file path: spk_num_seq windows per forward, one file at a time
+    lambda_u_dict = gen_lambda_store(None, dv_y_cfg, dv_y_model, [(speaker_id, [file_name]) for speaker_id, file_name in speaker_file_list], 'gen_lambda_test')
+
+    # Batched path: capacity windows per forward, mixed across files
+    feed_cfg, model_cfg = make_gen_feed_model_cfg(dv_y_cfg, capacity)
+    gen_model = torch_initialisation(model_cfg)
+    gen_model.load_nn_model(dv_y_cfg.nnets_file_name)
+    gen_model.eval()
+    batched_dict = Lambda_Store(os.path.join(dv_y_cfg.lambda_store_dir, 'batched'), 'test', dv_y_cfg.dv_dim)
+    gen_lambda_store_batched(feed_cfg, gen_model, speaker_file_list, batched_dict, make_logger('gen_lambda_test'))
+
+    lambda_N_D, B_N = lambda_u_dict.get_lambda_B(file_list)
+    lambda_batched_N_D, B_batched_N = batched_dict.get_lambda_B(file_list)
+    print('%s: B_u %s, max lambda error %.3g' % (dv_y_cfg.y_feat_name, numpy.array(B_N, dtype=int).tolist(), numpy.max(numpy.abs(lambda_N_D - lambda_batched_N_D))))
+    assert numpy.array_equal(B_N, B_batched_N)
+    assert numpy.allclose(lambda_N_D, lambda_batched_N_D, atol=1e-5)
+    return B_N
+
+def test_gen_lambda_cmp():
+    for conv_window_exec in [False, True]:
+        dv_y_cfg, file_list = make_cmp_configuration(tempfile.mkdtemp(), conv_window_exec)
+        B_N = check_gen_lambda(dv_y_cfg, file_list)
+        # A file too short for one window is stored with B 0; the others span several batches
+        assert list(B_N) == [0, 1, 71, 71, 43]
+
+def test_gen_lambda_sinenet_pitch_feed():
+    dv_y_cfg, file_list = make_sinenet_configuration(tempfile.mkdtemp())
+    B_N = check_gen_lambda(dv_y_cfg, file_list)
+    assert numpy.all(B_N > 7)
+
+if __name__ == '__main__':
+    test_gen_lambda_cmp()
+    test_gen_lambda_sinenet_pitch_feed()
@@ -0,0 +1,73 @@
+# parallel_tasks_test.py
+
+# run_parallel_file_tasks: serial and process pool give the same results, each passed to result_fn with its own task
+# Worker state from init_fn; a transient failure is retried; a task failing every attempt raises after all other tasks finished
+# Run from merlin_cued_mw545_pytorch: python tests/parallel_tasks_test.py
+
+import os, sys, tempfile
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from modules import run_parallel_file_tasks, make_size_aware_chunks
+
+def init_offset_worker(offset):
+    return {'offset': offset, 'pid': os.getpid()}
+
+def offset_square_worker(worker_state, x):
+    return x * x + worker_state['offset']
+
+def flaky_worker(worker_state, x, marker_dir):
+    ''' Fails on the first attempt at each x; fails on every attempt at negative x '''
+    marker_file = os.path.join(marker_dir, '%i.tried' % x)
+    if (x < 0) or (not os.path.exists(marker_file)):
+        open(marker_file, 'w').close()
+        raise IOError('attempt at %i failed' % x)
+    return x
+
+def test_size_aware_chunks():
+    size_list = [1, 50, 3, 20, 20, 2, 4]
+    chunk_list = make_size_aware_chunks(size_list, num_workers=2, chunks_per_worker=2)
+    # Every task once, largest first; chunks of at least total/4 but the last
+    assert sorted([i for chunk in chunk_list for i in chunk]) == list(range(len(size_list)))
+    assert chunk_list[0] == [1]
+    chunk_size_list = [sum([size_list[i] for i in chunk]) for chunk in chunk_list]
+    assert all([x >= sum(size_list) / 4. for x in chunk_size_list[:-1]])
+
+def test_serial_pool_equivalence():
+    task_list = [(x,) for x in range(40)]
+    result_dict = {}
+    for num_workers in [1, 3]:
+        result_list = []
+        run_parallel_file_tasks(offset_square_worker, task_list, init_offset_worker, (7,), num_workers=num_workers, size_list=[1] * len(task_list), result_fn=lambda task, result: result_list.append((task, result)))
+        assert all([result == task[0] * task[0] + 7 for task, result in result_list])
+        result_dict[num_workers] = result_list
+    # Serial: tasks of equal size keep their order; pool: chunks finish in any order, same results
+    assert [task for task, result in result_dict[1]] == task_list
+    assert sorted(result_dict[3]) == result_dict[1]
+
+def test_retry_and_failure():
+    for num_workers in [1, 2]:
+        marker_dir = tempfile.mkdtemp()
+        result_list = []
+        run_parallel_file_tasks(flaky_worker, [(x, marker_dir) for x in range(6)], num_workers=num_workers, num_retries=1, result_fn=lambda task, result: result_list.append(result))
+        assert sorted(result_list) == list(range(6))
+
+        marker_dir = tempfile.mkdtemp()
+        result_list = []
+        try:
+            run_parallel_file_tasks(flaky_worker, [(x, marker_dir) for x in [3, -1, 4, -2, 5]], num_workers=num_workers, num_retries=2, result_fn=lambda task, result: result_list.append(result))
+            assert False
+        except RuntimeError as e:
+            assert '2 of 5' in str(e)
+        # Other tasks still finished and reached result_fn
+        assert sorted(result_list) == [3, 4, 5]
+
+        marker_dir = tempfile.mkdtemp()
+        try:
+            run_parallel_file_tasks(flaky_worker, [(x, marker_dir) for x in range(3)], num_workers=num_workers, num_retries=0)
+            assert False
+        except RuntimeError as e:
+            assert '3 of 3' in str(e)
+
+if __name__ == '__main__':
+    test_size_aware_chunks()
+    test_serial_pool_equivalence()
+    test_retry_and_failure()
@@ -0,0 +1,139 @@
+# pitch_store_test.py
+
+# Binary pitch stores (Pitch_Store) against the old text path: re-printed .pm text, scalar find_pitch_time
+# Then the Sinenet pitch feed: make_pitch_feed windows, and a Sinenet first layer taking Pitch_Input
+# Run from merlin_cued_mw545_pytorch: python tests/pitch_store_test.py
+
+import os, sys, tempfile
+import numpy, torch
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from modules import Silence_Index, reduce_silence_reaper_output
+from modules_2 import Pitch_Store
+
+class test_cfg(object):
+    def __init__(self):
+        self.frame_sr = 200
+
+class test_dv_y_configuration(object):
+    def __init__(self, pitch_dir):
+        self.frames_silence_to_keep = 50
+        self.sil_pad = 5
+        self.wav_sr  = 16000
+        self.feat_dim = 1
+        self.batch_seq_len   = 3200
+        self.batch_seq_shift = 400
+        self.batch_num_spk = 2
+        self.spk_num_seq   = 6
+        self.lf0_mean = 5.02654
+        self.lf0_std  = 0.373288
+        self.pitch_store = Pitch_Store(pitch_dir)
+
+def write_reaper_output(reaper_output_file, rng, num_marks=600):
+    ''' REAPER-style text: header lines, then "time vuv f0" lines '''
+    t = numpy.cumsum(rng.uniform(0.002, 0.012, size=num_marks))
+    vuv = (rng.uniform(size=num_marks) > 0.3).astype(int)
+    f0 = numpy.where(vuv > 0, rng.uniform(80., 300., size=num_marks), -1.)
+    with open(reaper_output_file, 'w') as f:
+        f.write('EST_File Track\nDataType ascii\nNumFrames %i\nNumChannels 1\nEST_Header_End\n' % num_marks)
+        for i in range(num_marks):
+            f.write('%f %i %f\n' % (t[i], vuv[i], f0[i]))
+    return t[-1]
+
+def old_reduce_silence_reaper_output(reaper_output_file, start_time, end_time, out_file):
+    ''' Text path before the binary stores '''
+    with open(reaper_output_file, 'r') as f:
+        file_lines = f.readlines()
+    with open(out_file, 'w') as f:
+        for l in file_lines:
+            x = l.strip().split(' ')
+            if len(x) == 3:
+                t = float(x[0])
+                if (t >= start_time) and (t <= end_time):
+                    f.write(str(t - start_time)+' '+x[1]+' '+x[2]+'\n')
+
+def old_find_pitch_time(pitch_loc_list, t_start, t_end):
+    for t in pitch_loc_list:
+        if t > t_start:
+            if t <= t_end:
+                return t
+        elif t > t_end:
+            return 0
+    return 0
+
+def old_query_tau(pm_file, t_start, t_end):
+    pitch_loc_list = [float(l.split(' ')[0]) for l in open(pm_file, 'r').readlines()]
+    pitch_time = old_find_pitch_time(pitch_loc_list, t_start, t_end)
+    return pitch_time - t_start if pitch_time > 0 else 0.
+
+def make_pitch_files(temp_dir, num_files=10, seed=545):
+    ''' Binary stores by reduce_silence_reaper_output, and the old .pm text of the same files '''
+    rng = numpy.random.RandomState(seed)
+    cfg = test_cfg()
+    file_id_list = ['p%i_%03i' % (i % 3, i) for i in range(num_files)]
+    boundary_list = []
+    for file_id in file_id_list:
+        total_time = write_reaper_output(os.path.join(temp_dir, file_id + '.used.pm'), rng)
+        start = rng.randint(20, 80)
+        boundary_list.append((start, int(total_time * cfg.frame_sr) - rng.randint(20, 80)))
+    worker_state = {'cfg': cfg, 'silence_index': Silence_Index(file_id_list, boundary_list)}
+    for file_id, (start, end) in zip(file_id_list, boundary_list):
+        reaper_output_file = os.path.join(temp_dir, file_id + '.used.pm')
+        reduce_silence_reaper_output(cfg, reaper_output_file, file_id + '.lab', os.path.join(temp_dir, file_id + '.pitch'), worker_state=worker_state)
+        old_reduce_silence_reaper_output(reaper_output_file, float(start) / cfg.frame_sr, float(end) / cfg.frame_sr, os.path.join(temp_dir, file_id + '.pm'))
+    return file_id_list, boundary_list
+
+def test_query_windows_against_text_path(seq_len=3200, sr=16000):
+    temp_dir = tempfile.mkdtemp()
+    file_id_list, boundary_list = make_pitch_files(temp_dir)
+    pitch_store = Pitch_Store(temp_dir)
+    rng = numpy.random.RandomState(0)
+    start_index_SB = rng.randint(0, 80000, size=(len(file_id_list), 50)) # Some past the last mark
+    tau_SB, lf0_SB = pitch_store.query_windows(file_id_list, start_index_SB, seq_len, sr)
+    for s, file_id in enumerate(file_id_list):
+        pm_file = os.path.join(temp_dir, file_id + '.pm')
+        pitch_data = numpy.array([l.split(' ') for l in open(pm_file, 'r').readlines()], dtype=numpy.float64)
+        voiced = (pitch_data[:, 1] > 0) & (pitch_data[:, 2] > 0)
+        for b in range(start_index_SB.shape[1]):
+            t_start = float(start_index_SB[s, b]) / sr
+            t_end   = t_start + float(seq_len) / sr
+            assert abs(tau_SB[s, b] - old_query_tau(pm_file, t_start, t_end)) < 1e-9
+            # log-F0 at the window centre, linear between the voiced marks either side of it
+            t_mid = (t_start + t_end) / 2.
+            lf0 = numpy.interp(t_mid, pitch_data[voiced, 0], numpy.log(pitch_data[voiced, 2]))
+            assert abs(lf0_SB[s, b] - lf0) < 1e-9
+    # Windows with and without a pitch mark are both covered
+    assert numpy.any(tau_SB > 0) and numpy.any(tau_SB == 0)
+
+def test_sinenet_pitch_feed():
+    from exp_mw545.exp_dv_wav_baseline import make_pitch_feed
+    from modules_torch import DV_Y_CMP_NN_model, Pitch_Input
+    temp_dir = tempfile.mkdtemp()
+    file_id_list, boundary_list = make_pitch_files(temp_dir, num_files=2)
+    dv_y_cfg = test_dv_y_configuration(temp_dir)
+    total_sil_one_side = (dv_y_cfg.frames_silence_to_keep + dv_y_cfg.sil_pad) * 80
+    start_index_SB = total_sil_one_side + dv_y_cfg.batch_seq_shift * numpy.arange(dv_y_cfg.spk_num_seq).reshape(1, -1).repeat(2, axis=0)
+    nlf, tau = make_pitch_feed(dv_y_cfg, file_id_list, start_index_SB)
+    assert nlf.shape == (2, dv_y_cfg.spk_num_seq, 1, 1)
+    # Window starts in the silence-reduced wav are total_sil_one_side samples after the pitch time origin
+    for s, file_id in enumerate(file_id_list):
+        for b in range(dv_y_cfg.spk_num_seq):
+            t_start = float(dv_y_cfg.batch_seq_shift * b) / dv_y_cfg.wav_sr
+            assert abs(tau[s, b, 0, 0] - old_query_tau(os.path.join(temp_dir, file_id + '.pm'), t_start, t_start + 0.2)) < 1e-9
+
+    # Sinenet first layer takes the pitch of each window from the feed
+    dv_y_cfg.dv_dim = 8
+    dv_y_cfg.nn_layer_config_list = [{'type':'Sinenet', 'size':16, 'num_channels':2, 'dropout_p':0}, {'type':'LinDV', 'size':dv_y_cfg.dv_dim, 'num_channels':1, 'dropout_p':0}]
+    dv_y_cfg.num_nn_layers = 2
+    dv_y_cfg.num_speaker_dict = {'train': 5}
+    dv_y_cfg.train_by_window  = True
+    dv_y_cfg.conv_window_exec = False
+    nn_model = DV_Y_CMP_NN_model(dv_y_cfg)
+    x = torch.randn(2, dv_y_cfg.spk_num_seq, dv_y_cfg.batch_seq_len)
+    lambda_SBD = nn_model.gen_lambda_SBD(Pitch_Input(x, torch.tensor(nlf, dtype=torch.float), torch.tensor(tau, dtype=torch.float)))
+    assert lambda_SBD.shape == (2, dv_y_cfg.spk_num_seq, dv_y_cfg.dv_dim)
+    lambda_shift = nn_model.gen_lambda_SBD(Pitch_Input(x, torch.tensor(nlf, dtype=torch.float), torch.tensor(tau + 0.001, dtype=torch.float)))
+    assert not torch.allclose(lambda_SBD, lambda_shift)
+
+if __name__ == '__main__':
+    test_query_windows_against_text_path()
+    test_sinenet_pitch_feed()
@@ -0,0 +1,84 @@
+# speaker_index_test.py
+
+# Speaker_Index: IVF recall and speed against exact search, unfilled slots, and the DV.dat index
+# Rows are noisy copies of random speaker centres, so the exact top-1 is a row of the query's speaker
+# Run from merlin_cued_mw545_pytorch: python tests/speaker_index_test.py
+
+import os, sys, time, pickle, tempfile
+import numpy
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from modules_dv import Speaker_Index, load_speaker_index
+
+def make_clustered_rows(num_rows, num_speakers, dv_dim, noise=0.3, seed=545):
+    rng = numpy.random.RandomState(seed)
+    centre_S_D = rng.randn(num_speakers, dv_dim)
+    speaker_idx_N = rng.randint(num_speakers, size=num_rows)
+    dv_N_D = centre_S_D[speaker_idx_N] + noise * rng.randn(num_rows, dv_dim)
+    return ['p%05i' % s for s in speaker_idx_N], dv_N_D, centre_S_D
+
+def test_ivf_recall_and_speed(num_rows=200000, num_speakers=2000, dv_dim=32, num_queries=200, num_lists=256, num_probe=8):
+    speaker_id_list, dv_N_D, centre_S_D = make_clustered_rows(num_rows, num_speakers, dv_dim)
+    speaker_index = Speaker_Index(dv_dim)
+    speaker_index.enrol(speaker_id_list, dv_N_D)
+    numpy.random.seed(545)
+    speaker_index.build_ivf(num_lists)
+    query_Q_D = centre_S_D[:num_queries] + 0.3 * numpy.random.RandomState(0).randn(num_queries, dv_dim)
+
+    t_start = time.time()
+    exact_id_Q_K, exact_score_Q_K = speaker_index.search(query_Q_D, k=10)
+    exact_time = time.time() - t_start
+    t_start = time.time()
+    ivf_id_Q_K, ivf_score_Q_K = speaker_index.search(query_Q_D, k=10, num_probe=num_probe)
+    ivf_time = time.time() - t_start
+
+    recall = numpy.mean(ivf_id_Q_K[:, 0] == exact_id_Q_K[:, 0])
+    print('%i rows, %i lists, %i probed: recall@1 %.3f; exact %.3f s, ivf %.3f s' % (num_rows, num_lists, num_probe, recall, exact_time, ivf_time))
+    assert recall >= 0.95
+    assert ivf_time < exact_time
+    # An IVF hit can never beat the exact score
+    assert numpy.all(ivf_score_Q_K[:, 0] <= exact_score_Q_K[:, 0] + 1e-5)
+
+def test_unfilled_slots():
+    speaker_index = Speaker_Index(2)
+    speaker_index.enrol(['a', 'b', 'c', 'd'], numpy.array([[1., 0.], [1., 0.1], [-1., 0.], [-1., -0.1]]))
+    numpy.random.seed(0)
+    speaker_index.build_ivf(2)
+    speaker_id_Q_K, score_Q_K = speaker_index.search(numpy.array([[1., 0.]]), k=4, num_probe=1)
+    # The probed list holds fewer than 4 rows; the rest are id -1, score -inf, never row 0's id
+    num_found = max([row_list.shape[0] for row_list in speaker_index.list_row_list if 0 in row_list])
+    assert num_found < 4
+    assert speaker_id_Q_K[0, 0] == 'a'
+    assert -1 not in list(speaker_id_Q_K[0, :num_found])
+    assert list(speaker_id_Q_K[0, num_found:]) == [-1] * (4 - num_found)
+    assert numpy.all(numpy.isneginf(score_Q_K[0, num_found:]))
+
+def test_enrol_after_build():
+    speaker_id_list, dv_N_D, centre_S_D = make_clustered_rows(5000, 50, 16)
+    speaker_index = Speaker_Index(16)
+    speaker_index.enrol(speaker_id_list[:4000], dv_N_D[:4000])
+    numpy.random.seed(0)
+    speaker_index.build_ivf(16)
+    speaker_index.enrol(speaker_id_list[4000:], dv_N_D[4000:])
+    assert sum([row_list.shape[0] for row_list in speaker_index.list_row_list]) == 5000
+    speaker_id_Q_K, score_Q_K = speaker_index.search(dv_N_D[4000:4100], k=1, num_probe=16)
+    assert list(speaker_id_Q_K[:, 0]) == speaker_id_list[4000:4100]
+
+def test_dv_file_index():
+    speaker_id_list, dv_N_D, centre_S_D = make_clustered_rows(100, 100, 16)
+    temp_dir = tempfile.mkdtemp()
+    dv_file_name = os.path.join(temp_dir, 'DV.dat')
+    index_file_name = os.path.join(temp_dir, 'DV.idx')
+    pickle.dump({'p%05i' % s: centre_S_D[s] for s in range(100)}, open(dv_file_name, 'wb'))
+    # First call builds from DV.dat and writes the index; second reads the index
+    for i in range(2):
+        numpy.random.seed(0)
+        speaker_index = load_speaker_index(dv_file_name, index_file_name, num_lists=8)
+        assert os.path.isfile(index_file_name)
+        speaker_id_Q_K, score_Q_K = speaker_index.search(centre_S_D[:20], k=1, num_probe=8)
+        assert list(speaker_id_Q_K[:, 0]) == ['p%05i' % s for s in range(20)]
+
+if __name__ == '__main__':
+    test_ivf_recall_and_speed()
+    test_unfilled_slots()
+    test_enrol_after_build()
+    test_dv_file_index()
@@ -0,0 +1,99 @@
+# verification_test.py
+
+# Speaker verification metrics: EER, minDCF and DET points on score sets with known answers
+# Score_Histogram against the exact (sorted score) path, and all-pair scoring against a full score matrix
+# Run from merlin_cued_mw545_pytorch: python tests/verification_test.py
+
+import os, sys
+import numpy
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from modules_dv import compute_det_curve, compute_verification_metrics, Score_Histogram, score_all_pair_trials, make_sampled_trial_list, normalise_rows
+
+def test_known_answer():
+    target_scores    = numpy.array([0.4123, 0.6123, 0.8123, 0.9123])
+    nontarget_scores = numpy.array([0.1123, 0.2123, 0.3123, 0.5123])
+    P_miss, P_fa, thresholds = compute_det_curve(target_scores, nontarget_scores)
+    # Accepting scores > threshold: everything at -inf, nothing at the top score
+    assert (P_miss[0], P_fa[0]) == (0., 1.)
+    assert (P_miss[-1], P_fa[-1]) == (1., 0.)
+    assert numpy.allclose(P_miss, [0, 0, 0, 0, 0.25, 0.25, 0.5, 0.75, 1.])
+    assert numpy.allclose(P_fa,   [1., 0.75, 0.5, 0.25, 0.25, 0., 0., 0., 0.])
+
+    # P_miss and P_fa are both 0.25 at threshold 0.4123
+    metric_dict = compute_verification_metrics(target_scores, nontarget_scores, P_target=0.5)
+    assert abs(metric_dict['eer'] - 0.25) < 1e-12
+    assert metric_dict['eer_threshold'] == 0.4123
+    # P_target 0.5: normalised cost is P_miss + P_fa, lowest (0.25) first at threshold 0.3123
+    assert abs(metric_dict['min_dcf'] - 0.25) < 1e-12
+    assert metric_dict['min_dcf_threshold'] == 0.3123
+    # P_target 0.01: normalised cost is P_miss + 99 P_fa, lowest with no false alarm, at threshold 0.5123
+    metric_dict = compute_verification_metrics(target_scores, nontarget_scores, P_target=0.01)
+    assert abs(metric_dict['min_dcf'] - 0.25) < 1e-12
+    assert metric_dict['min_dcf_threshold'] == 0.5123
+    assert (metric_dict['num_target'], metric_dict['num_nontarget']) == (4, 4)
+
+    # No score shares a bin with another: the histogram gives the same DET points, at bin edges
+    score_histogram = Score_Histogram()
+    score_histogram.add(target_scores, nontarget_scores)
+    P_miss_h, P_fa_h, thresholds_h = score_histogram.compute_det_curve()
+    assert set(zip(P_miss_h, P_fa_h)) == set(zip(P_miss, P_fa))
+    metric_dict_h = score_histogram.compute_verification_metrics(P_target=0.01)
+    assert abs(metric_dict_h['eer'] - 0.25) < 1e-12
+    assert abs(metric_dict_h['min_dcf'] - 0.25) < 1e-12
+    assert abs(metric_dict_h['min_dcf_threshold'] - 0.5123) < 2. / score_histogram.num_bins
+
+def test_histogram_against_exact(seed=545):
+    rng = numpy.random.RandomState(seed)
+    target_scores    = numpy.clip(rng.normal(0.5, 0.2, size=5000), -1, 1)
+    nontarget_scores = numpy.clip(rng.normal(0.0, 0.2, size=50000), -1, 1)
+    metric_dict = compute_verification_metrics(target_scores, nontarget_scores)
+    score_histogram = Score_Histogram()
+    for n_start in range(0, 50000, 10000):
+        score_histogram.add(target_scores[n_start//10:n_start//10+1000], nontarget_scores[n_start:n_start+10000])
+    metric_dict_h = score_histogram.compute_verification_metrics()
+    # Two unit-variance classes 2.5 sigma apart: EER is about Phi(-1.25) = 0.106
+    assert abs(metric_dict['eer'] - 0.106) < 0.01
+    assert abs(metric_dict_h['eer'] - metric_dict['eer']) < 1e-3
+    assert abs(metric_dict_h['min_dcf'] - metric_dict['min_dcf']) < 1e-2
+    assert (metric_dict_h['num_target'], metric_dict_h['num_nontarget']) == (5000, 50000)
+    # DET points are reduced, and P_miss rises as P_fa falls
+    assert metric_dict_h['det_P_miss'].shape[0] <= 1000
+    assert numpy.all(numpy.diff(metric_dict_h['det_P_miss']) >= 0) and numpy.all(numpy.diff(metric_dict_h['det_P_fa']) <= 0)
+
+def test_all_pair_trials(N=500, num_speakers=20, dv_dim=16, seed=545):
+    rng = numpy.random.RandomState(seed)
+    speaker_idx_N = rng.randint(num_speakers, size=N)
+    lambda_N_D = rng.randn(num_speakers, dv_dim)[speaker_idx_N] + rng.randn(N, dv_dim)
+    score_histogram = score_all_pair_trials(lambda_N_D, speaker_idx_N, block_size=64, num_threads=3)
+
+    x_N_D = normalise_rows(lambda_N_D)
+    i, j = numpy.triu_indices(N, k=1)
+    scores = numpy.sum(x_N_D[i] * x_N_D[j], axis=1)
+    is_target = speaker_idx_N[i] == speaker_idx_N[j]
+    assert numpy.sum(score_histogram.target_count) == numpy.sum(is_target)
+    assert numpy.sum(score_histogram.nontarget_count) == numpy.sum(~is_target)
+    metric_dict = compute_verification_metrics(scores[is_target], scores[~is_target])
+    metric_dict_h = score_histogram.compute_verification_metrics()
+    assert abs(metric_dict_h['eer'] - metric_dict['eer']) < 1e-3
+
+def test_sampled_trial_list():
+    speaker_idx_N = numpy.array([0, 0, 1, 1, 1, 2])
+    trial_index_M_2, is_target_M = make_sampled_trial_list(speaker_idx_N, num_nontarget=50)
+    # 1 + 3 target pairs, then the non-target ones
+    assert numpy.sum(is_target_M) == 4 and numpy.sum(~is_target_M) == 50
+    pair_speaker_M_2 = speaker_idx_N[trial_index_M_2]
+    assert numpy.all((pair_speaker_M_2[:, 0] == pair_speaker_M_2[:, 1]) == is_target_M)
+    # One speaker: no non-target pair can be drawn
+    try:
+        make_sampled_trial_list(numpy.zeros(5, dtype=int), num_nontarget=10)
+        assert False
+    except ValueError:
+        pass
+    trial_index_M_2, is_target_M = make_sampled_trial_list(numpy.zeros(5, dtype=int), num_nontarget=0)
+    assert numpy.all(is_target_M) and trial_index_M_2.shape == (10, 2)
+
+if __name__ == '__main__':
+    test_known_answer()
+    test_histogram_against_exact()
+    test_all_pair_trials()
+    test_sampled_trial_list()